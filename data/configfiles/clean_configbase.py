@@ -104,5 +104,18 @@ atlases = {"":
                 }}
    
 
+
+cachedir = ""
+depcheck = "mtime"
+backend = "local"
+spooldir = ""
+spoolwait = 300
+maxprocs = 0
+memlimit = 0
+pool = "process"
+journal = True
+engine = "freesurfer"
+chunkframes = 0
+
 #==========================================================================#    
 #==========================================================================#    
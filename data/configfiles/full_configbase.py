@@ -149,6 +149,9 @@ extractions : dictionary
                 "maskcon"    : contrast to mask image with before extraction
                 "maskthresh" : threshold to apply to the mask (in -log10(p))
                 "masksign"   : constrain mask to "pos" or "neg" (optional -- default "abs")
+                "stats"      : more region statistics to extract along with the mean, from
+                               "median", "std", "min", "max", "p<N>" (Nth percentile), 
+                               and "trim<N>" (mean without the top and bottom N%)
 """
 
 extractions = [{"par": "", "extract": ""},
@@ -180,6 +183,8 @@ Entry Formats
 - sourcelevel: "subject" or "group"
 - sourcedir: string
 - sourcefiles: "all" or list of strings 
+- weighted: bool (mask atlases only, optional -- default False; treats the
+  mask images as region weights, e.g. probability maps)
 - coordsys: "mni", "tal", or "vox"
 - radius: integer
 - centers: dictionary with a string keys and tuples of integers as values 
@@ -226,5 +231,64 @@ atlases = {"":
                 }}
    
 
+#------------------------------<Execution>---------------------------------#
+"""
+All of these settings are optional
+
+cachedir : string
+           directory to cache the outputs of Freesurfer programs in, so they are 
+           not run again on unchanged inputs (relative to basepath; default: no cache)
+depcheck : string
+           how to tell whether the inputs to a processing step changed since
+           its outputs were made: "mtime" (size and modification time; default)
+           or "digest" (file contents)
+backend  : string
+           where to run Freesurfer programs: "local" (default) or "spool" to 
+           hand them to `pyroi worker` processes through the spool directory
+spooldir : string
+           spool directory for the "spool" backend (relative to basepath; 
+           default: roi/analysis/<projectname>/spool)
+spoolwait : int
+           seconds a spooled job may wait with no live `pyroi worker` to run 
+           it before it is withdrawn and reported as failed (default: 300; 
+           0 waits forever)
+maxprocs : int
+           most external programs one PyROI process will run at once (default: 
+           0, no limit)
+memlimit : int
+           memory budget in megabytes for the external programs that all PyROI
+           processes of the project on one host run at once; each program is 
+           admitted against the peak memory it was measured to use on earlier
+           runs, or 1000 MB until it has been measured (default: 0, no budget)
+pool     : string
+           how group methods with n_jobs > 1 run subjects: "process" (a pool of 
+           worker processes; default) or "thread" (threads in one process, 
+           limited by maxprocs)
+journal  : bool
+           record when each processing step starts and finishes in 
+           roi/analysis/<projectname>/journal, and rerun steps that were 
+           interrupted (default: True)
+engine   : string
+           "freesurfer" (default) runs Freesurfer programs for every step; 
+           "native" does the steps PyROI can do itself (e.g. extraction) in 
+           Python with NumPy
+chunkframes : int
+           with the native engine, read source images this many frames at a
+           time instead of all at once, so long timecourses can be extracted
+           in bounded memory; 0 (default) reads them whole
+"""
+
+cachedir = ""
+depcheck = "mtime"
+backend = "local"
+spooldir = ""
+spoolwait = 300
+maxprocs = 0
+memlimit = 0
+pool = "process"
+journal = True
+engine = "freesurfer"
+chunkframes = 0
+
 #==========================================================================#    
 #==========================================================================#    
@@ -2,6 +2,7 @@
 from atlases import *
 from core import *
 from database import build_database
+from project import run_project
 import source
 import exceptions
 import treeutils as tree
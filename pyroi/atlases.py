@@ -27,14 +27,19 @@ Functions
 ---------
 init_atlas         :  Common interface to instantiation of atlas classes
 
+extract_atlases    :  Extract one analysis for several atlases, reading each
+                      source image once
+
 See the docstrings for different classes for more information and usage examples
 
 """
 import os
 import re
 import sys
+import time
 import shutil
 import subprocess
+from copy import copy
 from glob import glob
 from tempfile import mkdtemp
 
@@ -46,12 +51,20 @@ import configinterface as cfg
 import source
 import treeutils as tree
 from exceptions import *
-from database import build_database
+from database import build_database, cube_database
 import core
+import cache
+import locks
+import parallel
+import extraction
+import resample
+import clusters
+import journal
 from core import RoiBase, RoiResult
 
 __all__ = ["Atlas", "FreesurferAtlas", "FSRegister", "LabelAtlas", "SigSurfAtlas",
-           "MaskAtlas", "HarvardOxfordAtlas", "SphereAtlas", "init_atlas"]
+           "MaskAtlas", "HarvardOxfordAtlas", "SphereAtlas", "init_atlas",
+           "extract_atlases"]
 
 __module__ = "atlases"
 
@@ -205,43 +218,56 @@ class Atlas(RoiBase):
                                                  % text))
         return repr
 
-    def _atlas_exists(self):
-        """Return whether the atlas file exists."""
+    def _hemi_files(self, fname):
+        """Return a list with a file path for each hemisphere (or just one)."""
         if self.manifold == "volume":
-            return os.path.isfile(self.atlas)
+            return [fname]
         else:
-            exists = []
-            for hemi in self.iterhemi:
-                if os.path.isfile(self.atlas % hemi):
-                    exists.append(True)
-                else:  
-                    exists.append(False)
-            return all(exists)
+            return [fname % hemi for hemi in self.iterhemi]
+
+    def _atlas_files(self):
+        """Return a list of the atlas image files."""
+        return self._hemi_files(self.atlas)
+
+    def _atlas_inputs(self):
+        """Return a list of the files the atlas image is made from."""
+        return []
+
+    def _source_files(self):
+        """Return a list of the source image files for the analysis."""
+        return self._hemi_files(self.analysis.source)
+
+    def _mask_files(self):
+        """Return a list of the mask image files for the analysis."""
+        if not self.mask:
+            return []
+        return self._hemi_files(self.analysis.maskimg)
+
+    def _extract_files(self):
+        """Return a list of the files written by extraction."""
+        files = []
+        fnames = [self.functxt, self.funcvol, self.funcstats]
+        fnames.extend([self._stat_file(stat) for stat in self.analysis.stats])
+        for fname in fnames:
+            files.extend(self._hemi_files(fname))
+        return files
+
+    def _stat_file(self, stat):
+        """Return the path to the text file for an extra region statistic."""
+        return os.path.join(self.analysis.dir, "extracttxt",
+                            "%s.%s.txt" % (self.subject, stat))
 
-    def _source_exists(self):
+    def _atlas_exists(self):
         """Return whether the atlas file exists."""
-        if self.manifold == "volume":
-            return os.path.isfile(self.analysis.source)
-        else:
-            exists = []
-            for hemi in self.iterhemi:
-                if os.path.isfile(self.analysis.source % hemi):
-                    exists.append(True)
-                else:  
-                    exists.append(False)
-            return all(exists)
+        return all([os.path.isfile(f) for f in self._atlas_files()])
+
+    def _source_exists(self):
+        """Return whether the source file exists."""
+        return all([os.path.isfile(f) for f in self._source_files()])
+
     def _extract_exists(self):
         """Return whether an extraction text file exists."""
-        if self.manifold == "volume":
-            return os.path.isfile(self.functxt)
-        else:
-            exists = []
-            for hemi in self.iterhemi:
-                if os.path.isfile(self.functxt % hemi):
-                    exists.append(True)
-                else:  
-                    exists.append(False)
-            return all(exists)
+        return all([os.path.isfile(f) for f in self._hemi_files(self.functxt)])
 
 
     # Initialization methods
@@ -286,7 +312,7 @@ class Atlas(RoiBase):
             self.analysis.masksign = analysis.masksign
         else:
             self.mask = False
-        sourceimg = source.init_stat_object(analysis, debug=self.debug)
+        sourceimg = source.init_stat_object(analysis, **self._runopts())
         sourceimg.init_subject(self.subject)
         if self.manifold == "surface":
             self.analysis.source = sourceimg.extractsurf
@@ -331,14 +357,23 @@ class Atlas(RoiBase):
         """Copy an annotation from the roi atlas tree to the subjects directory."""
         result = RoiResult()
         for hemi in self.iterhemi:
-            target = os.path.join(self.subjdir, self.subject, "label", 
-                                  "%s.%s.annot" % (hemi, self.atlasname))
+            target = self._annot_file(hemi, self.atlasname)
             if not self.debug:
                 shutil.copyfile(self.atlas % hemi, target)
             result("cp %s %s" % (self.atlas % hemi, target))
         return result
                                     
 
+    def _annot_file(self, hemi, name):
+        """Return the path to an annotation in the subject's label directory."""
+        return os.path.join(self.subjdir, self.subject, "label", 
+                            "%s.%s.annot" % (hemi, name))
+
+    def _annot_inputs(self, hemi, name):
+        """Return the files read by segstats for an annotation."""
+        return [self._annot_file(hemi, name),
+                os.path.join(self.subjdir, self.subject, "surf", "%s.white" % hemi)]
+
     def _sourcenames_to_lutdict(self):                        
         """Turn the list of sourcenames into a lookup dict."""
         self.lutdict = {}
@@ -435,7 +470,7 @@ class Atlas(RoiBase):
             subprocess.call(cmd)
         
     
-    def group_make_atlas(self, subjects=None, reg=1, gen_new_atlas=False):
+    def group_make_atlas(self, subjects=None, reg=1, gen_new_atlas=False, n_jobs=1):
         """Run atlas preprocessing steps for a list of subjects.
         
         Prerequisite
@@ -459,6 +494,9 @@ class Atlas(RoiBase):
             for clusters once.  By default, if the surfcluster summary file
             is found, this method will skip that step.  To force  a new
             cluster summary table to be made, set to true.  
+        n_jobs : int, optional
+            Number of subjects to process at once in separate processes.
+            -1 uses all available cores.  Defaults to 1 (serial).
         
         Returns
         -------
@@ -472,19 +510,20 @@ class Atlas(RoiBase):
         result = RoiResult()
         if self.source == "standard":
             result(self.make_atlas(reg))
-        else:
-            for i, subject in enumerate(subjects):
-                self.init_subject(subject)
-                if self.source != "sigsurf":
-                    res = self.make_atlas(reg)
-                else:
-                    if not i:
-                        gen_new_atlas = gen_new_atlas
-                    else:
-                        gen_new_atlas = False
-                    res = self.make_atlas(reg, gen_new_atlas=gen_new_atlas)
-                print res
-                result(res)
+            return result
+        kwargs = {}
+        if self.source == "sigsurf" and subjects:
+            # The cluster summary has to exist before subjects can run at once
+            self.init_subject(subjects[0])
+            res = self._journaled("make_atlas", "", reg, gen_new_atlas=gen_new_atlas)
+            print res
+            result(res)
+            subjects = subjects[1:]
+            kwargs = dict(gen_new_atlas=False)
+        for res in parallel.map_subjects(self, subjects, "_journaled", 
+                                         ("make_atlas", "", reg), kwargs, n_jobs):
+            print res
+            result(res)
         return result
 
 
@@ -499,7 +538,7 @@ class Atlas(RoiBase):
         cmd.append("--o %s"%output)
         cmd.append("--mul %d"%segnum)
 
-        return self._run(cmd)
+        return self._run(cmd, [self.sourcefiles[segnum-1]], [output])
 
     def _combine_segvols(self):
         """Combine adjusted segvols into one atlas."""
@@ -510,10 +549,12 @@ class Atlas(RoiBase):
         cmd.append("--o %s"%self.atlas)
         cmd.append("--combine")
 
-        return self._run(cmd)
+        return self._run(cmd, self.tempvols, [self.atlas])
 
     def _surfcluster(self):
         """Run mri_surfcluster to get a list of significant labels."""
+        if self._option("engine") == "native":
+            return self._native_surfcluster()
 
         cmd = ["mri_surfcluster"]
 
@@ -531,6 +572,39 @@ class Atlas(RoiBase):
 
         return self._run(cmd)
     
+    def _native_surfcluster(self):
+        """Cluster the sig map in process instead of with mri_surfcluster."""
+        desc = "native surfcluster --subject fsaverage --hemi %s --in %s --cortex" % (
+            self.hemi, self.sourcefile)
+        desc = "%s --annot aparc --olab %s --sum %s" % (
+            desc, self.surfclusterlab, self.surfclustersum)
+        if self.threshtype == "fdr":
+            desc = "%s --fdr %.3f" % (desc, self.threshold)
+        else:
+            desc = "%s --thmin %.3f" % (desc, self.threshold)
+        if not self.debug:
+            sc = self.surface_clusters()
+            thresh = sc.threshold(self.threshtype, self.threshold)
+            sc.write(sc.clusters(thresh), self.surfclustersum, self.surfclusterlab)
+        return RoiResult(desc)
+
+    def surface_clusters(self):
+        """Return a SurfaceClusters object for the sig map of this atlas.
+
+        Use it to try other thresholds and minimum sizes without remaking
+        the atlas::
+
+            >>> sc = atlas.surface_clusters()
+            >>> for thresh in [2, 3, 4]:
+            ...     print len(sc.clusters(thresh, minsize=atlas.minsize))
+
+        Returns
+        -------
+        SurfaceClusters object
+
+        """
+        return clusters.SurfaceClusters(self.sourcefile, self.subjdir, self.hemi)
+
     def _get_atlas_info_from_sum(self):
         """Parse a surfcluster summary file and get label names/files."""
         if not os.path.isfile(self.surfclustersum):
@@ -572,6 +646,8 @@ class Atlas(RoiBase):
 
     def _resample_labels(self):
         """Resample label files from fsaverage surface to native surfaces."""
+        if self._option("engine") == "native":
+            return self._native_resample_labels()
         res = RoiResult()
         subjlevel = bool(self.sourcelevel == "subject")
         for i, label in enumerate(self.sourcefiles):
@@ -585,15 +661,43 @@ class Atlas(RoiBase):
             cmd.append("--trgsubject %s" % self.subject)
             cmd.append("--hemi %s" % self.hemi)
             cmd.append("--regmethod surface")
-            cmd.append("--trglabel %s" 
-                       % os.path.join(self.atlasdir,
-                       "%s.label" % self.sourcenames[i]))
+            trglabel = os.path.join(self.atlasdir, "%s.label" % self.sourcenames[i])
+            cmd.append("--trglabel %s" % trglabel)
 
-            result = self._run(cmd)
+            spheres = [os.path.join(self.subjdir, subj, "surf", "%s.sphere.reg" % self.hemi)
+                       for subj in ["fsaverage", self.subject]]
+            result = self._run(cmd, [label] + spheres, [trglabel])
             res(result)      
 
         return res
 
+    def _native_resample_labels(self):
+        """Resample all labels at once instead of with mri_label2label.
+
+        The fsaverage to subject vertex maps are saved in the roi atlas
+        directory and shared by every label atlas.
+
+        """
+        labels = list(self.sourcefiles)
+        if self.sourcelevel == "subject":
+            labels = [label.replace("$subject", self.subject) for label in labels]
+        trglabels = [os.path.join(self.atlasdir, "%s.label" % name)
+                     for name in self.sourcenames]
+        spheres = [os.path.join(self.subjdir, subj, "surf", "%s.sphere.reg" % self.hemi)
+                   for subj in ["fsaverage", self.subject]]
+        res = RoiResult()
+        for label, trglabel in zip(labels, trglabels):
+            res("native label2label --srcsubject fsaverage --srclabel %s "
+                "--trgsubject %s --hemi %s --regmethod surface --trglabel %s"
+                % (label, self.subject, self.hemi, trglabel))
+        if not self.debug:
+            white = os.path.join(self.subjdir, self.subject, "surf",
+                                 "%s.white" % self.hemi)
+            resample.map_labels(labels, trglabels, spheres[0], spheres[1], white,
+                                self.subject,
+                                os.path.join(self.roidir, "atlases", "spheremaps"))
+        return res
+
     def _gen_annotation(self):
         """Create an annotation from a list of labels."""
         if os.path.isfile(self.origatlas % self.hemi) and not self.debug:
@@ -604,10 +708,12 @@ class Atlas(RoiBase):
         cmd.append("--hemi %s" % self.hemi)
         cmd.append("--ctab %s" % self.lutfile)
         cmd.append("--a %s" % self.atlasname)
-        for label in self.sourcenames:
-            cmd.append("--l %s" % os.path.join(self.atlasdir, "%s.label" % label))
+        labels = [os.path.join(self.atlasdir, "%s.label" % label) 
+                  for label in self.sourcenames]
+        for label in labels:
+            cmd.append("--l %s" % label)
 
-        res = self._run(cmd)
+        res = self._run(cmd, labels + [self.lutfile], [self.origatlas % self.hemi])
 
         try:
             res(self._copy_atlas())
@@ -632,6 +738,8 @@ class Atlas(RoiBase):
 
     def _resample(self):
         """Resample a freesurfer volume atlas into functional space."""
+        if self._option("engine") == "native":
+            return self._native_resample()
         cmd = ["mri_vol2vol"]
         
         cmd.append("--mov %s"%self.meanfuncimg)
@@ -641,7 +749,20 @@ class Atlas(RoiBase):
         cmd.append("--interp nearest")
         cmd.append("--o %s"%self.atlas)
 
-        return self._run(cmd)
+        return self._run(cmd, [self.meanfuncimg, self.origatlas, self.regmat], 
+                         [self.atlas])
+
+    def _native_resample(self):
+        """Resample a volume atlas in process instead of with mri_vol2vol."""
+        desc = ("native vol2vol --mov %s --targ %s --reg %s --inv --interp nearest "
+                "--o %s" % (self.meanfuncimg, self.origatlas, self.regmat, self.atlas))
+        if not self.debug:
+            atlasdir = os.path.dirname(self.atlas)
+            if not os.path.isdir(atlasdir):
+                os.makedirs(atlasdir)
+            resample.resample_labels(self.origatlas, self.meanfuncimg,
+                                     self.regmat, self.atlas)
+        return RoiResult(desc)
 
     def _write_mask(self):
         """Turn an atlas into a binary mask volume."""
@@ -652,7 +773,7 @@ class Atlas(RoiBase):
         for id in self.regions:
             cmd.append("--match %d" % id)
 
-        return(self._run(cmd))
+        return(self._run(cmd, [self.atlas], [self.mask_image]))
                     
     def _stats(self):
         """Generate a summary of voxel/vertex counts for all regions in an atlas."""
@@ -677,7 +798,8 @@ class Atlas(RoiBase):
         for id in ids:
             cmd.append("--id %d" % id)
 
-        return self._run(cmd)
+        inputs = self._annot_inputs(hemi, self.atlasname) + [self.lutfile]
+        return self._run(cmd, inputs, [self.statsfile % hemi])
 
     def _vol_stats(self):
         """Generate stats for a volume atlas."""
@@ -692,9 +814,9 @@ class Atlas(RoiBase):
         cmd.append("--ctab %s"%self.lutfile)
         cmd.append("--sum %s"%self.statsfile)
 
-        return self._run(cmd)
+        return self._run(cmd, [self.atlas, self.lutfile], [self.statsfile])
 
-    def prepare_source_images(self, analysis=None, reg=1):
+    def prepare_source_images(self, analysis=None, reg=1, n_jobs=1):
         """Prepare the functional and statistical images for extraction.
         
         An analysis must be initialized in the atlas
@@ -711,11 +833,17 @@ class Atlas(RoiBase):
             0 : do not create registration matrix
             1 : create registration matrix if it does not exist -- default
             2 : create or overwrite registration matrix
+        n_jobs : int, optional
+            Number of independent steps (e.g. the two hemispheres, or the 
+            source and mask images) to run at once.  Defaults to 1.
 
         Returns
         -------
         RoiResult object
 
+        Each step is recorded in the project journal under the same name 
+        process() gives it, so a step that fails here is run again there.
+
         """
         if analysis is not None:
             self.init_analysis(analysis)
@@ -736,35 +864,79 @@ class Atlas(RoiBase):
                                "\nCall method with a different `reg` setting to create."
                                % (self.subject, mask.analysis.maskpar))
                         return
-                        
 
-        res = RoiResult()
+        jrnl = None
+        if self._option("journal") and not self.debug:
+            jrnl = journal.project_journal(self.subject, self.analysis.name,
+                                           self.atlasname)
+        return parallel.TaskGraph(self._source_tasks(reg)).run(n_jobs, journal=jrnl)
+
+    def _source_tasks(self, reg=1):
+        """Return the list of tasks that prepare the source images.
+
+        The registration, source, and mask branches only meet at the
+        surface sampling steps, and each hemisphere is sampled separately,
+        so a TaskGraph can run most of these at the same time.
+
+        """
+        tasks = []
+        stem = "%s:%s:%s" % (self.subject, self.analysis.paradigm, 
+                             self.analysis.extract)
         if self.manifold == "surface":
-            sourcereg = FSRegister(self.analysis.paradigm, self.subject, debug=self.debug)
-            if reg==2 or (reg==1 and not os.path.isfile(sourcereg.regmat)):
-                res(sourcereg.register())
-                if self.mask and self.analysis.maskpar != self.analysis.paradigm:
-                    maskreg = FSRegister(self.analysis.maskpar, self.subject, debug=self.debug)
-                    if reg==2 or (reg==1 and not os.path.isfile(maskreg.regmat)):
-                        res(maskreg.register())
-        extractvols = source.init_stat_object(self.analysis, debug=self.debug)
+            regpars = [self.analysis.paradigm]
+            if self.mask and self.analysis.maskpar != self.analysis.paradigm:
+                regpars.append(self.analysis.maskpar)
+            for par in regpars:
+                parreg = FSRegister(par, self.subject, **self._runopts())
+                if reg==2 or (reg==1 and not os.path.isfile(parreg.regmat)):
+                    tasks.append(parallel.Task(
+                        "register:%s:%s" % (self.subject, par), parreg.register,
+                        kwargs=dict(force=reg==2),
+                        inputs=[parreg.meanfuncimg], outputs=[parreg.regmat]))
+
+        extractvols = source.init_stat_object(self.analysis, **self._runopts())
         extractvols.init_subject(self.subject)
         if not self.analysis.extract == "timecourse":
-            res(extractvols.concatenate())
+            tasks.append(parallel.Task(
+                "concatenate:%s" % stem, extractvols.concatenate,
+                inputs=extractvols.extractlist, outputs=[extractvols.extractvol]))
         if self.manifold == "surface":
-            res(extractvols.sample_to_surface())
+            for hemi in ["lh", "rh"]:
+                tasks.append(parallel.Task(
+                    "sample:%s:%s" % (stem, hemi), extractvols.sample_to_surface,
+                    kwargs=dict(hemis=[hemi]),
+                    inputs=[extractvols.extractvol, extractvols.regmat],
+                    outputs=[extractvols.extractsurf % hemi]))
         if self.mask:
-            tstat = source.TStatImage(self.analysis, debug=self.debug)
-            tstat.init_subject(self.subject)
-            res(tstat.convert_to_sig())
-            if self.manifold == "surface":
-                sig = source.SigImage(self.analysis, debug=self.debug)
-                sig.init_subject(self.subject)
-                res(sig.sample_to_surface())
+            tasks.extend(self._mask_tasks(self.analysis))
+        return tasks
 
-        return res
+    def _mask_tasks(self, analysis):
+        """Return the tasks that make the mask images of an analysis.
 
-    def group_prepare_source_images(self, analysis, subjects=None, reg=1):
+        The significance image of the mask contrast is made from its t
+        image, and sampled to the surface for surface atlases.
+
+        """
+        tasks = []
+        tstat = source.TStatImage(analysis, **self._runopts())
+        tstat.init_subject(self.subject)
+        sigstem = "%s:%s:%s" % (self.subject, analysis.maskpar, analysis.maskcon)
+        tasks.append(parallel.Task(
+            "convert_to_sig:%s" % sigstem, tstat.convert_to_sig,
+            inputs=[tstat.timg], outputs=[tstat.sigimg]))
+        if self.manifold == "surface":
+            sig = source.SigImage(analysis, **self._runopts())
+            sig.init_subject(self.subject)
+            for hemi in ["lh", "rh"]:
+                tasks.append(parallel.Task(
+                    "sample_sig:%s:%s" % (sigstem, hemi), sig.sample_to_surface,
+                    kwargs=dict(hemis=[hemi]),
+                    inputs=[sig.extractvol, sig.regmat],
+                    outputs=[sig.extractsurf % hemi]))
+        return tasks
+
+    def group_prepare_source_images(self, analysis, subjects=None, reg=1, n_jobs=1):
         """Prepare the source images for a group.
 
         Parameters
@@ -779,6 +951,9 @@ class Atlas(RoiBase):
             0 : do not create registration matrices
             1 : create registration matrices if they do not exist -- default
             2 : create or overwrite registration matricies
+        n_jobs : int, optional
+            Number of subjects to process at once in separate processes.
+            -1 uses all available cores.  Defaults to 1 (serial).
 
         Returns
         -------
@@ -790,9 +965,8 @@ class Atlas(RoiBase):
         elif isinstance(subjects, str):
             subjects = cfg.subjects(subjects)
         result = RoiResult()
-        for subject in subjects:
-            self.init_subject(subject)
-            res = self.prepare_source_images(analysis, reg=reg)
+        for res in parallel.map_subjects(self, subjects, "prepare_source_images",
+                                         (analysis,), dict(reg=reg), n_jobs):
             print res
             result(res)
 
@@ -825,24 +999,56 @@ class Atlas(RoiBase):
         final ROI.
 
         """
-        if not self._init_analysis:
-            raise InitError("Analysis")
-        elif not self._atlas_exists() and not self.debug:
-            raise PreprocessError("The atlas")
-        elif not self._source_exists() and not self.debug:
-            raise PreprocessError("The source")
+        self._check_extract(analysis)
 
         if self.manifold == "volume":
             return self._vol_extract()
         else:
+            if self._use_native() and len(self.iterhemi) > 1:
+                # Native extraction runs in process, so do both hemispheres
+                # at once
+                graph = parallel.TaskGraph(
+                    [parallel.Task("extract:%s" % hemi, self._surf_extract, (hemi,))
+                     for hemi in self.iterhemi])
+                return graph.run(len(self.iterhemi))
             results = RoiResult()
             for hemi in self.iterhemi:
                 res = self._surf_extract(hemi)
                 results(res)
             return results
 
+    def _check_extract(self, analysis=None):
+        """Initialize the analysis and make sure there is data to extract."""
+        if analysis is not None:
+            self.init_analysis(analysis)
+        if not self._init_analysis:
+            raise InitError("Analysis")
+        elif not self._atlas_exists() and not self.debug:
+            raise PreprocessError("The atlas")
+        elif not self._source_exists() and not self.debug:
+            raise PreprocessError("The source")
+
+    def _native_extract(self, cache=None):
+        """Extract with the native engine, reusing images in cache."""
+        if self.manifold == "volume":
+            return self._native_vol_extract(cache)
+        result = RoiResult()
+        for hemi in self.iterhemi:
+            result(self._native_surf_extract(hemi, cache))
+        return result
+
+    def _use_native(self):
+        """Return whether to extract with the native engine.
+
+        Extra region statistics can only be computed natively.
+
+        """
+        return self._option("engine") == "native" or bool(self.analysis.stats)
+
     def _surf_extract(self, hemi):
         """Internal function to extract from a surface."""
+        if self._use_native():
+            return self._native_surf_extract(hemi)
         cmd = ["mri_segstats"]
 
         cmd.append("--annot %s %s %s"%(self.subject, hemi, self.fname[:-6]))
@@ -859,10 +1065,16 @@ class Atlas(RoiBase):
         cmd.append("--avgwfvol %s"%self.funcvol%hemi)
         cmd.append("--sum %s"%self.funcstats%hemi)
 
-        return self._run(cmd)
+        inputs = self._annot_inputs(hemi, self.fname[:-6]) + [self.analysis.source%hemi]
+        if self.mask:
+            inputs.append(self.analysis.maskimg%hemi)
+        outputs = [self.functxt%hemi, self.funcvol%hemi, self.funcstats%hemi]
+        return self._run(cmd, inputs, outputs)
 
     def _vol_extract(self):
         """Internal function to extract from a volume."""
+        if self._use_native():
+            return self._native_vol_extract()
         cmd = ["mri_segstats"]
 
         cmd.append("--seg %s"%self.atlas)
@@ -879,9 +1091,104 @@ class Atlas(RoiBase):
         cmd.append("--avgwfvol %s"%self.funcvol)
         cmd.append("--sum %s"%self.funcstats)
 
-        return self._run(cmd)
-
-    def group_extract(self, analysis, subjects=None):
+        inputs = [self.atlas, self.analysis.source] + self._mask_files()
+        return self._run(cmd, inputs, self._extract_files())
+
+    def _stat_files(self, hemi=None):
+        """Return a dict mapping each extra statistic to its output file."""
+        statfiles = {}
+        for stat in self.analysis.stats:
+            statfiles[stat] = self._stat_file(stat)
+            if hemi is not None:
+                statfiles[stat] = statfiles[stat] % hemi
+        return statfiles
+
+    def _native_seg(self):
+        """Return the label image(s) and region ids for native extraction."""
+        return self.atlas, sorted(self.regions)
+
+    def _index_dir(self):
+        """Return the directory to keep region indexes in, or None."""
+        if self.space == "standard":
+            # The label image is the same for every subject, so keep its
+            # region index around
+            return os.path.join(self.roidir, "atlases", "index")
+        return None
+
+    def _segbase(self, hemi):
+        """Return the number added to annotation structure ids for a hemi."""
+        if self.fname[:-6] == "aparc":
+            return dict(lh=1000, rh=2000)[hemi]
+        return 0
+
+    def _native_index(self, hemi=None):
+        """Return the RegionIndex of the atlas (for one hemi of a surface)."""
+        if self.manifold == "volume":
+            seg, ids = self._native_seg()
+            return extraction.region_index(seg, ids, self._index_dir())
+        annot = self._annot_file(hemi, self.fname[:-6])
+        return extraction.annot_index(annot, sorted(self.regions[hemi]),
+                                      self._segbase(hemi))
+
+    def _native_vol_extract(self, cache=None):
+        """Extract from a volume in process instead of with mri_segstats."""
+        seg, ids = self._native_seg()
+        if isinstance(seg, str):
+            desc = "native segstats --seg %s" % seg
+        else:
+            desc = "native segstats --weights %s" % " ".join(seg)
+        desc = "%s --i %s" % (desc, self.analysis.source)
+        maskargs = {}
+        if self.mask:
+            maskargs = dict(mask=self.analysis.maskimg,
+                            maskthresh=self.analysis.maskthresh,
+                            masksign=self.analysis.masksign)
+            desc = "%s --mask %s --maskthresh %s --masksign %s" % (
+                desc, self.analysis.maskimg, self.analysis.maskthresh, 
+                self.analysis.masksign)
+        desc = "%s --avgwf %s --avgwfvol %s --sum %s" % (
+            desc, self.functxt, self.funcvol, self.funcstats)
+        if self.analysis.stats:
+            desc = "%s --stats %s" % (desc, " ".join(self.analysis.stats))
+        if not self.debug:
+            extraction.extract(seg, self.analysis.source, ids,
+                               self.functxt, self.funcvol, self.funcstats, 
+                               cache=cache, indexdir=self._index_dir(),
+                               chunkframes=self._option("chunkframes"),
+                               statfiles=self._stat_files(), **maskargs)
+        return RoiResult(desc)
+
+    def _native_surf_extract(self, hemi, cache=None):
+        """Extract from a surface in process instead of with mri_segstats."""
+        annotname = self.fname[:-6]
+        annot = self._annot_file(hemi, annotname)
+        source = self.analysis.source % hemi
+        desc = "native segstats --annot %s %s %s --i %s" % (
+            self.subject, hemi, annotname, source)
+        maskargs = {}
+        if self.mask:
+            maskargs = dict(mask=self.analysis.maskimg % hemi,
+                            maskthresh=self.analysis.maskthresh,
+                            masksign=self.analysis.masksign)
+            desc = "%s --mask %s --maskthresh %s --masksign %s" % (
+                desc, self.analysis.maskimg % hemi, self.analysis.maskthresh,
+                self.analysis.masksign)
+        desc = "%s --avgwf %s --avgwfvol %s --sum %s" % (
+            desc, self.functxt % hemi, self.funcvol % hemi, self.funcstats % hemi)
+        if self.analysis.stats:
+            desc = "%s --stats %s" % (desc, " ".join(self.analysis.stats))
+        if not self.debug:
+            white = self._annot_inputs(hemi, annotname)[1]
+            extraction.extract_surface(annot, white, source, sorted(self.regions[hemi]),
+                                       self.functxt % hemi, self.funcvol % hemi,
+                                       self.funcstats % hemi, self._segbase(hemi), 
+                                       cache=cache,
+                                       chunkframes=self._option("chunkframes"),
+                                       statfiles=self._stat_files(hemi),
+                                       **maskargs)
+        return RoiResult(desc)
+
+    def group_extract(self, analysis, subjects=None, n_jobs=1):
         """Extract functional data for a group of subjects.
         
         See the docstring for the extract() method for more information.
@@ -895,6 +1202,9 @@ class Atlas(RoiBase):
             List of subjects to preprocess. If a string, it runs the
             group defined by that name in the config file. Will run
             the config setup module.
+        n_jobs : int, optional
+            Number of subjects to process at once in separate processes.
+            -1 uses all available cores.  Defaults to 1 (serial).
            
         Returns
         -------
@@ -908,22 +1218,291 @@ class Atlas(RoiBase):
         if isinstance(analysis, dict) or isinstance(analysis, int):
             analysis = source.Analysis(analysis)
         result = RoiResult()
-        for subj in subjects:
-            self.init_paradigm(analysis.paradigm)
-            self.init_subject(subj)
-            self.init_analysis(analysis)
-            res = self.extract()
+        self.init_paradigm(analysis.paradigm)
+        for res in parallel.map_subjects(self, subjects, "_journaled",
+                                         ("extract", analysis.name, analysis),
+                                         n_jobs=n_jobs):
             print res
             result(res)
         if not self.debug:
-            res=build_database(self.atlasname, self.analysis.dict, subjects)
+            res=build_database(self.atlasname, analysis.dict, subjects)
+            print res
+            result(res)
+        return result
+
+    def mask_sweep(self, thresholds, signs=None, maskcons=None, analysis=None):
+        """Extract under many mask thresholds, signs, and contrasts at once.
+
+        The source image and each mask image are read once, and the
+        averages for every threshold and sign come from cumulative sums
+        over the voxels of each region sorted by mask value (see
+        extraction.mask_sweep()).  This replaces defining an analysis
+        for each mask setting in a sensitivity analysis.  The results
+        are written as a table to the sweep directory next to the
+        extraction files.
+
+        Parameters
+        ----------
+        thresholds : list of floats
+            Mask thresholds (in -log10(p)).
+        signs : list, optional
+            Mask signs ("abs", "pos", "neg"); defaults to the analysis's.
+        maskcons : list, optional
+            Contrasts of the mask paradigm to make masks from; defaults
+            to the analysis's.  Their sig images (and surface samples)
+            are made from the t images first if they are out of date.
+        analysis : int, dict, or Analysis object, optional
+            Analysis to extract from.  It must have a mask.
+
+        Returns
+        -------
+        RoiResult object
+
+        """
+        self._check_extract(analysis)
+        if not self.mask:
+            raise SetupError("Analysis %s has no mask to sweep" % self.analysis.name)
+        if signs is None:
+            signs = [self.analysis.masksign]
+        if maskcons is None:
+            maskcons = [self.analysis.maskcon]
+        masks = {}
+        graph = parallel.TaskGraph()
+        for con in maskcons:
+            conanalysis = copy(self.analysis)
+            conanalysis.maskcon = con
+            for task in self._mask_tasks(conanalysis):
+                graph.add(task)
+            sig = source.SigImage(conanalysis, **self._runopts())
+            sig.init_subject(self.subject)
+            if self.manifold == "surface":
+                masks[con] = sig.sigsurf
+            else:
+                masks[con] = sig.sigvol
+        sweepfile = os.path.join(self.analysis.dir, "sweep", "%s.txt" % self.subject)
+        if self.manifold == "surface":
+            hemis = self.iterhemi
+        else:
+            hemis = [None]
+
+        # Make the sig images of the mask contrasts that are missing or
+        # out of date, as prepare_source_images() does for the analysis's
+        # own mask contrast
+        jrnl = None
+        if self._option("journal") and not self.debug:
+            jrnl = journal.project_journal(self.subject, self.analysis.name,
+                                           self.atlasname)
+        result = graph.update(1, False, self._option("depcheck"), jrnl, self.debug)
+        if result.failed:
+            return result
+        if not self.debug:
+            for con in maskcons:
+                for hemi in hemis:
+                    maskfile = masks[con]
+                    if hemi is not None:
+                        maskfile = maskfile % hemi
+                    if not os.path.isfile(maskfile):
+                        raise SetupError("Mask image %s for contrast %s was not made"
+                                         % (maskfile, con))
+        for hemi in hemis:
+            if hemi is None:
+                sourcefile, outfile = self.analysis.source, sweepfile
+                maskfiles = [masks[con] for con in maskcons]
+            else:
+                sourcefile, outfile = self.analysis.source % hemi, sweepfile % hemi
+                maskfiles = [masks[con] % hemi for con in maskcons]
+            result("native masksweep --i %s --mask %s --thresh %s --sign %s --o %s" % (
+                sourcefile, " ".join(maskfiles), " ".join([str(t) for t in thresholds]),
+                " ".join(signs), outfile))
+            if self.debug:
+                continue
+            index = self._native_index(hemi)
+            data = extraction.load_data(sourcefile)[0]
+            sweeps = {}
+            for con, maskfile in zip(maskcons, maskfiles):
+                maskdata = extraction.load_data(maskfile)[0]
+                sweeps[con] = extraction.mask_sweep(index, data, maskdata,
+                                                    thresholds, signs)
+            if not os.path.isdir(os.path.dirname(outfile)):
+                os.makedirs(os.path.dirname(outfile))
+            extraction.write_sweep(outfile, index.ids,
+                                   [self.lutdict[id] for id in index.ids], sweeps)
+        return result
+
+    def group_mask_sweep(self, analysis, thresholds, signs=None, maskcons=None,
+                         subjects=None, n_jobs=1):
+        """Run mask_sweep() for a group of subjects.
+
+        Parameters
+        ----------
+        analysis : Analysis object or dict
+        thresholds, signs, maskcons :
+            See mask_sweep().
+        subjects : list, or str, optional
+            List of subjects, or the name of a group in the config file.
+        n_jobs : int, optional
+            Number of subjects to process at once.  Defaults to 1.
+
+        Returns
+        -------
+        RoiResult object
+
+        """
+        if subjects is None:
+            subjects = cfg.subjects()
+        elif isinstance(subjects, str):
+            subjects = cfg.subjects(subjects)
+        if isinstance(analysis, dict) or isinstance(analysis, int):
+            analysis = source.Analysis(analysis)
+        result = RoiResult()
+        self.init_paradigm(analysis.paradigm)
+        for res in parallel.map_subjects(self, subjects, "mask_sweep",
+                                         (thresholds, signs, maskcons, analysis),
+                                         n_jobs=n_jobs):
             print res
             result(res)
         return result
 
-    def process(self, subject, analysis, force=False):
+    def group_cube(self, analysis, subjects=None, chunksubjects=8, database=True):
+        """Extract a group into one subjects x regions x frames array.
+
+        For standard-space atlases every subject's source image is in the
+        same space as the atlas, so the sources of several subjects can be
+        stacked and reduced over the regions at once (see
+        extraction.group_cube()).  The database is then written from the
+        array instead of from per-subject extraction files, which are not
+        written.  Any extra region statistics of the analysis (its stats
+        setting) are computed along the way and get their database columns.
+
+        Parameters
+        ----------
+        analysis : Analysis object or dict
+        subjects : list, or str, optional
+            List of subjects, or the name of a group in the config file.
+        chunksubjects : int, optional
+            Number of subjects to hold in memory at once.  Defaults to 8.
+        database : bool, optional
+            Write the database for the atlas and analysis.  True by default.
+
+        Returns
+        -------
+        subjects x regions x frames array (None when debugging)
+
+        """
+        if self.space != "standard":
+            raise SetupError("Group cubes need a standard-space atlas; %s is "
+                             "in native space" % self.atlasname)
+        if subjects is None:
+            subjects = cfg.subjects()
+        elif isinstance(subjects, str):
+            subjects = cfg.subjects(subjects)
+        if isinstance(analysis, dict) or isinstance(analysis, int):
+            analysis = source.Analysis(analysis)
+        self.init_paradigm(analysis.paradigm)
+        sources = []
+        masks = []
+        for subject in subjects:
+            self.init_subject(subject)
+            self._check_extract(analysis)
+            sources.append(self.analysis.source)
+            if self.mask:
+                masks.append(self.analysis.maskimg)
+        print RoiResult("native groupcube --i %s%s" % (
+            " ".join(sources), "".join([" --mask %s" % m for m in masks])))
+        if self.debug:
+            return None
+        index = self._native_index()
+        maskargs = {}
+        if self.mask:
+            maskargs = dict(masks=masks, maskthresh=analysis.maskthresh,
+                            masksign=analysis.masksign)
+        cube, counts, extra = extraction.group_cube(index, sources,
+                                                    chunksubjects=chunksubjects,
+                                                    extra=analysis.stats,
+                                                    **maskargs)
+        if database:
+            print cube_database(self, analysis.dict, subjects, index.ids, cube,
+                                index.counts(), counts, extra)
+        return cube
+
+    def export_patterns(self, analysis, subjects=None):
+        """Write the voxel (or vertex) patterns of every region for a group.
+
+        Rather than region averages, this writes each region's source
+        values at every voxel, for multivariate pattern analyses.  The
+        patterns of all subjects and regions go in one patterns.npy file
+        in the analysis directory for the atlas, with a patterns.index.txt
+        table of where each region's rows are; see
+        extraction.read_patterns() to slice them out of a memory map.
+
+        Parameters
+        ----------
+        analysis : Analysis object or dict
+        subjects : list, or str, optional
+            List of subjects, or the name of a group in the config file.
+
+        Returns
+        -------
+        RoiResult object
+
+        """
+        if subjects is None:
+            subjects = cfg.subjects()
+        elif isinstance(subjects, str):
+            subjects = cfg.subjects(subjects)
+        if isinstance(analysis, dict) or isinstance(analysis, int):
+            analysis = source.Analysis(analysis)
+        self.init_paradigm(analysis.paradigm)
+        patternfile = os.path.join(self.roidir, "analysis", cfg.projectname(),
+                                   core.get_analysis_name(analysis.dict),
+                                   self.atlasname, "patterns.npy")
+        if self.manifold == "surface":
+            hemis = self.iterhemi
+        else:
+            hemis = [None]
+        entries = []
+        for subject in subjects:
+            self.init_subject(subject)
+            self._check_extract(analysis)
+            for hemi in hemis:
+                sourcefile = self.analysis.source
+                maskfile = None
+                if self.mask:
+                    maskfile = self.analysis.maskimg
+                if hemi is not None:
+                    sourcefile = sourcefile % hemi
+                    if maskfile is not None:
+                        maskfile = maskfile % hemi
+                index = None
+                if not self.debug:
+                    index = self._native_index(hemi)
+                entries.append((subject, hemi or "", index, sourcefile, maskfile))
+        result = RoiResult("native patterns --i %s --o %s" % (
+            " ".join([entry[3] for entry in entries]), patternfile))
+        if not self.debug:
+            if not os.path.isdir(os.path.dirname(patternfile)):
+                os.makedirs(os.path.dirname(patternfile))
+            maskargs = {}
+            if self.mask:
+                maskargs = dict(maskthresh=analysis.maskthresh,
+                                masksign=analysis.masksign)
+            extraction.export_patterns(patternfile, entries, **maskargs)
+        return result
+
+    def process(self, subject, analysis, force=False, n_jobs=1, 
+                shared_atlas=True):
         """Process a subject up through extraction.
         
+        The atlas, registration, source image, and mask image steps are 
+        run as a graph of tasks, so independent steps can run at once.
+        Steps whose output files are newer than (or, with the "digest" 
+        `depcheck` setting, were made from the same contents as) the files
+        they read are skipped, along with the steps that only depend on 
+        them, so changing one beta image or registration reruns just the
+        steps downstream of it.  Steps that the project journal shows were
+        started but never finished (see the journal module) are always run
+        again, so a crashed group run resumes where it stopped.
+        
         Parameters
         ----------
         subject : str
@@ -931,8 +1510,16 @@ class Atlas(RoiBase):
         analysis : int
             Analysis index
         force : bool, optional
-            Force overwriting of the files the processing methods create 
-            if they are found to exist.  False by default.
+            Run every step even if its outputs are up to date.  False by 
+            default.
+        n_jobs : int, optional
+            Number of independent processing steps to run at once.
+            Defaults to 1.
+        shared_atlas : bool, optional
+            If False, leave out making a standard-space atlas, which is 
+            one image for every subject.  group_process() makes it once 
+            with the first subject and then runs the rest this way.  True
+            by default.
 
         Returns
         -------
@@ -943,17 +1530,70 @@ class Atlas(RoiBase):
             analysis = source.Analysis(analysis)
         self.init_paradigm(analysis.paradigm)
         self.init_subject(subject)
-        result = RoiResult()
-        if force or not self._atlas_exists():
-            result(self.make_atlas())
-        self.init_analysis(analysis)
-        if force or not self._source_exists():
-            result(self.prepare_source_images())
-        if force or not self._extract_exists():
-            result(self.extract())
-        return result
+        graph = parallel.TaskGraph(self._process_tasks(analysis, shared_atlas))
+        jrnl = None
+        if self._option("journal") and not self.debug:
+            jrnl = journal.project_journal(self.subject, self.analysis.name,
+                                           self.atlasname)
+        return graph.update(n_jobs, force, self._option("depcheck"), jrnl, 
+                            self.debug)
+
+    def _journaled(self, method, analysisname, *args, **kwargs):
+        """Call a processing method as a stage in the project journal.
+
+        group_make_atlas() and group_extract() run each subject through
+        this, so the journal shows which subjects' stages failed or were
+        cut short and process() runs them again.  Stages are named as in 
+        _process_tasks(), e.g. "extract:<atlas>:<analysis>:<subject>".
+
+        """
+        if not self._option("journal") or self.debug:
+            return getattr(self, method)(*args, **kwargs)
+        if method == "make_atlas":
+            stage = "make_atlas:%s:%s:%s" % (self.atlasname, self.paradigm,
+                                             self.subject)
+        else:
+            stage = "%s:%s:%s:%s" % (method, self.atlasname, analysisname,
+                                     self.subject)
+        jrnl = journal.project_journal(self.subject, analysisname, self.atlasname)
+        jrnl.start(stage)
+        started = time.time()
+        ok = False
+        try:
+            res = getattr(self, method)(*args, **kwargs)
+            ok = res is None or not getattr(res, "failed", None)
+            return res
+        finally:
+            jrnl.finish(stage, ok, time.time() - started)
+
+    def _process_tasks(self, analysis, shared_atlas=True):
+        """Return the list of tasks that process a subject through extraction.
+
+        The atlas has to be initialized with the subject.  This initializes
+        the analysis.  Every stage is returned; process() drops the ones
+        whose outputs are up to date.  With shared_atlas False, a standard
+        space atlas is not made.
 
-    def group_process(self, analysis, subjects=None, force=False):
+        """
+        tasks = []
+        if shared_atlas or self.space != "standard":
+            tasks.append(parallel.Task(
+                "make_atlas:%s:%s:%s" % (self.atlasname, self.paradigm, 
+                                         self.subject),
+                self.make_atlas, inputs=self._atlas_inputs(),
+                outputs=self._atlas_files()))
+        self.init_analysis(analysis)
+        tasks.extend(self._source_tasks())
+        tasks.append(parallel.Task(
+            "extract:%s:%s:%s" % (self.atlasname, self.analysis.name, self.subject),
+            self.extract,
+            inputs=(self._atlas_files() + self._source_files() 
+                    + self._mask_files()),
+            outputs=self._extract_files()))
+        return tasks
+
+    def group_process(self, analysis, subjects=None, force=False, n_jobs=1,
+                      stage_jobs=1):
         """Process a group up through extraction.
         
         Parameters
@@ -965,8 +1605,18 @@ class Atlas(RoiBase):
             string, runs the group defined by that name.  If a list, runs
             the each subject defined in that list.  None by default.
         force : bool, optional
-            Force overwriting of the files the processing methods create 
-            if they are found to exist.  False by default.
+            Run every step even if its outputs are up to date.  False by 
+            default.
+        n_jobs : int, optional
+            Number of subjects to process at once in separate processes.
+            -1 uses all available cores.  Defaults to 1 (serial).  For
+            SigSurf and standard-space atlases the first subject runs on
+            its own so the cluster summary or the atlas image exists 
+            before the rest start, and the rest do not make the 
+            standard-space atlas again.
+        stage_jobs : int, optional
+            Number of independent steps to run at once for each subject.
+            See the process() docstring.  Defaults to 1.
 
         Returns
         -------
@@ -980,12 +1630,21 @@ class Atlas(RoiBase):
         if isinstance(analysis, dict) or isinstance(analysis, int):
             analysis = source.Analysis(analysis)
         result = RoiResult()
-        for subj in subjects:
-            res = self.process(subj, analysis, force)
+        calls = [(self, "process", (subj, analysis, force, stage_jobs), {}) 
+                 for subj in subjects]
+        if (self.source == "sigsurf" or self.space == "standard") and calls:
+            # The cluster summary or the standard-space atlas is shared by
+            # every subject, so only the first one writes it
+            res = self.process(*calls[0][2])
+            print res
+            result(res)
+            calls = [(obj, method, args + (False,), kwargs)
+                     for obj, method, args, kwargs in calls[1:]]
+        for res in parallel.map_calls(calls, n_jobs):
             print res
             result(res)
         if not self.debug:
-            res=build_database(self.atlasname, self.analysis.dict, subjects)
+            res=build_database(self.atlasname, analysis.dict, subjects)
             print res
             result(res)
         return result
@@ -1165,6 +1824,12 @@ class FreesurferAtlas(Atlas):
 
             self._init_subject = True
 
+    def _atlas_inputs(self):
+        """Return a list of the files the atlas image is made from."""
+        if self.manifold == "volume":
+            return [self.origatlas, self.regmat]
+        return self._hemi_files(self.origatlas)
+
     def make_atlas(self, reg=1):
         """Run the neccessary preprocessing steps to make a create the atlas image.
         
@@ -1210,10 +1875,10 @@ class FreesurferAtlas(Atlas):
         result = RoiResult()
         if self.manifold == "volume":
             if reg==2 or (reg==1 and not os.path.isfile(self.regmat)):
-                reg = FSRegister(debug=self.debug)
-                reg.init_paradigm(self.paradigm)
-                reg.init_subject(self.subject)
-                result(reg.register())
+                registration = FSRegister(**self._runopts())
+                registration.init_paradigm(self.paradigm)
+                registration.init_subject(self.subject)
+                result(registration.register(force=reg==2))
             result(self._resample())
         else:
             result(self._copy_atlas())
@@ -1224,7 +1889,7 @@ class FreesurferAtlas(Atlas):
                 result(self._write_mask())
         return result
 
-    def group_make_atlas(self, subjects=None, reg=1):
+    def group_make_atlas(self, subjects=None, reg=1, n_jobs=1):
         """Run atlas preprocessing steps for a list of subjects.
         
         Parameters
@@ -1238,6 +1903,9 @@ class FreesurferAtlas(Atlas):
             0 : do not create registration matrices
             1 : create registration matrices if they do not exist -- default
             2 : create or overwrite registration matricies
+        n_jobs : int, optional
+            Number of subjects to process at once in separate processes.
+            -1 uses all available cores.  Defaults to 1 (serial).
         
         Returns
         -------
@@ -1249,9 +1917,8 @@ class FreesurferAtlas(Atlas):
         elif isinstance(subjects, str):
             subjects = cfg.subjects(subjects)
         result = RoiResult()
-        for i, subject in enumerate(subjects):
-            self.init_subject(subject)
-            res = self.make_atlas(reg)
+        for res in parallel.map_subjects(self, subjects, "_journaled",
+                                         ("make_atlas", "", reg), n_jobs=n_jobs):
             print res
             result(res)
         return result
@@ -1265,6 +1932,13 @@ class FSRegister(FreesurferAtlas):
     internally find a linear transform matrix with either FSL FLIRT, the SPM
     coregister routine, or from header geometry.  It uses FLIRT by default.
 
+    Each registration is done under a file lock and recorded in a registry
+    file next to the registration matrix along with a digest of the mean
+    functional image it was made from.  When several processes ask for the
+    same registration at once, one runs bbregister and the others wait for 
+    it and then use its result, and a registration is not redone until the
+    mean functional image or the subject's anatomy changes.
+
     Examples
     --------
     >>> reg = roi.FSRegister("par_name", "subj_id")
@@ -1291,8 +1965,41 @@ class FSRegister(FreesurferAtlas):
         if paradigm is not None: self.init_paradigm(paradigm)
         if subject is not None: self.init_subject(subject)
 
+    def _anat_files(self):
+        """Return the subject's Freesurfer files that bbregister reads."""
+        subjdir = os.path.join(self.subjdir, self.subject)
+        files = [os.path.join(subjdir, "mri", "orig.mgz")]
+        for hemi in ["lh", "rh"]:
+            files.extend([os.path.join(subjdir, "surf", "%s.%s" % (hemi, surf))
+                          for surf in ["white", "thickness"]])
+        return files
+
+    def _registry_file(self):
+        """Return the file that records how the registration was made."""
+        path, fname = os.path.split(self._regtreepath)
+        return os.path.join(path, ".%s.registry" % fname)
+
+    def _registry_key(self):
+        """Return the registry key for the current paradigm and subject."""
+        digests = []
+        for fname in [self.meanfuncimg] + self._anat_files():
+            if os.path.isfile(fname):
+                digests.append(cache.file_digest(fname))
+            else:
+                digests.append("missing")
+        return "%s %s %s" % (self.paradigm, self.subject, " ".join(digests))
+
+    def _registered(self, key):
+        """Return whether the registration in the tree was made for this key."""
+        if not os.path.isfile(self._regtreepath):
+            return False
+        try:
+            return open(self._registry_file()).read().strip() == key
+        except IOError:
+            return False
+
     # Processing methods
-    def register(self, method="fsl"):
+    def register(self, method="fsl", force=False):
         """Register functional space to Freesurfer original atlas space.
         
         Parameters
@@ -1300,6 +2007,9 @@ class FSRegister(FreesurferAtlas):
         method : str, optional
             Specifiy the initial registration method.  Options are 'fsl',
             'spm', or 'header'.  Defaults to 'fsl'.
+        force : bool, optional
+            Run bbregister even if the registry shows the registration was 
+            already made from the current mean functional image.
 
         Returns
         -------
@@ -1314,9 +2024,31 @@ class FSRegister(FreesurferAtlas):
         cmd.append("--reg %s"%self._regtreepath)
         cmd.append("--init-%s"%method)
 
-        return self._run(cmd)
+        if self.debug:
+            return self._run(cmd)
+
+        key = self._registry_key()
+        lock = locks.FileLock("%s.lock" % self._regtreepath)
+        lock.acquire()
+        try:
+            if not force and self._registered(key):
+                return RoiResult("Registration for %s %s found at %s" 
+                                 % (self.subject, self.paradigm, self._regtreepath))
+            result = self._run(cmd, [self.meanfuncimg] + self._anat_files(),
+                               [self._regtreepath])
+            if result.failed:
+                # A matrix left by a failed run must not count as current
+                if os.path.isfile(self._registry_file()):
+                    os.remove(self._registry_file())
+            elif os.path.isfile(self._regtreepath):
+                fid = open(self._registry_file(), "w")
+                fid.write(key)
+                fid.close()
+            return result
+        finally:
+            lock.release()
 
-    def group_register(self, subjects=None, method="fsl"):
+    def group_register(self, subjects=None, method="fsl", force=False, n_jobs=1):
         """Register functional space to Freesurfer original atlas space for a group.
         
         Parameters
@@ -1328,6 +2060,11 @@ class FSRegister(FreesurferAtlas):
         method : str, optional
             Specifiy the initial registration method.  Options are 'fsl',
             'spm', or 'header'.  Defaults to 'fsl'.
+        force : bool, optional
+            Rerun registrations that are already up to date.
+        n_jobs : int, optional
+            Number of subjects to register at once in separate processes.
+            -1 uses all available cores.  Defaults to 1 (serial).
 
         Returns
         -------
@@ -1339,9 +2076,8 @@ class FSRegister(FreesurferAtlas):
         elif isinstance(subjects, str):
             subjects = cfg.subjects(subjects)
         result = RoiResult()
-        for subj in subjects:
-            self.init_subject(subjects)
-            res = self.register(method)
+        for res in parallel.map_subjects(self, subjects, "register",
+                                         (method, force), n_jobs=n_jobs):
             result(res)
 
         return result
@@ -1516,6 +2252,10 @@ class SigSurfAtlas(Atlas):
         
         self._init_subject = True
 
+    def _atlas_inputs(self):
+        """Return a list of the files the atlas image is made from."""
+        return [self.sourcefile]
+
     def make_atlas(self, gen_new_atlas=False):
         """Turn a second level sig image into an atlas image.
 
@@ -1545,7 +2285,7 @@ class SigSurfAtlas(Atlas):
             result(self._stats())
         return result
 
-    def group_make_atlas(self, subjects=None, gen_new_atlas=False):
+    def group_make_atlas(self, subjects=None, gen_new_atlas=False, n_jobs=1):
         """Run atlas preprocessing steps for a list of subjects.
         
         Prerequisite
@@ -1564,6 +2304,10 @@ class SigSurfAtlas(Atlas):
             for clusters once.  By default, if the surfcluster summary file
             is found, this method will skip that step.  To force  a new
             cluster summary table to be made, set to true.  
+        n_jobs : int, optional
+            Number of subjects to process at once in separate processes.
+            The first subject always runs on its own so the cluster summary
+            exists before the rest start.  Defaults to 1 (serial).
         
         Returns
         -------
@@ -1575,13 +2319,15 @@ class SigSurfAtlas(Atlas):
         elif isinstance(subjects, str):
             subjects = cfg.subjects(subjects)
         result = RoiResult()
-        for i, subject in enumerate(subjects):
-            self.init_subject(subject)
-            if not i:
-                gen_new_atlas = gen_new_atlas
-            else:
-                gen_new_atlas = False
-            res = self.make_atlas(gen_new_atlas=gen_new_atlas)
+        if not subjects:
+            return result
+        self.init_subject(subjects[0])
+        res = self._journaled("make_atlas", "", gen_new_atlas=gen_new_atlas)
+        print res
+        result(res)
+        for res in parallel.map_subjects(self, subjects[1:], "_journaled",
+                                         ("make_atlas", ""),
+                                         dict(gen_new_atlas=False), n_jobs):
             print res
             result(res)
         return result
@@ -1699,7 +2445,7 @@ class LabelAtlas(Atlas):
             result(self._stats())
         return result
 
-    def group_make_atlas(self, subjects=None):
+    def group_make_atlas(self, subjects=None, n_jobs=1):
         """Run atlas preprocessing steps for a list of subjects.
         
         Parameters
@@ -1708,6 +2454,9 @@ class LabelAtlas(Atlas):
             List of subjects to preprocess. If a string, it runs the
             group defined by that name in the config file. Will run
             the full subject list from config if ommitted.
+        n_jobs : int, optional
+            Number of subjects to process at once in separate processes.
+            -1 uses all available cores.  Defaults to 1 (serial).
         
         Returns
         -------
@@ -1719,9 +2468,8 @@ class LabelAtlas(Atlas):
         elif isinstance(subjects, str):
             subjects = cfg.subjects(subjects)
         result = RoiResult()
-        for i, subject in enumerate(subjects):
-            self.init_subject(subject)
-            res = self.make_atlas()
+        for res in parallel.map_subjects(self, subjects, "_journaled",
+                                         ("make_atlas", ""), n_jobs=n_jobs):
             print res
             result(res)
         return result
@@ -1752,6 +2500,13 @@ class MaskAtlas(Atlas):
     The MaskAtlas class can construct and extract from an atlas 
     defined by any number of non-overlapping binary mask images
     in standard volume space.  
+
+    With "weighted": True in the atlas dictionary, the images are 
+    instead taken as weights (e.g. probability maps or soft masks),
+    which may overlap, and each region is a weighted average over 
+    the voxels with nonzero weight.  Weighted atlases are always
+    extracted with the native engine, and the atlas image written
+    by make_atlas() labels each voxel with its highest-weight region.
     
     Note
     ----
@@ -1791,6 +2546,7 @@ class MaskAtlas(Atlas):
         self.all_regions = self.regions
         self.regionnames = [self.lutdict[id] for id in self.regions]
         self.regionnames.sort()                                
+        self.weighted = atlasdict["weighted"]
         
         self.atlas = os.path.join(self.basedir, self.fname)
 
@@ -1806,6 +2562,8 @@ class MaskAtlas(Atlas):
 
     def make_atlas(self):
         """Make the single atlas image and look-up-table from a group of masks."""
+        if self.weighted:
+            return self._make_weighted_atlas()
         self.tempdir = mkdtemp()
         self.tempvols = []
         result = RoiResult(self._write_lut())
@@ -1820,6 +2578,28 @@ class MaskAtlas(Atlas):
             result(self._stats())
         return result
 
+    def _make_weighted_atlas(self):
+        """Write the look-up-table and the highest-weight label image."""
+        result = RoiResult(self._write_lut())
+        ids = range(1, len(self.sourcefiles) + 1)
+        if not self.debug:
+            extraction.write_max_labels(self.sourcefiles, ids, self.atlas)
+        result("native maxlabels --i %s --o %s" % (" ".join(self.sourcefiles),
+                                                  self.atlas))
+        if self._atlas_exists():
+            result(self._stats())
+        return result
+
+    def _native_seg(self):
+        """Use the weight images themselves for a weighted atlas."""
+        if self.weighted:
+            return self.sourcefiles, range(1, len(self.sourcefiles) + 1)
+        return Atlas._native_seg(self)
+
+    def _use_native(self):
+        """Extract natively for weighted atlases, which mri_segstats can't do."""
+        return self.weighted or Atlas._use_native(self)
+
 
 class SphereAtlas(Atlas):
     """Not yet implemented."""
@@ -1907,3 +2687,43 @@ def init_atlas(atlas, *args, **kwargs):
                   sphere     = SphereAtlas)
     source = atlas["source"]                  
     return switch[source](atlas, subject=sub, paradigm=par, **kwargs)
+
+def extract_atlases(atlases, analysis=None):
+    """Extract one analysis for several atlases, reading each source once.
+
+    Calling extract() on each atlas reads the source image (and the mask)
+    again for every atlas.  This instead extracts every atlas with the
+    native engine against images held in memory, so each file is read
+    once however many atlases use it.  Atlases in the same space share
+    a source image; e.g. every standard-space atlas reads the same
+    normalized betas.  An image is dropped once the last atlas that uses
+    it is extracted, so atlases that share images should be listed next
+    to each other to keep fewer of them in memory at once.
+
+    Parameters
+    ----------
+    atlases : list of Atlas objects
+        Atlases initialized for the same subject (and paradigm).
+    analysis : int, dict, or Analysis object, optional
+        Analysis to extract from; each atlas runs init_analysis() with a
+        copy of it.  If not given, the atlases must already be initialized
+        with one.
+
+    Returns
+    -------
+    RoiResult object
+
+    """
+    result = RoiResult()
+    lastuse = {}
+    for i, atlas in enumerate(atlases):
+        atlas._check_extract(copy(analysis))
+        for fname in atlas._source_files() + atlas._mask_files():
+            lastuse[fname] = i
+    images = {}
+    for i, atlas in enumerate(atlases):
+        result(atlas._native_extract(images))
+        for fname, last in lastuse.items():
+            if last == i:
+                images.pop(fname, None)
+    return result
@@ -0,0 +1,179 @@
+"""
+Content-addressed cache for the output of external programs.
+
+Most of the processing in PyROI is done by Freesurfer programs that read
+a few images and write a few more.  When a program is run with the same
+command line on input files with the same contents, it will write the
+same outputs, so those outputs can be copied back from a cache instead
+of running the program again.
+
+Cache entries are keyed on the command line and a SHA-1 digest of the
+contents of each declared input file.  Commands that do not declare
+their inputs and outputs are never cached.  Caching is turned on with
+the ``cachedir`` config setting (or a ``cachedir`` keyword argument to
+an atlas or source object).
+
+Classes
+-------
+CommandCache :  Stores and restores the outputs of command lines
+
+Functions
+---------
+file_digest  :  Return the SHA-1 digest of a file's contents
+
+"""
+import os
+import shutil
+from hashlib import sha1
+from tempfile import mkdtemp
+
+__all__ = ["CommandCache", "file_digest"]
+
+__module__ = "cache"
+
+# Digests are remembered as long as a file's size and mtime do not change
+_digests = {}
+
+def file_digest(fname):
+    """Return the SHA-1 hex digest of a file's contents.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the file.
+
+    Returns
+    -------
+    str
+
+    """
+    fstat = os.stat(fname)
+    stamp = (os.path.abspath(fname), fstat.st_size, fstat.st_mtime)
+    if stamp in _digests:
+        return _digests[stamp]
+    digest = sha1()
+    fid = open(fname, "rb")
+    try:
+        while True:
+            block = fid.read(1 << 20)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        fid.close()
+    _digests[stamp] = digest.hexdigest()
+    return _digests[stamp]
+
+class CommandCache(object):
+    """Cache of the output files written by command lines.
+
+    Each entry is a directory named by the key, holding a copy of each
+    output file along with the stdout and stderr of the original run.
+    Entries are written to a temporary directory and renamed into place,
+    so several processes can share one cache directory.
+
+    """
+    def __init__(self, cachedir):
+        """
+        Parameters
+        ----------
+        cachedir : str
+            Directory to keep cache entries in; made if it does not exist.
+
+        """
+        self.cachedir = os.path.abspath(cachedir)
+        if not os.path.isdir(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                if not os.path.isdir(self.cachedir):
+                    raise
+
+    def key(self, cmdline, inputs, scratch=None):
+        """Return the cache key for a command line and its input files.
+
+        Parameters
+        ----------
+        cmdline : str
+            The command line.
+        inputs : list
+            Files the command reads.
+        scratch : str, optional
+            Temporary directory made for this run.  Its name is replaced
+            by a fixed one in the command line and input paths, so that
+            the key is the same from one run to the next.
+
+        Returns
+        -------
+        str, or None if any of the inputs do not exist
+
+        """
+        if scratch is not None:
+            scratch = os.path.join(os.path.abspath(scratch), "")
+            label = lambda path: path.replace(scratch, "<scratch>/")
+        else:
+            label = lambda path: path
+        digest = sha1(label(cmdline))
+        for fname in inputs:
+            if not os.path.isfile(fname):
+                return None
+            digest.update("\n%s %s" % (label(fname), file_digest(fname)))
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        """Return the directory for a cache entry."""
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def restore(self, key, outputs):
+        """Copy a cached entry's files to the output paths.
+
+        Returns
+        -------
+        (stdout, stderr) tuple from the cached run, or None if the key
+        is not in the cache
+
+        """
+        entry = self._entry(key)
+        cached = [os.path.join(entry, "output-%d" % i) for i in range(len(outputs))]
+        if not all([os.path.isfile(f) for f in cached]):
+            return None
+        for cachefile, output in zip(cached, outputs):
+            shutil.copyfile(cachefile, output)
+        return (open(os.path.join(entry, "stdout")).read(),
+                open(os.path.join(entry, "stderr")).read())
+
+    def store(self, key, outputs, stdout="", stderr=""):
+        """Add a command's output files to the cache.
+
+        Nothing is stored unless every output file exists.
+
+        Returns
+        -------
+        bool : whether an entry was stored
+
+        """
+        if not all([os.path.isfile(f) for f in outputs]):
+            return False
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return True
+        parent = os.path.split(entry)[0]
+        if not os.path.isdir(parent):
+            try:
+                os.mkdir(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        tempdir = mkdtemp(prefix=".tmp-", dir=parent)
+        for i, output in enumerate(outputs):
+            shutil.copyfile(output, os.path.join(tempdir, "output-%d" % i))
+        for name, text in [("stdout", stdout), ("stderr", stderr)]:
+            fid = open(os.path.join(tempdir, name), "w")
+            fid.write(text)
+            fid.close()
+        try:
+            os.rename(tempdir, entry)
+        except OSError:
+            # Someone else stored the same entry first
+            shutil.rmtree(tempdir)
+        return True
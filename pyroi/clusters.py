@@ -0,0 +1,284 @@
+"""
+Native clustering of significance maps on a surface mesh.
+
+SigSurf atlases are made by thresholding a significance map on the
+average surface and turning the contiguous blobs above threshold into
+regions.  mri_surfcluster does this from scratch on every run, reading
+the surface and annotation again for each threshold.  Here the mesh is
+loaded once and kept as a sparse vertex adjacency matrix, so clustering
+a map comes down to a threshold (FDR-corrected or not) and one call to
+scipy's connected_components, and many thresholds and minimum sizes can
+be tried in a few milliseconds each.
+
+The summary table and label files are written in the formats
+mri_surfcluster uses for its --sum and --olab options, so SigSurf atlases
+read them the same way.
+
+Classes
+-------
+SurfaceClusters :  Clusters a significance map on a surface mesh
+
+Functions
+---------
+mesh_adjacency  :  Return the vertex adjacency matrix of a mesh
+
+read_label      :  Return the vertices and values of a label file
+
+write_label     :  Write a label file
+
+fdr_threshold   :  Return the sig threshold that controls the FDR
+
+"""
+import os
+import threading
+
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from extraction import load_data, vertex_areas
+
+__all__ = ["SurfaceClusters", "mesh_adjacency", "read_label", "write_label",
+           "fdr_threshold"]
+
+__module__ = "clusters"
+
+def mesh_adjacency(faces, n_verts):
+    """Return the vertex adjacency matrix of a mesh.
+
+    Parameters
+    ----------
+    faces : n_faces x 3 int array
+    n_verts : int
+
+    Returns
+    -------
+    n_verts x n_verts symmetric scipy.sparse.csr_matrix of bools
+
+    """
+    rows = np.concatenate([faces[:, 0], faces[:, 1], faces[:, 2]])
+    cols = np.concatenate([faces[:, 1], faces[:, 2], faces[:, 0]])
+    adjacency = sparse.coo_matrix((np.ones(len(rows), bool), (rows, cols)),
+                                  shape=(n_verts, n_verts)).tocsr()
+    return (adjacency + adjacency.T).tocsr()
+
+def read_label(fname):
+    """Return the vertices and values of a label file.
+
+    Returns
+    -------
+    (vertices, values) tuple : int array and float array
+
+    """
+    lines = open(fname).readlines()
+    n_verts = int(lines[1])
+    rows = [line.split() for line in lines[2:2 + n_verts]]
+    return (np.array([int(row[0]) for row in rows], int),
+            np.array([float(row[4]) for row in rows], float))
+
+def write_label(fname, vertices, coords, values, subject):
+    """Write a label file.
+
+    Parameters
+    ----------
+    fname : str
+    vertices : int array
+    coords : n_vertices x 3 array
+        Surface coordinates of the label vertices.
+    values : array
+        Value of each vertex.
+    subject : str
+        Subject the label is on.
+
+    """
+    fid = open(fname, "w")
+    fid.write("#!ascii label, from subject %s vox2ras=TkReg\n" % subject)
+    fid.write("%d\n" % len(vertices))
+    for vert, (x, y, z), value in zip(vertices, coords, values):
+        fid.write("%d  %.3f  %.3f  %.3f %.7f\n" % (vert, x, y, z, value))
+    fid.close()
+
+def _signed(sig, sign):
+    """Return the values of a sig map compared against a threshold."""
+    if sign == "abs":
+        return np.abs(sig)
+    elif sign == "pos":
+        return sig
+    elif sign == "neg":
+        return -sig
+    raise ValueError("Threshold sign must be 'abs', 'pos', or 'neg', not '%s'"
+                     % sign)
+
+def fdr_threshold(sig, q, sign="abs"):
+    """Return the sig threshold that controls the FDR.
+
+    Uses the Benjamini-Hochberg procedure on the p values of a -log10(p)
+    significance map, as mri_surfcluster --fdr does.
+
+    Parameters
+    ----------
+    sig : array
+        Significance values (-log10(p), signed by the effect).
+    q : float
+        False discovery rate.
+    sign : "abs", "pos", or "neg", optional
+        Only values of this sign count as discoveries.
+
+    Returns
+    -------
+    float : the threshold, or inf if no vertex survives
+
+    """
+    values = _signed(np.asarray(sig, float), sign)
+    pvals = np.sort(10 ** -np.maximum(values, 0))
+    passed = np.nonzero(pvals <= q * np.arange(1, len(pvals) + 1) / len(pvals))[0]
+    if not len(passed):
+        return np.inf
+    return -np.log10(pvals[passed[-1]])
+
+# Meshes already loaded, by white surface file
+_meshes = {}
+_meshes_lock = threading.Lock()
+
+def _load_mesh(white):
+    """Return the coordinates, adjacency, and vertex areas of a surface."""
+    _meshes_lock.acquire()
+    try:
+        if white not in _meshes:
+            coords, faces = nib.freesurfer.read_geometry(white)
+            _meshes[white] = (coords, mesh_adjacency(faces, coords.shape[0]),
+                              vertex_areas(white))
+        return _meshes[white]
+    finally:
+        _meshes_lock.release()
+
+class SurfaceClusters(object):
+    """Clusters a significance map on a surface mesh.
+
+    The mesh, cortex label, and annotation are read once, so clusters()
+    can be called for any number of thresholds::
+
+        >>> sc = SurfaceClusters("sig.mgh", subjdir, "lh")
+        >>> for thresh in [2, 3, 4]:
+        ...     print len(sc.clusters(thresh, minsize=50))
+
+    """
+    def __init__(self, sigfile, subjdir, hemi, subject="fsaverage",
+                 cortex=True, annot="aparc"):
+        """
+        Parameters
+        ----------
+        sigfile : str
+            Significance map on the surface (-log10(p)).
+        subjdir : str
+            Freesurfer subjects directory.
+        hemi : str
+            "lh" or "rh".
+        subject : str, optional
+            Subject the map is on.  Defaults to fsaverage.
+        cortex : bool, optional
+            Only cluster vertices in ?h.cortex.label.  Defaults to True.
+        annot : str, optional
+            Annotation used to name clusters by their peak vertex.
+
+        """
+        self.subject = subject
+        self.hemi = hemi
+        surfdir = os.path.join(subjdir, subject, "surf")
+        labeldir = os.path.join(subjdir, subject, "label")
+        self.coords, self.adjacency, self.areas = _load_mesh(
+            os.path.join(surfdir, "%s.white" % hemi))
+        self.sig = load_data(sigfile)[0][:, 0].astype(float)
+        if len(self.sig) != self.coords.shape[0]:
+            raise ValueError("%s does not have a value for each vertex of %s %s"
+                             % (sigfile, subject, hemi))
+        self.mask = np.ones(len(self.sig), bool)
+        if cortex:
+            self.mask[:] = False
+            cortexverts = read_label(os.path.join(labeldir, "%s.cortex.label" % hemi))[0]
+            self.mask[cortexverts] = True
+        labels, ctab, names = nib.freesurfer.read_annot(
+            os.path.join(labeldir, "%s.%s.annot" % (hemi, annot)))
+        self.annotnames = np.array(list(names) + ["unknown"])
+        labels = np.asarray(labels).copy()
+        labels[labels < 0] = len(names)
+        self.annotlabels = labels
+
+    def threshold(self, threshtype, value, sign="abs"):
+        """Return the sig threshold for a threshold type and value.
+
+        Parameters
+        ----------
+        threshtype : "sig" or "fdr"
+        value : float
+            The sig threshold itself, or the FDR.
+        sign : "abs", "pos", or "neg", optional
+
+        """
+        if threshtype == "fdr":
+            return fdr_threshold(self.sig[self.mask], value, sign)
+        return value
+
+    def clusters(self, thresh, minsize=0, sign="abs"):
+        """Find the clusters of vertices above a threshold.
+
+        Parameters
+        ----------
+        thresh : float
+            Sig threshold; see threshold() to get one from an FDR.
+        minsize : int, optional
+            Minimum number of vertices in a cluster.
+        sign : "abs", "pos", or "neg", optional
+
+        Returns
+        -------
+        list of dicts, one for each cluster in order of decreasing peak
+        value, with keys "max", "vtxmax", "area", "vertices", and "annot"
+
+        """
+        supra = np.nonzero(self.mask & (_signed(self.sig, sign) >= thresh))[0]
+        if not len(supra):
+            return []
+        n_clusters, labels = csgraph.connected_components(
+            self.adjacency[supra][:, supra], directed=False)
+        order = np.argsort(labels, kind="mergesort")
+        starts = np.searchsorted(labels[order], np.arange(n_clusters))
+        clusters = []
+        for vertices in np.split(supra[order], starts[1:]):
+            if len(vertices) < minsize:
+                continue
+            peak = vertices[np.argmax(np.abs(self.sig[vertices]))]
+            clusters.append(dict(max=self.sig[peak], vtxmax=peak,
+                                 area=self.areas[vertices].sum(),
+                                 vertices=vertices,
+                                 annot=self.annotnames[self.annotlabels[peak]]))
+        clusters.sort(key=lambda cluster: -abs(cluster["max"]))
+        return clusters
+
+    def write(self, clusters, summary, labelstem):
+        """Write clusters as an mri_surfcluster summary and label files.
+
+        Parameters
+        ----------
+        clusters : list
+            Clusters from clusters().
+        summary : str
+            Summary table file.
+        labelstem : str
+            Label files are written to <labelstem>-%04d.label, numbered
+            from 1 in the order of the clusters.
+
+        """
+        fid = open(summary, "w")
+        fid.write("# Cluster summary of %s %s\n" % (self.subject, self.hemi))
+        fid.write("# ClusterNo  Max   VtxMax   Size(mm^2)  X  Y  Z  NVtxs  Annot\n")
+        for i, cluster in enumerate(clusters):
+            x, y, z = self.coords[cluster["vtxmax"]]
+            fid.write("%4d  %8.4f  %6d  %8.2f  %6.1f  %6.1f  %6.1f  %5d  %s\n"
+                      % (i + 1, cluster["max"], cluster["vtxmax"], cluster["area"],
+                         x, y, z, len(cluster["vertices"]), cluster["annot"]))
+            vertices = cluster["vertices"]
+            write_label("%s-%04d.label" % (labelstem, i + 1), vertices,
+                        self.coords[vertices], self.sig[vertices], self.subject)
+        fid.close()
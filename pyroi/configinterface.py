@@ -300,7 +300,9 @@ def _prep_label_atlas(atlasdict):
 
 def _prep_mask_atlas(atlasdict):
     """Prepare a mask atlas dictionary"""
-    atlasfields = ["atlasname", "source", "sourcedir", "sourcefiles"]
+    atlasfields = ["atlasname", "source", "sourcedir", "sourcefiles", "weighted"]
+    if "weighted" not in atlasdict:
+        atlasdict["weighted"] = False
     _check_fields(atlasfields, atlasdict)
 
     if not os.path.isabs(atlasdict["sourcedir"]):
@@ -375,6 +377,65 @@ def fssubjdir():
     os.environ["SUBJECTS_DIR"] = path
     return path
 
+# Optional settings that control how processing is run, and their defaults
+_execution_defaults = dict(cachedir="", depcheck="mtime",
+                           backend="local", spooldir="", spoolwait=300,
+                           maxprocs=0, memlimit=0, pool="process",
+                           journal=True, engine="freesurfer", chunkframes=0)
+
+def execution(option=None):
+    """Return the settings that control how processing programs are run.
+
+    None of these settings are required in the config file; any that are
+    missing take their default value.  Each can also be overridden for a 
+    single atlas or source object with a keyword argument of the same name.
+
+    Parameters
+    ----------
+    option : str, optional
+        Name of a single setting to return.  Returns all of them if None.
+
+    Returns
+    -------
+    dict, or the value of one setting
+
+    """
+    settings = {}
+    for name, default in _execution_defaults.items():
+        if is_setup:
+            settings[name] = copy(getattr(setup, name, default))
+        else:
+            settings[name] = default
+
+    if settings["cachedir"] and not os.path.isabs(settings["cachedir"]):
+        settings["cachedir"] = os.path.join(setup.basepath, settings["cachedir"])
+    if settings["depcheck"] not in ["mtime", "digest"]:
+        raise SetupError("Execution setting 'depcheck' must be 'mtime' or 'digest'")
+    if settings["backend"] not in ["local", "spool"]:
+        raise SetupError("Execution setting 'backend' must be 'local' or 'spool'")
+    if (not isinstance(settings["spoolwait"], (int, float))
+        or settings["spoolwait"] < 0):
+        raise SetupError("Execution setting 'spoolwait' must be a positive number or 0")
+    if settings["pool"] not in ["process", "thread"]:
+        raise SetupError("Execution setting 'pool' must be 'process' or 'thread'")
+    if settings["engine"] not in ["freesurfer", "native"]:
+        raise SetupError("Execution setting 'engine' must be 'freesurfer' or 'native'")
+    if not isinstance(settings["chunkframes"], int) or settings["chunkframes"] < 0:
+        raise SetupError("Execution setting 'chunkframes' must be a positive integer or 0")
+    if is_setup:
+        if not settings["spooldir"]:
+            settings["spooldir"] = os.path.join(setup.basepath, "roi", "analysis",
+                                                projectname(), "spool")
+        elif not os.path.isabs(settings["spooldir"]):
+            settings["spooldir"] = os.path.join(setup.basepath, settings["spooldir"])
+
+    if option is None:
+        return settings
+    elif option in settings:
+        return settings[option]
+    else:
+        raise SetupError("Execution setting '%s' not understood" % option)
+
 def first_level_program():
     """Return the program used for first-level analysis.
     
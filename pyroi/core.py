@@ -5,12 +5,15 @@ import os
 import re
 import sys
 import shutil
-import subprocess
-from copy import deepcopy
+import getpass
+import threading
 from datetime import datetime
 from socket import gethostname
 import numpy as np
 import configinterface as cfg
+import cache
+import spool
+import runner
 try:
     import nipype.interfaces.base as pypebase
 except ImportError:
@@ -21,15 +24,39 @@ __all__ = ["RoiResult", "Log",
 
 __module__ = "core"
 
+# Log files can be written from several threads at once
+_log_lock = threading.Lock()
+
 class RoiBase(object):
-    """Base class for PyROI objects that defines run methods."""
+    """Base class for PyROI objects that defines run methods.
+
+    Keyword arguments override execution settings (see cfg.execution())
+    for one object.  An object given a Log as its ``log`` keyword writes 
+    each program it runs to that log as the program runs, line by line,
+    rather than leaving it to be logged from the returned result.
+
+    """
     def __init__(self, **kwargs):
 
         self.__dict__.update(**kwargs)
         if "debug" not in self.__dict__:
             self.debug = False
 
-    def _run(self, input):
+    def _option(self, name):
+        """Return an execution setting from this object or the config file."""
+        if name in self.__dict__:
+            return self.__dict__[name]
+        return cfg.execution(name)
+
+    def _runopts(self):
+        """Return the keyword arguments that pass run settings to helper objects."""
+        opts = dict(debug=self.debug)
+        for name in cfg.execution().keys() + ["log"]:
+            if name in self.__dict__:
+                opts[name] = self.__dict__[name]
+        return opts
+
+    def _run(self, input, inputs=None, outputs=None, scratch=None):
         """Interface to _nipype_run and _manual_run methods.
         
         Parameters
@@ -39,6 +66,12 @@ class RoiBase(object):
             method to be executed with a subprocess system call.  If 
             an interface, it is passed to _nipype_run and executed by
             calling its run() method.
+        inputs : list, optional
+            Files the command reads.  See _manual_run().
+        outputs : list, optional
+            Files the command writes.  See _manual_run().
+        scratch : str, optional
+            Temporary directory of this run.  See _manual_run().
 
         Returns
         -------
@@ -46,12 +79,16 @@ class RoiBase(object):
         """
 
         if isinstance(input, list):
-            return self._manual_run(input)
+            return self._manual_run(input, inputs, outputs, scratch)
         elif isinstance(input, pypebase.Interface):
             return self._nipype_run(input)
         else:
             raise TypeError("Unexpected input %s" % type(input))
-            
+
+    def _call_for_subject(self, subject, method, *args, **kwargs):
+        """Initialize the object for a subject and call one of its methods."""
+        self.init_subject(subject)
+        return getattr(self, method)(*args, **kwargs)
 
     def _nipype_run(self, interface):
         """Run a program using its nipype interface.
@@ -71,15 +108,39 @@ class RoiBase(object):
         else:
             res = interface.run()
             result(interface.cmdline, res)
+            returncode = getattr(res.runtime, "returncode", 0)
+            if returncode:
+                result.fail(interface.cmdline, returncode)
         return result
 
-    def _manual_run(self, cmd):
+    def _manual_run(self, cmd, inputs=None, outputs=None, scratch=None):
         """Run a command line program that lacks a nipype interface.
         
+        If a cache directory is set (see cfg.execution()) and the command
+        declares both its input and output files, the outputs are copied
+        from the cache when the command has already been run on inputs 
+        with the same contents, and stored in the cache after a new run.
+
+        With the "spool" backend, the command is handed to a worker 
+        through the spool directory instead of run here (see the spool
+        module), and this waits for it to finish, or fails it once it has
+        waited spoolwait seconds with no worker running.
+
+        If the object was given a log (see RoiBase), the command and its
+        output are also written to it, line by line as the program runs
+        with the local backend.
+
         Parameter
         ---------
         cmd : list
             List of command and argument strings
+        inputs : list, optional
+            Files the command reads
+        outputs : list, optional
+            Files the command writes
+        scratch : str, optional
+            Temporary directory made for this run, which is left out of
+            the cache key
 
         Returns
         -------
@@ -90,16 +151,51 @@ class RoiBase(object):
         cmdline = " ".join(cmd)
         if self.debug:
             result(cmdline)
+            return result
+        log = self.__dict__.get("log")
+
+        key = None
+        cachedir = self._option("cachedir")
+        if cachedir and inputs is not None and outputs:
+            cmdcache = cache.CommandCache(cachedir)
+            key = cmdcache.key(cmdline, inputs, scratch)
+            if key is not None:
+                cached = cmdcache.restore(key, outputs)
+                if cached is not None:
+                    stdout, stderr = cached
+                    stdout = "Outputs restored from cache %s\n%s" % (key, stdout)
+                    result(cmdline, [stdout, stderr])
+                    if log is not None:
+                        log(cmdline, [stdout, stderr])
+                    return result
+
+        if self._option("backend") == "spool":
+            jobs = spool.Spool(self._option("spooldir"))
+            stdout, stderr, returncode = jobs.call(
+                cmdline, inputs, outputs, unclaimed=self._option("spoolwait") or None)
+            if log is not None:
+                log(cmdline, [stdout, stderr])
         else:
-            proc = subprocess.Popen(cmdline, 
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    env=deepcopy(os.environ.data),
-                                    shell=True)
-            stdout, stderr = proc.communicate()
-            result(cmdline, [stdout, stderr])
+            # The runner streams the output into the log as it is written
+            procs = runner.Runner(self._option("maxprocs"), 
+                                  self._option("memlimit"), _memory_profile())
+            stdout, stderr, returncode = procs.run(cmdline, log)
+        result(cmdline, [stdout, stderr])
+        if returncode:
+            result.fail(cmdline, returncode)
+            if log is not None:
+                log.fail(cmdline, returncode)
+        elif key is not None:
+            cmdcache.store(key, outputs, stdout, stderr)
         return result
 
+def _memory_profile():
+    """Return the file that keeps the peak memory use of each program."""
+    if not cfg.is_setup:
+        return None
+    return os.path.join(cfg.setup.basepath, "roi", "analysis", 
+                        cfg.projectname(), "logfiles", ".toolmemory")
+
 class RoiResult(object):
     """Result class to return PyROI processing command lines and results.
     
@@ -113,6 +209,10 @@ class RoiResult(object):
 
     By calling or using the add() method on another RoiResult object,
     it will add that object's information to its internal result lists.  
+
+    Command lines that exited with an error are also listed in the failed
+    attribute, which is carried along when results are added together,
+    so a result is only a success if failed is empty.
     
     """
     def __init__(self, cmdline=None, res=None, log=False, continue_log=False, logdir=None):
@@ -120,6 +220,7 @@ class RoiResult(object):
         self.cmdline = []
         self.stdout = []
         self.stderr = []
+        self.failed = []
 
         if log:
             self._setup_log(continue_log, logdir)
@@ -135,6 +236,7 @@ class RoiResult(object):
             self.cmdline.extend(cmdline.cmdline)
             self.stdout.extend(cmdline.stdout)
             self.stderr.extend(cmdline.stderr)
+            self.failed.extend(cmdline.failed)
             logentry = ""
             for i, entry in enumerate(cmdline.cmdline):
                 logentry = "\n".join((logentry, cmdline.cmdline[i],
@@ -161,7 +263,7 @@ class RoiResult(object):
 
         logentry = logentry + "\n"
         if self.log:
-            self._log_fid.write(logentry)
+            self._write_log(logentry)
 
     def __str__(self):
 
@@ -174,6 +276,43 @@ class RoiResult(object):
 
         self(cmdline, res)
 
+    def fail(self, cmdline, returncode=None):
+        """Record that a command line failed."""
+        self.failed.append(cmdline)
+        if self.log:
+            self._write_log("Failed (exit status %s): %s\n" % (returncode, cmdline))
+
+    def stream(self, text):
+        """Write part of a running command's output to the log file.
+
+        Used by the runner module to log output as it is written; the 
+        command is added to the result with add_streamed() once it exits.
+
+        """
+        if self.log:
+            self._write_log(text)
+
+    def add_streamed(self, cmdline, res):
+        """Add a command whose output was already written with stream()."""
+        _log_lock.acquire()
+        try:
+            self.cmdline.append(cmdline)
+            self.stdout.append(res[0] or "")
+            self.stderr.append(res[1] or "")
+        finally:
+            _log_lock.release()
+        if self.log:
+            self._write_log("\n")
+
+    def _write_log(self, text):
+        """Write to the log file, one thread at a time."""
+        _log_lock.acquire()
+        try:
+            self._log_fid.write(text)
+            self._log_fid.flush()
+        finally:
+            _log_lock.release()
+
     def last(self):
 
         print "\n".join([self.cmdline[-1], self.stdout[-1], self.stderr[-1]])
@@ -221,7 +360,7 @@ class RoiResult(object):
         
         header = "\n".join(("PyROI Log File",
                             "%s" % str(datetime.now())[:-10],
-                            "User: %s" % os.getlogin(),
+                            "User: %s" % getpass.getuser(),
                             "Host: %s" % gethostname()))
         if config_file_path():
             header = "\n".join((header,
@@ -231,13 +370,31 @@ class RoiResult(object):
         self._log_fid.write(header)
 
 class Log(RoiResult):
-    """Wraps RoiResult with logging automatically enabled."""
+    """Wraps RoiResult with logging automatically enabled.
+
+    A Log can be handed to PyROI objects with their ``log`` keyword so
+    that programs are logged as they run.  It survives being copied to
+    the worker processes of a process pool, which append to the same
+    log file.
+
+    """
     def __init__(self, continue_log=False, logdir=None):
         RoiResult.__init__(self, log=True, continue_log=continue_log, logdir=logdir) 
     
     def write(self, cmdline, result=None):
         self(cmdline, result)
 
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        del state["_log_fid"]
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._log_fid = open(self.log_file, "a")
+
 
 def import_config(module_name):
     """Import a customized config setup module into the cfg module.
@@ -47,44 +47,6 @@ def build_database(atlas, analysis, subjects=None):
     if not isinstance(atlas, RoiBase):
         atlas = atlases.init_atlas(atlas, analysis["par"])
 
-    # Get the name, current date, and database directory
-    name = atlas.atlasname + "_" + get_analysis_name(analysis)
-    newdate = str(
-        datetime.now())[:-10].replace("-","").replace(":","").replace(" ","-")
-    dbdir = os.path.join(cfg.setup.basepath, "roi", "analysis",
-                         cfg.projectname(), "databases")
-    dbfile = os.path.join(dbdir, name + ".txt")                         
-    dbtmpfile = os.path.join(dbdir, ".tmp1-" + name + ".txt")
-    rectmpfile = os.path.join(dbdir, ".tmp2-" + name + ".txt")
-    
-    # Hist file has names and dates of writing of old databases
-    histfile = os.path.join(dbdir, "." + cfg.projectname() + "_history.npy")
-    try:
-        dbhist = np.load(histfile)
-        if name in dbhist:
-            # Figure out the old date and then replace it with the new date
-            if dbhist.ndim > 1: 
-                nameidx = np.where(dbhist == name)
-                dateidx = (nameidx[0], nameidx[1]+1)
-                olddate = dbhist[dateidx][0]
-                dbhist[dateidx] = newdate
-            else:
-                olddate = dbhist[1][0]
-                dbhist[1] = newdate
-
-            archfile = os.path.join(dbdir, ".old", name + "_" + olddate + ".txt")
-            try:
-                # Move the old database to database depository 
-                shutil.move(dbfile, archfile)
-            except IOError:
-                # Or just pass if the old database no longer exists
-                pass
-        else:
-            dbhist = np.vstack((dbhist, np.array((name, newdate))))
-    except IOError:
-        # Catch the error where the history file doesn't exist
-        dbhist = np.array((name, newdate))
-    
     unitdict = {"surface": "vertices", "volume": "voxels"}
     units = unitdict[atlas.manifold]
 
@@ -94,11 +56,8 @@ def build_database(atlas, analysis, subjects=None):
     rois = np.array("rois")
     size = np.array("base-%s" % units)
     mask = np.array("final-%s" % units)
-    if analysis["extract"] == "beta":
-        func = np.array(cfg.betas(analysis["par"], "names", cfg.subjects()[0]))
-    elif analysis["extract"] == "contrast":
-        func = np.array(cfg.contrasts(analysis["par"], "names"))
-    elif analysis["extract"] == "timecourse":
+    ntps = None
+    if analysis["extract"] == "timecourse":
         atlas.init_subject(subjects[0])
         atlas(analysis)
         if atlas.manifold == "volume":
@@ -106,7 +65,14 @@ def build_database(atlas, analysis, subjects=None):
         else:
             dummy = np.genfromtxt(atlas.functxt % atlas.iterhemi[0])
         ntps = dummy.shape[0]
-        func = np.array(["%s-%d"%(cfg.paradigms(analysis["par"]),i) for i in range(ntps)],)
+    func = _func_header(analysis, ntps)
+
+    # Extra region statistics get a column for each of the func columns
+    if "stats" in analysis.keys():
+        stats = list(analysis["stats"])
+    else:
+        stats = []
+    statcols = [np.array(["%s-%s" % (name, stat) for name in func]) for stat in stats]
 
     if atlas.manifold == "volume":
         addrois = np.array([atlas.lutdict[id] for id in atlas.regions])
@@ -137,6 +103,15 @@ def build_database(atlas, analysis, subjects=None):
             addrois = surfrois
 
 
+    def readstats(hemi=None):
+        """Append the extra statistics for the current subject (and hemi)."""
+        for i, stat in enumerate(stats):
+            statfile = atlas._stat_file(stat)
+            if hemi is not None:
+                statfile = statfile % hemi
+            addstat = np.transpose(np.genfromtxt(statfile))
+            statcols[i] = np.vstack((statcols[i], addstat))
+
     # Build the database
     for subject in subjects:
         atlas.init_subject(subject)
@@ -154,6 +129,7 @@ def build_database(atlas, analysis, subjects=None):
                 getmask = lambda id: maskarr[np.where(maskarr[:,1] == id), 2].flat[0]
                 addsize = np.array([getsize(id) for id in atlas.regions]).reshape(nrois, 1)
                 addmask = np.array([getmask(id) for id in atlas.regions]).reshape(nrois, 1)
+                readstats()
             else:
                 h = atlas.hemi
                 addfunc = np.genfromtxt(atlas.functxt % h)
@@ -165,6 +141,7 @@ def build_database(atlas, analysis, subjects=None):
                 getmask = lambda id: maskarr[np.where(maskarr[:,1] == id), 2].flat[0]
                 addsize = np.array([getsize(id) for id in atlas.regions[h]]).reshape(nrois, 1)
                 addmask = np.array([getmask(id) for id in atlas.regions[h]]).reshape(nrois, 1)
+                readstats(h)
             addfunc = np.transpose(addfunc)
             addsubj = np.array([subject for i in range(nrois)]).reshape(nrois, 1)
             group = cfg.subjects(subject=subject)
@@ -197,6 +174,7 @@ def build_database(atlas, analysis, subjects=None):
                     [getsize(id) for id in atlas.regions[hemi]]).reshape(nrois/2, 1)
                 addmask = np.array(
                     [getmask(id) for id in atlas.regions[hemi]]).reshape(nrois/2, 1)
+                readstats(hemi)
 
                 # Append this subject's rows
                 subj = np.vstack((subj, addsubj))
@@ -206,8 +184,120 @@ def build_database(atlas, analysis, subjects=None):
                 func = np.vstack((func, addfunc))
                 mask = np.vstack((mask, addmask))
 
+    fulldb = np.hstack([subj, grp, rois, size, func] + statcols + [mask])
+    return _save_database(atlas, analysis, fulldb)
+
+def cube_database(atlas, analysis, subjects, ids, cube, base, final, stats=None):
+    """Write a database straight from a group extraction array.
+
+    This writes the same table as build_database(), but from the output
+    of Atlas.group_cube() rather than from per-subject extraction files.
+
+    Parameters
+    ----------
+    atlas : Atlas object
+    analysis : dict
+        Analysis dictionary.
+    subjects : list
+        Subject of each row of the cube.
+    ids : list
+        Region id of each column of the cube.
+    cube : array
+        Subjects x regions x frames average waveforms.
+    base : array
+        Number of voxels in each region.
+    final : array
+        Subjects x regions number of voxels left after masking.
+    stats : dict, optional
+        Subjects x regions x frames array of each of the analysis's extra
+        region statistics, which get their columns as in build_database().
+
+    Returns
+    -------
+    RoiResult object
+
+    """
+    units = {"surface": "vertices", "volume": "voxels"}[atlas.manifold]
+    func = _func_header(analysis, cube.shape[2])
+    names = list(analysis.get("stats", []))
+    if names and (stats is None or set(names) - set(stats)):
+        raise ValueError("The analysis has stats %s, but they were not all given"
+                         % ", ".join(names))
+    head = ["subjects", "group", "rois", "base-%s" % units] + list(func)
+    for name in names:
+        head.extend(["%s-%s" % (col, name) for col in func])
+    head.append("final-%s" % units)
+    rows = [head]
+    for s, subject in enumerate(subjects):
+        group = cfg.subjects(subject=subject)
+        for r, id in enumerate(ids):
+            row = [subject, group, atlas.lutdict[id], str(base[r])]
+            row.extend(["%g" % value for value in cube[s, r]])
+            for name in names:
+                row.extend(["%g" % value for value in stats[name][s, r]])
+            row.append(str(final[s, r]))
+            rows.append(row)
+    return _save_database(atlas, analysis, np.array(rows))
+
+def _func_header(analysis, ntps=None):
+    """Return the names of the func columns for an analysis.
+
+    ntps is the number of timepoints, needed for timecourse analyses.
+
+    """
+    if analysis["extract"] == "beta":
+        return np.array(cfg.betas(analysis["par"], "names", cfg.subjects()[0]))
+    elif analysis["extract"] == "contrast":
+        return np.array(cfg.contrasts(analysis["par"], "names"))
+    elif analysis["extract"] == "timecourse":
+        return np.array(["%s-%d"%(cfg.paradigms(analysis["par"]),i) for i in range(ntps)],)
+
+def _save_database(atlas, analysis, fulldb):
+    """Sort the database rows by roi, group, and subject and write it out.
+
+    The first row of fulldb is the header.  Any older database for the
+    atlas and analysis is moved to the .old directory.
+
+    """
+    # Get the name, current date, and database directory
+    name = atlas.atlasname + "_" + get_analysis_name(analysis)
+    newdate = str(
+        datetime.now())[:-10].replace("-","").replace(":","").replace(" ","-")
+    dbdir = os.path.join(cfg.setup.basepath, "roi", "analysis",
+                         cfg.projectname(), "databases")
+    dbfile = os.path.join(dbdir, name + ".txt")                         
+    dbtmpfile = os.path.join(dbdir, ".tmp1-" + name + ".txt")
+    rectmpfile = os.path.join(dbdir, ".tmp2-" + name + ".txt")
+    
+    # Hist file has names and dates of writing of old databases
+    histfile = os.path.join(dbdir, "." + cfg.projectname() + "_history.npy")
+    try:
+        dbhist = np.load(histfile)
+        if name in dbhist:
+            # Figure out the old date and then replace it with the new date
+            if dbhist.ndim > 1: 
+                nameidx = np.where(dbhist == name)
+                dateidx = (nameidx[0], nameidx[1]+1)
+                olddate = dbhist[dateidx][0]
+                dbhist[dateidx] = newdate
+            else:
+                olddate = dbhist[1][0]
+                dbhist[1] = newdate
+
+            archfile = os.path.join(dbdir, ".old", name + "_" + olddate + ".txt")
+            try:
+                # Move the old database to database depository 
+                shutil.move(dbfile, archfile)
+            except IOError:
+                # Or just pass if the old database no longer exists
+                pass
+        else:
+            dbhist = np.vstack((dbhist, np.array((name, newdate))))
+    except IOError:
+        # Catch the error where the history file doesn't exist
+        dbhist = np.array((name, newdate))
+    
     # Possible hack to sort by ROI using a recarray
-    fulldb = np.hstack((subj, grp, rois, size, func, mask))
     head = fulldb[0,:]
     np.savetxt(dbtmpfile, fulldb, "%s", "\t")
     recdb = np.recfromtxt(dbtmpfile, names=True)
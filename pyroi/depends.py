@@ -0,0 +1,125 @@
+"""
+Make-style dependency tracking for the files PyROI writes.
+
+When a processing step finishes, a small stamp file is written next to
+each of its outputs recording the state of every input the step read.
+An output is up to date if its stamp lists the same inputs and none of
+them have changed since.  Outputs written before stamps existed fall
+back to the make rule: they are up to date if they are newer than all
+of their inputs.
+
+Input state is either the size and modification time of a file (the
+"mtime" method, which is cheap) or a digest of its contents (the
+"digest" method, which ignores files that were touched but not
+changed).  The method is chosen with the ``depcheck`` config setting.
+
+Functions
+---------
+record     :  Write dependency stamps for a step's outputs
+
+is_current :  Return whether a step's outputs are up to date
+
+"""
+import os
+
+import cache
+
+__all__ = ["record", "is_current"]
+
+__module__ = "depends"
+
+def _stamp_file(output):
+    """Return the path to the stamp file for an output."""
+    path, fname = os.path.split(output)
+    return os.path.join(path, ".%s.deps" % fname)
+
+def _input_state(fname, method):
+    """Return a string describing the current state of an input file."""
+    if method == "digest":
+        return cache.file_digest(fname)
+    elif method == "mtime":
+        fstat = os.stat(fname)
+        return "%d:%r" % (fstat.st_size, fstat.st_mtime)
+    else:
+        raise ValueError("Dependency check method '%s' not understood" % method)
+
+def _read_stamp(output):
+    """Return the {input: state} dict from an output's stamp, or None."""
+    try:
+        fid = open(_stamp_file(output), "r")
+    except IOError:
+        return None
+    stamp = {}
+    for line in fid:
+        line = line.rstrip("\n")
+        if line:
+            state, fname = line.split("\t", 1)
+            stamp[fname] = state
+    fid.close()
+    return stamp
+
+def record(outputs, inputs, method="mtime"):
+    """Write dependency stamps for the outputs of a processing step.
+
+    Stamps are only written for outputs that exist, and only if all of
+    the inputs exist.
+
+    Parameters
+    ----------
+    outputs : list
+        Files the step wrote.
+    inputs : list
+        Files the step read.
+    method : "mtime" or "digest", optional
+
+    """
+    if not all([os.path.isfile(f) for f in inputs]):
+        return
+    lines = ["%s\t%s\n" % (_input_state(f, method), f) for f in inputs]
+    for output in outputs:
+        if not os.path.isfile(output):
+            continue
+        stampfile = _stamp_file(output)
+        tmpfile = "%s.%d" % (stampfile, os.getpid())
+        fid = open(tmpfile, "w")
+        fid.writelines(lines)
+        fid.close()
+        os.rename(tmpfile, stampfile)
+
+def is_current(outputs, inputs, method="mtime"):
+    """Return whether the outputs of a processing step are up to date.
+
+    Parameters
+    ----------
+    outputs : list
+        Files the step writes.
+    inputs : list
+        Files the step reads.
+    method : "mtime" or "digest", optional
+
+    Returns
+    -------
+    bool
+
+    """
+    if not outputs:
+        return False
+    for output in outputs:
+        if not os.path.isfile(output):
+            return False
+        stamp = _read_stamp(output)
+        if stamp is None:
+            # Make rule for outputs without a stamp
+            outtime = os.path.getmtime(output)
+            for fname in inputs:
+                if os.path.isfile(fname) and os.path.getmtime(fname) > outtime:
+                    return False
+            continue
+        if set(stamp) != set(inputs):
+            return False
+        for fname in inputs:
+            if not os.path.isfile(fname):
+                return False
+            if stamp[fname] != _input_state(fname, method):
+                return False
+    return True
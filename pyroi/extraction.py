@@ -0,0 +1,1333 @@
+"""
+Native region extraction engine.
+
+By default, PyROI extracts regional averages by running mri_segstats,
+which has to start a new process and read the atlas and the source image
+from disk for every subject and analysis.  With the ``engine = "native"``
+config setting, atlases instead do the same reductions in process with
+NumPy: the voxels (or vertices) of each region are listed in a compact
+sparse index, and the stats of every region come from gathering the
+source data in index order and reducing it with a single reduceat call.
+
+The label image of a standard-space atlas is the same for every subject,
+so its index can be saved to disk keyed by the digest of the atlas file
+(see region_index()) and reused instead of scanning the labels again.
+
+The output files are written in the same formats mri_segstats uses for
+its --avgwf, --avgwfvol, and --sum options, so the database functions
+read them the same way.
+
+Classes
+-------
+RegionIndex    :  Sparse index of the voxels in each region of a label image
+
+Functions
+---------
+load_data      :  Load an image as a voxels x frames array
+
+iter_frames    :  Read an image a few frames at a time
+
+save_volume    :  Save an array as an mgz or Nifti image
+
+concatenate    :  Write the mean of each group of images as a frame of one
+                  image
+
+voxel_size     :  Return the volume of one voxel in an image
+
+region_index   :  Return the RegionIndex of a label image, reusing one
+                  saved on disk when possible
+
+apply_mask     :  Threshold a mask image the way mri_segstats does
+
+parse_stat     :  Check the name of a region statistic
+
+order_stats    :  Compute medians, percentiles, trimmed means, etc. of the
+                  voxels in each region
+
+mask_sweep     :  Compute masked region averages for many mask thresholds
+                  and signs at once
+
+write_sweep    :  Write the results of mask sweeps as a table
+
+group_cube     :  Extract a group of images in the same space into one
+                  subjects x regions x frames array
+
+export_patterns : Write the voxel patterns of many regions and subjects to
+                  one .npy file with an offset table
+
+read_patterns  :  Open a pattern file as a memory map and its offset table
+
+region_stats   :  Compute average waveforms and summary stats for regions
+
+stream_stats   :  Compute the same stats reading a source a few frames
+                  at a time
+
+extract        :  Reduce a source image over the regions of an atlas image
+                  and write the segstats output files
+
+read_annot     :  Return the colortable structure id of each vertex in an
+                  annotation
+
+annot_index    :  Return the RegionIndex of the labels in an annotation
+
+vertex_areas   :  Return the area of each vertex of a surface
+
+extract_surface : Reduce a surface overlay over the regions of an annotation
+                  and write the segstats output files
+
+write_avgwf    :  Write average waveforms in mri_segstats --avgwf format
+
+write_avgwfvol :  Write average waveforms in mri_segstats --avgwfvol format
+
+write_sum      :  Write a summary table in mri_segstats --sum format
+
+write_max_labels : Write a label image giving each voxel the region of its
+                   largest weight
+
+"""
+import os
+import gzip
+import tempfile
+import threading
+from hashlib import sha1
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+
+import cache as cmdcache
+
+__all__ = ["RegionIndex", "load_data", "iter_frames", "save_volume", "concatenate",
+           "voxel_size", "region_index",
+           "apply_mask", "parse_stat", "order_stats", "mask_sweep", "write_sweep",
+           "group_cube", "export_patterns", "read_patterns",
+           "region_stats", "stream_stats", "extract", "read_annot", "annot_index",
+           "vertex_areas", "extract_surface", "write_avgwf", "write_avgwfvol",
+           "write_sum", "write_max_labels"]
+
+__module__ = "extraction"
+
+# One lock per cache file, so threads wait for a file another is building
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+def _build_lock(fname):
+    """Return the lock held while a cache file is looked up or built."""
+    _build_locks_lock.acquire()
+    try:
+        if fname not in _build_locks:
+            _build_locks[fname] = threading.Lock()
+        return _build_locks[fname]
+    finally:
+        _build_locks_lock.release()
+
+def _save_npz(fname, **arrays):
+    """Write arrays to an npz file atomically.
+
+    The arrays go to a temp file of its own in the same directory, which
+    is then renamed over fname, so concurrent writers in any process or
+    thread never share a temp file and readers never see a partial file.
+
+    """
+    fd, tmpfile = tempfile.mkstemp(".npz", ".tmp-",
+                                   os.path.dirname(os.path.abspath(fname)))
+    try:
+        fid = os.fdopen(fd, "wb")
+        try:
+            np.savez(fid, **arrays)
+        finally:
+            fid.close()
+        os.chmod(tmpfile, 0644)
+        os.rename(tmpfile, fname)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+def load_data(fname, cache=None):
+    """Load an image as a voxels x frames array.
+
+    Surface overlays in mgz format (vertices x 1 x 1 x frames) come out
+    as vertices x frames.
+
+    Parameters
+    ----------
+    fname : str
+        Image file.
+    cache : dict, optional
+        If given, images are kept in it by file name, so extracting
+        several atlases from the same source reads it only once.
+
+    Returns
+    -------
+    (data, img) tuple : float array and the nibabel image object
+
+    """
+    if cache is not None and fname in cache:
+        return cache[fname]
+    img = nib.load(fname)
+    data = np.asarray(img.get_data())
+    if data.ndim > 3:
+        data = data.reshape(-1, data.shape[3])
+    else:
+        data = data.reshape(-1, 1)
+    if cache is not None:
+        cache[fname] = data, img
+    return data, img
+
+def iter_frames(fname, chunkframes):
+    """Read an image a few frames at a time.
+
+    Uncompressed images are memory-mapped and compressed ones (.nii.gz
+    and .mgz) are decompressed as they are read, so only one chunk is
+    ever in memory.
+
+    Parameters
+    ----------
+    fname : str
+        Image file.
+    chunkframes : int
+        Number of frames in each chunk.
+
+    Returns
+    -------
+    iterator of (first frame, voxels x frames array) tuples, with voxels
+    in the same order as load_data() gives them
+
+    """
+    img = nib.load(fname)
+    shape = (tuple(img.shape) + (1, 1, 1, 1))[:4]
+    nvox = int(np.prod(shape[:3]))
+    # The header reports no offset or scaling for a Nifti image until it
+    # is written; the array proxy has the values the file was read with
+    proxy = img.dataobj
+    dtype = np.dtype(proxy.dtype)
+    offset = proxy.offset
+    slope, inter = proxy.slope, proxy.inter
+    if slope is None or not np.isfinite(slope) or slope == 0:
+        slope = 1.
+    if inter is None or not np.isfinite(inter):
+        inter = 0.
+    imgfile = img.file_map["image"].filename
+    del img
+
+    fid = open(imgfile, "rb")
+    gzipped = fid.read(2) == "\x1f\x8b"
+    fid.close()
+    if gzipped:
+        fid = gzip.open(imgfile, "rb")
+        fid.read(offset)
+    else:
+        frames = np.memmap(imgfile, dtype, "r", offset, (shape[3], nvox))
+    try:
+        for start in range(0, shape[3], chunkframes):
+            n = min(chunkframes, shape[3] - start)
+            if gzipped:
+                block = np.fromstring(fid.read(n * nvox * dtype.itemsize), dtype)
+            else:
+                block = frames[start:start + n]
+            # Frames are stored in Fortran order; put the voxels of each
+            # in C order to match load_data()
+            block = block.reshape((n,) + shape[2::-1]).transpose(3, 2, 1, 0)
+            yield start, np.asarray(block, float).reshape(nvox, n) * slope + inter
+    finally:
+        if gzipped:
+            fid.close()
+
+def _load_volume(fname):
+    """Load a single-frame image as a 3D float32 array and its image."""
+    img = nib.load(fname)
+    data = np.asarray(img.get_data(), np.float32)
+    return data.reshape(data.shape[:3]), img
+
+def save_volume(data, affine, fname):
+    """Save an array as an mgz/mgh image, or as Nifti for other names."""
+    if fname.endswith(".mgz") or fname.endswith(".mgh"):
+        nib.save(nib.MGHImage(data, affine), fname)
+    else:
+        nib.save(nib.Nifti1Image(data, affine), fname)
+
+def concatenate(groups, fname, n_threads=4):
+    """Write the mean of each group of images as a frame of one image.
+
+    This is the native equivalent of running ``mri_concat --mean`` on
+    each group and then ``mri_concat`` on the means, without writing the
+    means to disk.  Images are read by a pool of threads at most
+    n_threads ahead of where they are needed, and each group is averaged
+    by adding its images to an accumulator one at a time, so only the
+    output and n_threads + 1 input images are in memory at once.
+
+    Parameters
+    ----------
+    groups : list of lists
+        Image files for each output frame; a group of one image is
+        copied as is.
+    fname : str
+        Output image.  The affine comes from the first input image.
+    n_threads : int, optional
+        Number of images to read at once, and to read ahead.
+
+    """
+    fnames = [f for group in groups for f in group]
+    pool = ThreadPool(n_threads)
+    # Reads in flight, oldest first; never more than n_threads of them
+    reads = deque()
+    started = 0
+    try:
+        out = None
+        for frame, group in enumerate(groups):
+            accum = None
+            for f in group:
+                while len(reads) < n_threads and started < len(fnames):
+                    reads.append(pool.apply_async(_load_volume, (fnames[started],)))
+                    started += 1
+                data, img = reads.popleft().get()
+                if out is None:
+                    out = np.zeros(data.shape + (len(groups),), np.float32)
+                    affine = img.get_affine()
+                if data.shape != out.shape[:3]:
+                    raise ValueError("%s has shape %s but %s has shape %s"
+                                     % (f, data.shape, fnames[0], out.shape[:3]))
+                if accum is None:
+                    accum = data.astype(np.float64)
+                else:
+                    accum += data
+            out[..., frame] = accum / len(group)
+    finally:
+        pool.close()
+    save_volume(out, affine, fname)
+
+def voxel_size(img):
+    """Return the volume of one voxel in an image in mm^3."""
+    return float(np.prod(img.get_header().get_zooms()[:3]))
+
+class RegionIndex(object):
+    """Sparse index of the voxels in each region of a label image.
+
+    The index is stored in compressed sparse row layout: the flat indices
+    of the voxels in all regions, sorted by region, and the offset of the
+    first voxel of each region in that list.
+
+    Regions can also be weighted (e.g. by the probabilities of a
+    probabilistic atlas), in which case a voxel can be in more than one
+    region and the weights attribute holds the weight of each indexed
+    voxel; see from_weights().  Sums over a weighted index are weighted
+    sums, and the size of each region is the total of its weights.
+
+    """
+    def __init__(self, labels, ids):
+        """
+        Parameters
+        ----------
+        labels : array or None
+            Label image with a region id in each voxel (any shape).  None
+            makes an empty index for load() to fill.
+        ids : list
+            Region ids to index, in the order results should come out.
+
+        """
+        self._matrix = None
+        self.weights = None
+        self.ids = list(ids)
+        if labels is None:
+            return
+        labels = np.asarray(labels).ravel()
+        self.n_voxels = labels.shape[0]
+        lookup = np.zeros(labels.shape[0], int) - 1
+        if self.ids:
+            # Position of each voxel's label in the id list, or -1
+            idorder = np.argsort(self.ids)
+            sortedids = np.asarray(self.ids)[idorder]
+            pos = np.minimum(np.searchsorted(sortedids, labels), len(sortedids) - 1)
+            lookup = np.where(sortedids[pos] == labels, idorder[pos], -1)
+        inregion = np.flatnonzero(lookup >= 0)
+        order = np.argsort(lookup[inregion], kind="mergesort")
+        self.voxels = inregion[order]
+        counts = np.bincount(lookup[self.voxels], minlength=len(self.ids))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def __len__(self):
+
+        return len(self.ids)
+
+    def from_weights(cls, maps, ids):
+        """Make a weighted index from a weight map for each region.
+
+        Parameters
+        ----------
+        maps : list of arrays
+            Weight of each voxel in each region (any shape, but all the
+            same size).  Voxels with zero weight are left out.
+        ids : list
+            Region id of each map.
+
+        Returns
+        -------
+        RegionIndex object
+
+        """
+        index = cls(None, ids)
+        voxels = []
+        weights = []
+        for weightmap in maps:
+            weightmap = np.asarray(weightmap, float).ravel()
+            inregion = np.flatnonzero(weightmap)
+            voxels.append(inregion)
+            weights.append(weightmap[inregion])
+            index.n_voxels = weightmap.shape[0]
+        index.voxels = np.concatenate(voxels)
+        index.weights = np.concatenate(weights)
+        index.offsets = np.concatenate(([0], np.cumsum([len(v) for v in voxels])))
+        return index
+    from_weights = classmethod(from_weights)
+
+    def counts(self):
+        """Return the number of voxels in each region."""
+        return np.diff(self.offsets)
+
+    def totals(self):
+        """Return the size of each region: its voxel count or total weight."""
+        if self.weights is None:
+            return self.counts().astype(float)
+        return self._reduceat(np.add, self.weights)
+
+    def region(self, i):
+        """Return the flat voxel indices of the i'th region."""
+        return self.voxels[self.offsets[i]:self.offsets[i + 1]]
+
+    def rows(self):
+        """Return the region row of each indexed voxel."""
+        return np.repeat(np.arange(len(self.ids)), self.counts())
+
+    def subset(self, mask):
+        """Return an index of only the voxels where mask is True."""
+        keep = np.asarray(mask).ravel()[self.voxels]
+        index = RegionIndex(None, self.ids)
+        index.n_voxels = self.n_voxels
+        index.voxels = self.voxels[keep]
+        index.offsets = np.concatenate(([0], np.cumsum(keep)))[self.offsets]
+        if self.weights is not None:
+            index.weights = self.weights[keep]
+        return index
+
+    def reduce(self, ufunc, values, empty=0):
+        """Reduce values over the voxels of each region.
+
+        The values of all regions are gathered in index order and reduced
+        with a single ufunc.reduceat() call.
+
+        Parameters
+        ----------
+        ufunc : numpy ufunc
+            E.g. np.add, np.minimum, or np.maximum.
+        values : array
+            Values for each voxel of the image (voxels [x frames]).
+        empty : float, optional
+            Value for regions without voxels.
+
+        Returns
+        -------
+        array with one row per region
+
+        """
+        return self._reduceat(ufunc, np.asarray(values)[self.voxels], empty)
+
+    def _reduceat(self, ufunc, gathered, empty=0):
+        """Reduce values already gathered in index order."""
+        out = np.zeros((len(self.ids),) + gathered.shape[1:]) + empty
+        nonempty = self.counts() > 0
+        if nonempty.any():
+            # Empty regions are dropped from the offsets; each remaining
+            # region then runs to the start of the next one
+            out[nonempty] = ufunc.reduceat(gathered, self.offsets[:-1][nonempty],
+                                           axis=0)
+        return out
+
+    def sums(self, values):
+        """Return the (weighted) sum of values over each region.
+
+        Unweighted sums are a gather and reduceat; weighted sums are one
+        sparse matrix product.
+
+        """
+        if self.weights is None:
+            return self.reduce(np.add, values)
+        return np.asarray(self.matrix().dot(values))
+
+    def save(self, fname):
+        """Save the index to an npz file, written atomically."""
+        arrays = dict(ids=np.asarray(self.ids), n_voxels=self.n_voxels,
+                      voxels=self.voxels, offsets=self.offsets)
+        if self.weights is not None:
+            arrays["weights"] = self.weights
+        _save_npz(fname, **arrays)
+
+    def load(cls, fname):
+        """Read an index saved with save()."""
+        arrays = np.load(fname)
+        index = cls(None, [int(id) for id in arrays["ids"]])
+        index.n_voxels = int(arrays["n_voxels"])
+        index.voxels = arrays["voxels"]
+        index.offsets = arrays["offsets"]
+        if "weights" in arrays.files:
+            index.weights = arrays["weights"]
+        return index
+    load = classmethod(load)
+
+    def matrix(self, weights=None):
+        """Return the regions x voxels sparse matrix of the index.
+
+        Parameters
+        ----------
+        weights : array, optional
+            Weight of each voxel (in full image order), applied on top of
+            the region weights of a weighted index.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+
+        """
+        if self.weights is None:
+            values = np.ones(len(self.voxels))
+        else:
+            values = self.weights
+        if weights is None:
+            if self._matrix is None:
+                self._matrix = sparse.csr_matrix(
+                    (values, self.voxels, self.offsets),
+                    shape=(len(self.ids), self.n_voxels))
+            return self._matrix
+        values = values * np.asarray(weights, float).ravel()[self.voxels]
+        return sparse.csr_matrix((values, self.voxels, self.offsets),
+                                 shape=(len(self.ids), self.n_voxels))
+
+# Indexes already loaded, by index file
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def region_index(seg, ids, indexdir=None):
+    """Return the RegionIndex of a label image.
+
+    Parameters
+    ----------
+    seg : str or list
+        Label image, or a list of weight images (one for each region id)
+        for a weighted index.
+    ids : list
+        Region ids to index.
+    indexdir : str, optional
+        Directory of saved indexes.  If given, the index is looked up by
+        the digest of the label image(s) and the region ids, and built and
+        saved there if it is not found.  Otherwise it is always built.
+
+    Returns
+    -------
+    RegionIndex object
+
+    """
+    ids = list(ids)
+    if indexdir is None:
+        return _build_index(seg, ids)
+    if isinstance(seg, str):
+        key = sha1(cmdcache.file_digest(seg))
+    else:
+        key = sha1("weighted")
+        for fname in seg:
+            key.update(cmdcache.file_digest(fname))
+    key.update(" ".join([str(id) for id in ids]))
+    indexfile = os.path.join(indexdir, "%s.npz" % key.hexdigest())
+    lock = _build_lock(indexfile)
+    lock.acquire()
+    try:
+        _indexes_lock.acquire()
+        try:
+            if indexfile in _indexes:
+                return _indexes[indexfile]
+        finally:
+            _indexes_lock.release()
+        if os.path.isfile(indexfile):
+            index = RegionIndex.load(indexfile)
+        else:
+            index = _build_index(seg, ids)
+            if not os.path.isdir(indexdir):
+                try:
+                    os.makedirs(indexdir)
+                except OSError:
+                    # Made by another process in the meantime
+                    pass
+            index.save(indexfile)
+        _indexes_lock.acquire()
+        try:
+            _indexes[indexfile] = index
+        finally:
+            _indexes_lock.release()
+        return index
+    finally:
+        lock.release()
+
+def _build_index(seg, ids):
+    """Make the RegionIndex of a label image or list of weight images."""
+    if isinstance(seg, str):
+        return RegionIndex(load_data(seg)[0][:, 0], ids)
+    return RegionIndex.from_weights((load_data(fname)[0][:, 0] for fname in seg),
+                                    ids)
+
+def apply_mask(maskdata, thresh, sign="abs"):
+    """Return the boolean mask from a mask image, mri_segstats style.
+
+    Parameters
+    ----------
+    maskdata : array
+        Values of the mask image (only the first frame is used).
+    thresh : float
+    sign : "abs", "pos", or "neg"
+
+    """
+    maskdata = np.asarray(maskdata)
+    if maskdata.ndim > 1:
+        maskdata = maskdata[:, 0]
+    if sign == "abs":
+        return np.abs(maskdata) > thresh
+    elif sign == "pos":
+        return maskdata > thresh
+    elif sign == "neg":
+        return maskdata < -thresh
+    else:
+        raise ValueError("Mask sign '%s' not understood" % sign)
+
+def parse_stat(name):
+    """Check the name of a region statistic and return what it computes.
+
+    Statistics are named "median", "std", "min", "max", "p<N>" (the Nth
+    percentile), or "trim<N>" (the mean after cutting N percent of the
+    voxels from each end).
+
+    Returns
+    -------
+    (kind, value) tuple : kind is "percentile", "trim", "std", "min", or
+    "max", and value the percentile or the fraction trimmed from each end
+
+    """
+    try:
+        if name == "median":
+            return "percentile", 50.
+        elif name in ["std", "min", "max"]:
+            return name, None
+        elif name.startswith("p") and 0 <= float(name[1:]) <= 100:
+            return "percentile", float(name[1:])
+        elif name.startswith("trim") and 0 <= float(name[4:]) < 50:
+            return "trim", float(name[4:]) / 100
+    except ValueError:
+        pass
+    raise ValueError("Region statistic '%s' not understood" % name)
+
+def order_stats(index, data, names, mask=None):
+    """Compute statistics of the voxels in each region for every frame.
+
+    All frames of all regions are sorted with one lexsort, and each
+    statistic is then read off the sorted values (or their cumulative
+    sums) at offsets into each region.  Region weights are not used; a
+    voxel is counted if it has any weight.
+
+    Parameters
+    ----------
+    index : RegionIndex
+    data : array
+        Voxels x frames source data.
+    names : list
+        Statistics to compute; see parse_stat().
+    mask : boolean array, optional
+        Voxels to include.
+
+    Returns
+    -------
+    dict mapping each name to a regions x frames array
+
+    """
+    _check_voxels(index, data)
+    if mask is not None:
+        index = index.subset(mask)
+    gathered = np.asarray(data, float)[index.voxels]
+    nvox, nframes = gathered.shape
+    if not nvox:
+        return dict([(name, np.zeros((len(index), nframes))) for name in names])
+    values = gathered.T.ravel()
+    order = np.lexsort((values, np.tile(index.rows(), nframes),
+                        np.repeat(np.arange(nframes), nvox)))
+    ordered = values[order].reshape(nframes, nvox).T
+    cumsums = np.vstack((np.zeros((1, nframes)), np.cumsum(ordered, axis=0)))
+
+    counts = index.counts()
+    starts = index.offsets[:-1]
+    ends = index.offsets[1:]
+    empty = counts == 0
+    # Indices safe to read even for empty regions, whose results are zeroed
+    last = np.maximum(ends - 1, 0)
+    results = {}
+    for name in names:
+        kind, value = parse_stat(name)
+        if kind == "percentile":
+            pos = starts + value / 100 * np.maximum(counts - 1, 0)
+            lo = np.minimum(np.floor(pos).astype(int), last)
+            hi = np.minimum(lo + 1, last)
+            frac = (pos - lo)[:, np.newaxis]
+            stat = ordered[lo] * (1 - frac) + ordered[hi] * frac
+        elif kind == "trim":
+            cut = np.floor(value * counts).astype(int)
+            kept = np.maximum(counts - 2 * cut, 1)
+            stat = (cumsums[ends - cut] - cumsums[starts + cut]) / kept[:, np.newaxis]
+        elif kind == "std":
+            denom = np.maximum(counts, 1)[:, np.newaxis]
+            mean = (cumsums[ends] - cumsums[starts]) / denom
+            sqdev = index._reduceat(np.add, gathered ** 2) / denom - mean ** 2
+            stat = np.sqrt(np.maximum(sqdev * denom / np.maximum(denom - 1, 1), 0))
+        elif kind == "min":
+            stat = ordered[np.minimum(starts, last)]
+        else:
+            stat = ordered[last]
+        stat[empty] = 0
+        results[name] = stat
+    return results
+
+def mask_sweep(index, data, maskdata, thresholds, signs=("abs",)):
+    """Compute masked region averages for many mask thresholds and signs.
+
+    For each sign, the voxels of every region are sorted by how far
+    their mask value is past zero (largest first) and the source data
+    is summed cumulatively in that order.  The voxels that pass any
+    threshold are then a prefix of each region, so the masked sum for
+    a threshold is a difference of two cumulative sums.  Region weights
+    are not used.
+
+    Parameters
+    ----------
+    index : RegionIndex
+    data : array
+        Voxels x frames source data.
+    maskdata : array
+        Values of the mask image (only the first frame is used).
+    thresholds : list of floats
+    signs : list, optional
+        Any of "abs", "pos", and "neg", with the same meaning as in
+        apply_mask().
+
+    Returns
+    -------
+    dict mapping (sign, threshold) to an (avgwf, counts) tuple: the
+    regions x frames averages and the voxels in each region that pass
+
+    """
+    _check_voxels(index, data)
+    maskdata = np.asarray(maskdata)
+    if maskdata.ndim > 1:
+        maskdata = maskdata[:, 0]
+    gathered = np.asarray(data, float)[index.voxels]
+    maskvals = np.asarray(maskdata, float)[index.voxels]
+    rows = index.rows()
+    starts = index.offsets[:-1]
+    results = {}
+    for sign in signs:
+        if sign == "abs":
+            keys = np.abs(maskvals)
+        elif sign == "pos":
+            keys = maskvals
+        elif sign == "neg":
+            keys = -maskvals
+        else:
+            raise ValueError("Mask sign '%s' not understood" % sign)
+        order = np.lexsort((-keys, rows))
+        cumsums = np.vstack((np.zeros((1, gathered.shape[1])),
+                             np.cumsum(gathered[order], axis=0)))
+        for thresh in thresholds:
+            counts = index._reduceat(np.add, (keys > thresh).astype(int)).astype(int)
+            sums = cumsums[starts + counts] - cumsums[starts]
+            avgwf = sums / np.maximum(counts, 1)[:, np.newaxis]
+            results[(sign, thresh)] = avgwf, counts
+    return results
+
+def group_cube(index, sources, masks=None, maskthresh=0, masksign="abs",
+               chunksubjects=8, extra=None):
+    """Extract a group of images in the same space into one array.
+
+    The images of up to chunksubjects subjects are stacked side by side
+    as a voxels x (subjects * frames) array and reduced over the regions
+    in one operation.  Masked images are reduced one at a time, since
+    each subject's mask picks out different voxels.
+
+    Parameters
+    ----------
+    index : RegionIndex
+    sources : list of str
+        Source image of each subject; all must have the same shape.
+    masks : list of str, optional
+        Mask image of each subject.
+    maskthresh : float, optional
+    masksign : "abs", "pos", or "neg", optional
+    chunksubjects : int, optional
+        Number of subjects to hold in memory at once.
+    extra : list, optional
+        Order statistics to compute as well (see parse_stat()).
+
+    Returns
+    -------
+    (cube, counts) tuple : subjects x regions x frames average waveforms,
+    and subjects x regions voxel counts after masking.  With extra, a
+    third item maps each statistic to a subjects x regions x frames array.
+
+    """
+    cube = None
+    counts = np.zeros((len(sources), len(index)), int)
+    extracubes = {}
+    for start in range(0, len(sources), chunksubjects):
+        stop = min(start + chunksubjects, len(sources))
+        datas = [load_data(fname)[0] for fname in sources[start:stop]]
+        if cube is None:
+            cube = np.zeros((len(sources), len(index), datas[0].shape[1]))
+            for name in extra or []:
+                extracubes[name] = np.zeros(cube.shape)
+        for fname, data in zip(sources[start:stop], datas):
+            if data.shape[1] != cube.shape[2]:
+                raise ValueError("%s has %d frames but other sources have %d"
+                                 % (fname, data.shape[1], cube.shape[2]))
+        if masks is None:
+            stacked = np.hstack(datas)
+            _check_voxels(index, stacked)
+            totals = index.totals()
+            avgwf = index.sums(stacked) / np.where(totals > 0, totals, 1)[:, np.newaxis]
+            cube[start:stop] = avgwf.reshape(len(index), stop - start, -1).swapaxes(0, 1)
+            counts[start:stop] = index.counts()
+            if extra:
+                for i, data in enumerate(datas):
+                    for name, values in order_stats(index, data, extra).items():
+                        extracubes[name][start + i] = values
+        else:
+            for i, data in enumerate(datas):
+                maskbool = apply_mask(load_data(masks[start + i])[0],
+                                      maskthresh, masksign)
+                stats = region_stats(index, data, maskbool, extra or ())
+                cube[start + i] = stats["avgwf"]
+                counts[start + i] = stats["counts"]
+                for name in extra or []:
+                    extracubes[name][start + i] = stats["extra"][name]
+    if extra is not None:
+        return cube, counts, extracubes
+    return cube, counts
+
+def export_patterns(fname, entries, maskthresh=0, masksign="abs"):
+    """Write the voxel patterns of many regions and subjects to one .npy file.
+
+    The file holds one float32 row per voxel (or vertex) and one column
+    per source frame.  The rows of each region of each subject are
+    contiguous, and a tab-delimited offset table (fname with .index.txt
+    in place of .npy) gives the subject, hemisphere, region id, and the
+    first and last-plus-one row of each.  read_patterns() opens both,
+    so a region's pattern can be sliced out of the memory map without
+    copying.
+
+    Parameters
+    ----------
+    fname : str
+        Pattern file to write (.npy).
+    entries : list of tuples
+        (subject, hemi, index, source, mask) for each subject and hemi;
+        hemi is "" for volume atlases and mask None when not masking.
+    maskthresh : float, optional
+    masksign : "abs", "pos", or "neg", optional
+
+    Returns
+    -------
+    str : the offset table file
+
+    """
+    # Work out the masked indexes first so the file can be sized
+    indexes = []
+    nrows = 0
+    for subject, hemi, index, source, mask in entries:
+        if mask is not None:
+            index = index.subset(apply_mask(load_data(mask)[0], maskthresh, masksign))
+        indexes.append(index)
+        nrows += len(index.voxels)
+    shape = (tuple(nib.load(entries[0][3]).shape) + (1, 1, 1, 1))[:4]
+
+    patterns = np.lib.format.open_memmap(fname, "w+", np.float32, (nrows, shape[3]))
+    indexfile = fname[:-4] + ".index.txt"
+    fid = open(indexfile, "w")
+    fid.write("subject\themi\tid\tstart\tstop\n")
+    row = 0
+    for entry, index in zip(entries, indexes):
+        subject, hemi, source = entry[0], entry[1], entry[3]
+        data = load_data(source)[0]
+        _check_voxels(index, data)
+        if data.shape[1] != shape[3]:
+            raise ValueError("%s has %d frames but other sources have %d"
+                             % (source, data.shape[1], shape[3]))
+        patterns[row:row + len(index.voxels)] = data[index.voxels]
+        for i, id in enumerate(index.ids):
+            fid.write("%s\t%s\t%d\t%d\t%d\n" % (subject, hemi, id,
+                                                  row + index.offsets[i],
+                                                  row + index.offsets[i + 1]))
+        row += len(index.voxels)
+    fid.close()
+    patterns.flush()
+    del patterns
+    return indexfile
+
+def read_patterns(fname):
+    """Open a pattern file written by export_patterns().
+
+    Returns
+    -------
+    (patterns, offsets) tuple : the read-only memory map of the pattern
+    rows, and a dict mapping (subject, hemi, id) to a (start, stop) row
+    range.  patterns[start:stop] is the voxels x frames pattern of that
+    region, without copying.
+
+    """
+    patterns = np.load(fname, mmap_mode="r")
+    offsets = {}
+    fid = open(fname[:-4] + ".index.txt")
+    fid.readline()
+    for line in fid:
+        subject, hemi, id, start, stop = line.rstrip("\n").split("\t")
+        offsets[(subject, hemi, int(id))] = int(start), int(stop)
+    fid.close()
+    return patterns, offsets
+
+def write_sweep(fname, ids, names, sweeps):
+    """Write the results of mask sweeps as a tab-delimited table.
+
+    Parameters
+    ----------
+    fname : str
+        Table file.
+    ids, names : lists
+        Region id and name of each region.
+    sweeps : dict
+        Maps each mask name to a dict returned by mask_sweep().
+
+    """
+    fid = open(fname, "w")
+    nframes = 0
+    for sweep in sweeps.values():
+        for avgwf, counts in sweep.values():
+            nframes = avgwf.shape[1]
+    fid.write("\t".join(["mask", "sign", "thresh", "id", "roi", "final-voxels"] +
+                        ["frame-%d" % i for i in range(nframes)]) + "\n")
+    for maskname in sorted(sweeps):
+        for sign, thresh in sorted(sweeps[maskname]):
+            avgwf, counts = sweeps[maskname][(sign, thresh)]
+            for i, id in enumerate(ids):
+                fid.write("\t".join([maskname, sign, "%g" % thresh, str(id),
+                                     names[i], str(counts[i])] +
+                                    ["%g" % value for value in avgwf[i]]) + "\n")
+    fid.close()
+
+def region_stats(index, data, mask=None, extra=()):
+    """Compute average waveforms and summary stats for a set of regions.
+
+    Parameters
+    ----------
+    index : RegionIndex
+    data : array
+        Voxels x frames source data.
+    mask : boolean array, optional
+        Voxels to include.
+    extra : list, optional
+        Names of more statistics to compute for every frame with
+        order_stats().
+
+    Returns
+    -------
+    dict with these arrays:
+        avgwf  : regions x frames (weighted) average waveforms
+        counts : number of voxels in each region (after masking)
+        totals : size of each region; the counts, or the total weights
+                 for a weighted index
+        mean, std, min, max : stats of the first frame in each region;
+                 with a weighted index, mean and std are weighted and min
+                 and max are over every voxel with any weight
+        extra  : dict of regions x frames arrays from order_stats()
+
+    """
+    _check_voxels(index, data)
+    stats = {}
+    if extra:
+        stats = order_stats(index, data, extra, mask)
+    if mask is not None:
+        index = index.subset(mask)
+    return _stats(index, index.sums(data), data[:, 0], stats)
+
+def stream_stats(index, source, chunkframes, mask=None, extra=()):
+    """Compute the same stats as region_stats() reading a few frames at a time.
+
+    Only the region index, one chunk of frames, and the region sums are
+    in memory at once, so the memory used does not grow with the length
+    of the source timecourse.
+
+    Parameters
+    ----------
+    index : RegionIndex
+    source : str
+        Source image file.
+    chunkframes : int
+        Number of frames to read at a time.
+    mask : boolean array, optional
+        Voxels to include.
+    extra : list, optional
+        Names of more statistics to compute; see order_stats().
+
+    Returns
+    -------
+    dict from region_stats()
+
+    """
+    if mask is not None:
+        index = index.subset(mask)
+    sums = []
+    chunkstats = dict([(name, []) for name in extra])
+    for start, block in iter_frames(source, chunkframes):
+        _check_voxels(index, block)
+        if not start:
+            first = block[:, 0].copy()
+        sums.append(index.sums(block))
+        if extra:
+            # Statistics are computed frame by frame, so chunks can be
+            # put back together
+            for name, stat in order_stats(index, block, extra).items():
+                chunkstats[name].append(stat)
+    stats = dict([(name, np.hstack(chunks)) for name, chunks in chunkstats.items()])
+    return _stats(index, np.hstack(sums), first, stats)
+
+def _check_voxels(index, data):
+    """Make sure source data has as many voxels as the index."""
+    if data.shape[0] != index.n_voxels:
+        raise ValueError("Source image has %d voxels but the atlas has %d"
+                         % (data.shape[0], index.n_voxels))
+
+def _stats(index, sums, first, extra=None):
+    """Return the region_stats() dict from region sums and the first frame."""
+    counts = index.counts()
+    totals = index.totals()
+    denom = np.where(totals > 0, totals, 1)
+    avgwf = sums / denom[:, np.newaxis]
+
+    first = np.asarray(first, float)
+    mean = avgwf[:, 0].copy()
+    sqdev = index.sums(first ** 2) / denom - mean ** 2
+    # Unbiased with reliability weights: the total weight less the sum of
+    # squared weights over the total, which is counts - 1 without weights
+    if index.weights is None:
+        sqweights = counts.astype(float)
+    else:
+        sqweights = index._reduceat(np.add, index.weights ** 2)
+    dof = totals - sqweights / denom
+    std = np.sqrt(np.maximum(sqdev * totals / np.where(dof > 0, dof, 1), 0))
+    vmin = index.reduce(np.minimum, first)
+    vmax = index.reduce(np.maximum, first)
+    if extra is None:
+        extra = {}
+    return dict(avgwf=avgwf, counts=counts.astype(int), totals=totals,
+                mean=mean, std=std, min=vmin, max=vmax, extra=extra)
+
+def _source_stats(index, source, mask, cache, chunkframes, extra=()):
+    """Return region stats for a source file, streaming it if asked to."""
+    if chunkframes:
+        return stream_stats(index, source, chunkframes, mask, extra)
+    return region_stats(index, load_data(source, cache)[0], mask, extra)
+
+def _write_outputs(stats, avgwf, avgwfvol, statfiles):
+    """Write the average waveforms and any extra statistics."""
+    write_avgwf(avgwf, stats["avgwf"])
+    write_avgwfvol(avgwfvol, stats["avgwf"])
+    if statfiles:
+        for name, fname in statfiles.items():
+            write_avgwf(fname, stats["extra"][name])
+
+def write_avgwf(fname, avgwf):
+    """Write average waveforms (regions x frames) as mri_segstats --avgwf does."""
+    fid = open(fname, "w")
+    for frame in np.asarray(avgwf).T:
+        fid.write("".join(["%g " % value for value in frame]) + "\n")
+    fid.close()
+
+def write_avgwfvol(fname, avgwf):
+    """Write average waveforms as mri_segstats --avgwfvol does.
+
+    The image has one column per region and one frame per source frame.
+
+    """
+    avgwf = np.asarray(avgwf, np.float32)
+    vol = avgwf.reshape(avgwf.shape[0], 1, 1, avgwf.shape[1])
+    nib.save(nib.Nifti1Image(vol, np.eye(4)), fname)
+
+def write_sum(fname, ids, stats, sizes=None, source=None, seg=None):
+    """Write a region summary table as mri_segstats --sum does.
+
+    Parameters
+    ----------
+    fname : str
+    ids : list
+        Region ids, in table order.
+    stats : dict
+        Output of region_stats().
+    sizes : array, optional
+        Volume (or, for surfaces, area) of each region in mm; defaults
+        to the voxel counts.
+    source, seg : str, optional
+        Files named in the table header.
+
+    """
+    counts = stats["counts"]
+    if sizes is None:
+        sizes = counts
+    fid = open(fname, "w")
+    fid.write("# Title Segmentation Statistics \n")
+    fid.write("# generating_program pyroi native extraction\n")
+    if seg is not None:
+        fid.write("# SegVolFile %s \n" % seg)
+    if source is not None:
+        fid.write("# InVolFile  %s \n" % source)
+    fid.write("# NRows %d \n" % len(ids))
+    fid.write("# NTableCols 9 \n")
+    fid.write("# ColHeaders  Index SegId NVoxels Volume_mm3 "
+              "Mean StdDev Min Max Range  \n")
+    for i, id in enumerate(ids):
+        fid.write("%3d %3d %8d %10.1f  " % (i + 1, id, counts[i], sizes[i]))
+        fid.write("%10.4f %10.4f %10.4f %10.4f %10.4f \n"
+                  % (stats["mean"][i], stats["std"][i], stats["min"][i],
+                     stats["max"][i], stats["max"][i] - stats["min"][i]))
+    fid.close()
+
+def extract(seg, source, ids, avgwf, avgwfvol, summary, mask=None,
+            maskthresh=0, masksign="abs", cache=None, indexdir=None,
+            chunkframes=0, statfiles=None):
+    """Reduce a source image over the regions of a label image.
+
+    This is the native equivalent of::
+
+        mri_segstats --seg seg --i source --id ... [--mask mask ...]
+                     --avgwf avgwf --avgwfvol avgwfvol --sum summary
+
+    Parameters
+    ----------
+    seg : str or list
+        Label image, or a list of weight images (e.g. probability maps),
+        one for each region id, whose regions are averaged with weights.
+    source : str
+        Source image, in the same space as the label image.
+    ids : list
+        Region ids to extract.
+    avgwf, avgwfvol, summary : str
+        Output files.
+    mask : str, optional
+        Mask image, in the same space as the label image.
+    maskthresh : float, optional
+    masksign : "abs", "pos", or "neg", optional
+    cache : dict, optional
+        Images already loaded, passed on to load_data() for the source
+        and mask.
+    chunkframes : int, optional
+        If not 0, read the source this many frames at a time (see
+        stream_stats()) instead of loading it whole.
+    statfiles : dict, optional
+        More statistics to compute (see parse_stat()), mapped to the
+        files to write them to in the same format as avgwf.
+    indexdir : str, optional
+        Directory of saved region indexes; see region_index().
+
+    Returns
+    -------
+    dict from region_stats()
+
+    """
+    if isinstance(seg, str):
+        ids = sorted(ids)
+        segimg = nib.load(seg)
+        segname = seg
+    else:
+        # Keep each weight image with its region id
+        ids, seg = zip(*sorted(zip(ids, seg)))
+        segimg = nib.load(seg[0])
+        segname = " ".join(seg)
+    index = region_index(seg, ids, indexdir)
+    maskbool = None
+    if mask is not None:
+        maskbool = apply_mask(load_data(mask, cache)[0], maskthresh, masksign)
+    stats = _source_stats(index, source, maskbool, cache, chunkframes,
+                          sorted(statfiles or {}))
+    _write_outputs(stats, avgwf, avgwfvol, statfiles)
+    write_sum(summary, index.ids, stats, stats["totals"] * voxel_size(segimg),
+              source, segname)
+    return stats
+
+def write_max_labels(maps, ids, fname):
+    """Write a label image giving each voxel the region of its largest weight.
+
+    Parameters
+    ----------
+    maps : list of str
+        Weight images, one for each region.
+    ids : list
+        Region id of each weight image.
+    fname : str
+        Label image to write; voxels with no weight are 0.
+
+    """
+    best = None
+    for id, weightfile in zip(ids, maps):
+        weights, img = load_data(weightfile)
+        weights = weights[:, 0]
+        if best is None:
+            best = np.zeros(weights.shape)
+            labels = np.zeros(weights.shape, np.int32)
+        larger = weights > best
+        best[larger] = weights[larger]
+        labels[larger] = id
+    save_volume(labels.reshape(img.shape[:3]), img.get_affine(), fname)
+
+def _read_ints(fid, count=1):
+    """Read big-endian 32 bit integers from a Freesurfer binary file."""
+    return np.fromfile(fid, ">i4", count)
+
+def read_annot(fname):
+    """Return the colortable structure id of each vertex in an annotation.
+
+    nibabel's read_annot() gives each vertex the position of its label in
+    the colortable that is read back, which differs from the structure id
+    when the colortable has gaps (as with colortables made from a PyROI
+    look-up-table).  The structure ids are what mri_segstats uses as
+    segmentation ids, so this reads them from the file directly.
+
+    Returns
+    -------
+    int array with a structure id per vertex, -1 for unlabeled vertices
+
+    """
+    fid = open(fname, "rb")
+    try:
+        nvert = _read_ints(fid)[0]
+        pairs = _read_ints(fid, 2 * nvert).reshape(nvert, 2)
+        annot = np.zeros(nvert, int) - 1
+        annot[pairs[:, 0]] = pairs[:, 1]
+        codes = []
+        structs = []
+        tag = _read_ints(fid)
+        if len(tag) and tag[0] == 1:
+            nentries = _read_ints(fid)[0]
+            # Old colortables give the number of entries, which are
+            # numbered in order; new ones a negative version number and
+            # then the structure id of each entry
+            oldformat = nentries > 0
+            if not oldformat:
+                _read_ints(fid)
+            fid.read(_read_ints(fid)[0])
+            if not oldformat:
+                nentries = _read_ints(fid)[0]
+            for i in range(nentries):
+                struct = i
+                if not oldformat:
+                    struct = _read_ints(fid)[0]
+                fid.read(_read_ints(fid)[0])
+                r, g, b, t = _read_ints(fid, 4)
+                codes.append(r + g * 2 ** 8 + b * 2 ** 16)
+                structs.append(struct)
+    finally:
+        fid.close()
+
+    ids = np.zeros(nvert, int) - 1
+    if codes:
+        order = np.argsort(codes)
+        codes = np.asarray(codes)[order]
+        structs = np.asarray(structs)[order]
+        pos = np.minimum(np.searchsorted(codes, annot), len(codes) - 1)
+        ids = np.where(codes[pos] == annot, structs[pos], -1)
+    return ids
+
+def annot_index(annot, ids, segbase=0):
+    """Return the RegionIndex of the labels in an annotation.
+
+    Parameters
+    ----------
+    annot : str
+        Annotation file.
+    ids : list
+        Region ids to index.
+    segbase : int, optional
+        Number added to the colortable structure ids to make region ids;
+        see extract_surface().
+
+    """
+    labels = read_annot(annot)
+    labels = np.where(labels >= 0, labels + segbase, -1)
+    return RegionIndex(labels, ids)
+
+def vertex_areas(surface):
+    """Return the area of each vertex of a surface (a third of each face)."""
+    coords, faces = nib.freesurfer.read_geometry(surface)
+    edge1 = coords[faces[:, 1]] - coords[faces[:, 0]]
+    edge2 = coords[faces[:, 2]] - coords[faces[:, 0]]
+    cross = np.cross(edge1, edge2)
+    faceareas = np.sqrt((cross ** 2).sum(axis=1)) / 2
+    areas = np.zeros(coords.shape[0])
+    for corner in range(3):
+        areas += np.bincount(faces[:, corner], faceareas / 3, coords.shape[0])
+    return areas
+
+def extract_surface(annot, white, source, ids, avgwf, avgwfvol, summary,
+                    segbase=0, mask=None, maskthresh=0, masksign="abs",
+                    cache=None, chunkframes=0, statfiles=None):
+    """Reduce a surface overlay over the regions of an annotation.
+
+    This is the native equivalent of::
+
+        mri_segstats --annot subject hemi name --i source --id ... 
+                     [--mask mask ...] --avgwf avgwf --avgwfvol avgwfvol 
+                     --sum summary
+
+    Parameters
+    ----------
+    annot : str
+        Annotation file.
+    white : str
+        White surface of the same hemisphere, used for region areas.
+    source : str
+        Surface overlay (vertices x 1 x 1 x frames).
+    ids : list
+        Region ids to extract.
+    avgwf, avgwfvol, summary : str
+        Output files.
+    segbase : int, optional
+        Number added to the colortable structure ids to make region ids
+        (mri_segstats adds 1000/2000 for the lh/rh aparc annotation).
+    mask : str, optional
+        Surface mask overlay.
+    maskthresh : float, optional
+    masksign : "abs", "pos", or "neg", optional
+    cache : dict, optional
+        Images already loaded, passed on to load_data() for the source
+        and mask.
+    chunkframes : int, optional
+        If not 0, read the source this many frames at a time (see
+        stream_stats()) instead of loading it whole.
+    statfiles : dict, optional
+        More statistics to compute (see parse_stat()), mapped to the
+        files to write them to in the same format as avgwf.
+
+    Returns
+    -------
+    dict from region_stats()
+
+    """
+    index = annot_index(annot, sorted(ids), segbase)
+    maskbool = None
+    if mask is not None:
+        maskbool = apply_mask(load_data(mask, cache)[0], maskthresh, masksign)
+    stats = _source_stats(index, source, maskbool, cache, chunkframes,
+                          sorted(statfiles or {}))
+    areas = index.matrix(maskbool).dot(vertex_areas(white))
+    _write_outputs(stats, avgwf, avgwfvol, statfiles)
+    write_sum(summary, index.ids, stats, areas, source, annot)
+    return stats
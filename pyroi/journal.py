@@ -0,0 +1,141 @@
+"""
+Append-only journal of processing stages for resuming group runs.
+
+Each processing stage run by Atlas.process() (or by the group methods
+that make atlases, prepare source images, and extract) writes a line to
+the project journal (roi/analysis/<project>/journal) when it starts and
+another when it finishes or fails, with the subject, analysis, atlas,
+and how long it took.  Each line goes out in a single write to a file opened for
+appending, so entries from several processes never interleave and a
+crash can at worst lose the line being written.
+
+When a run is restarted, a stage whose last entry is a start (because
+the run died while it was going) or a failure is run again even if its
+output files exist, since they may only be partly written.  Stages whose
+last entry is done are left to the usual dependency checks.
+
+Classes
+-------
+Journal         :  Reads and appends to the project journal
+
+Functions
+---------
+project_journal :  Return the Journal for the configured project
+
+"""
+import os
+import time
+import socket
+
+import configinterface as cfg
+
+__all__ = ["Journal", "project_journal"]
+
+__module__ = "journal"
+
+_fields = ["time", "host", "pid", "subject", "analysis", "atlas",
+           "stage", "status", "duration"]
+
+class Journal(object):
+    """Project journal, optionally bound to a subject, analysis, and atlas."""
+    def __init__(self, journalfile, subject="", analysis="", atlas=""):
+        """
+        Parameters
+        ----------
+        journalfile : str
+            Path to the journal file; made if it does not exist.
+        subject : str, optional
+        analysis : str, optional
+        atlas : str, optional
+            Written with each entry.
+
+        """
+        self.journalfile = journalfile
+        self.subject = subject
+        self.analysis = analysis
+        self.atlas = atlas
+
+    def write(self, stage, status, duration=None):
+        """Append one entry to the journal.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage; this is the key used to find the entries
+            for a stage, so it should be unique within the project.
+        status : str
+            "start", "done", or "failed".
+        duration : float, optional
+            Seconds the stage took.
+
+        """
+        if duration is None:
+            duration = ""
+        else:
+            duration = "%.1f" % duration
+        values = [time.strftime("%Y-%m-%d %H:%M:%S"), socket.gethostname(),
+                  str(os.getpid()), self.subject, self.analysis, self.atlas,
+                  stage, status, duration]
+        line = "\t".join([str(v).replace("\t", " ") for v in values]) + "\n"
+        fd = os.open(self.journalfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def start(self, stage):
+        """Record that a stage started."""
+        self.write(stage, "start")
+
+    def finish(self, stage, ok, duration):
+        """Record that a stage finished (or failed, if ok is False)."""
+        if ok:
+            self.write(stage, "done", duration)
+        else:
+            self.write(stage, "failed", duration)
+
+    def entries(self):
+        """Return a list of dicts, one for each complete journal entry."""
+        if not os.path.isfile(self.journalfile):
+            return []
+        entries = []
+        for line in open(self.journalfile):
+            if not line.endswith("\n"):
+                # A write cut short by a crash
+                continue
+            values = line[:-1].split("\t")
+            if len(values) == len(_fields):
+                entries.append(dict(zip(_fields, values)))
+        return entries
+
+    def last_status(self):
+        """Return a dict mapping each stage to the status of its last entry."""
+        status = {}
+        for entry in self.entries():
+            status[entry["stage"]] = entry["status"]
+        return status
+
+    def unfinished(self):
+        """Return the set of stages that were started but never finished."""
+        return set([stage for stage, status in self.last_status().items()
+                    if status != "done"])
+
+
+def project_journal(subject="", analysis="", atlas=""):
+    """Return the Journal for the configured project.
+
+    Parameters
+    ----------
+    subject : str, optional
+    analysis : str, optional
+    atlas : str, optional
+        Written with each entry.
+
+    Returns
+    -------
+    Journal object
+
+    """
+    return Journal(os.path.join(cfg.setup.basepath, "roi", "analysis",
+                                cfg.projectname(), "journal"),
+                   subject, analysis, atlas)
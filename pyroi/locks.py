@@ -0,0 +1,187 @@
+"""
+File locks that work across processes and hosts.
+
+A lock is a file created with O_EXCL, which only one process can do at a
+time, holding the host and process id of its owner.  Processes waiting
+on a lock poll for it to go away.  If the owner of a lock died on the
+same host without removing it, the next process to wait on it removes
+it, so a crash does not leave a lock behind for good.  Whether an owner
+on another host is alive cannot be checked, so the owner touches its
+lock file while it holds it, and a lock from another host that has not
+been touched for maxage seconds is taken to be stale as well.
+
+A stale lock is only removed while holding a second lock, the lock file
+name with ".break" added, and after reading it again to make sure it is
+still the same file that was found stale.  Since nothing else removes a
+lock it does not own, a waiter that was slow to act never removes a lock
+another process has since taken.
+
+Classes
+-------
+FileLock      :  Exclusive lock held as a file
+
+Functions
+---------
+process_alive :  Return whether a process on this host is still running
+
+"""
+import os
+import time
+import errno
+import socket
+import threading
+
+__all__ = ["FileLock", "process_alive"]
+
+__module__ = "locks"
+
+# Seconds after which a break lock from another host is taken to be stale
+_break_maxage = 60.0
+
+def process_alive(pid):
+    """Return whether a process with this pid exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno == errno.EPERM
+    return True
+
+class FileLock(object):
+    """Exclusive lock held as a file.
+
+    Can be used in a with statement::
+
+        >>> with FileLock("/path/to/file.lock"):
+        ...     do_something()
+
+    """
+    def __init__(self, lockfile, poll=1.0, maxage=600.0):
+        """
+        Parameters
+        ----------
+        lockfile : str
+            Path to the lock file.
+        poll : float, optional
+            Seconds to wait between attempts to take the lock.
+        maxage : float, optional
+            Seconds after which a lock held from another host that its
+            owner has not touched is taken to be stale.  The owner touches
+            it every maxage / 4 seconds.  None never takes those locks to
+            be stale.
+
+        """
+        self.lockfile = lockfile
+        self.poll = poll
+        self.maxage = maxage
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.locked = False
+        self._released = None
+        self._toucher = None
+
+    def __enter__(self):
+
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.release()
+
+    def _read(self):
+        """Return the (owner, inode, mtime) of the lock file, or None."""
+        try:
+            fid = open(self.lockfile)
+        except IOError:
+            return None
+        try:
+            owner = fid.read().strip()
+            fstat = os.fstat(fid.fileno())
+        finally:
+            fid.close()
+        return owner, fstat.st_ino, fstat.st_mtime
+
+    def _stale(self, owner, mtime):
+        """Return whether the owner of a lock is known to be gone."""
+        host, sep, pid = owner.rpartition(":")
+        if host == socket.gethostname() and pid.isdigit():
+            return not process_alive(int(pid))
+        # Either another host, or a lock still being written
+        if self.maxage is None:
+            return False
+        return time.time() - mtime > self.maxage
+
+    def _remove_if_stale(self):
+        """Remove the lock file if its owner is gone.
+
+        Returns
+        -------
+        bool : whether the lock file may be gone now
+
+        """
+        found = self._read()
+        if found is None:
+            return True
+        if not self._stale(found[0], found[2]):
+            return False
+        # The break lock is held only for a moment, so it goes stale fast
+        breaker = FileLock("%s.break" % self.lockfile, self.poll,
+                           min(self.maxage or _break_maxage, _break_maxage))
+        if not breaker.acquire(blocking=False):
+            return False
+        try:
+            # Inodes can be reused at once, so compare the owner as well
+            if self._read() != found:
+                return True
+            os.remove(self.lockfile)
+            return True
+        finally:
+            breaker.release()
+
+    def _touch(self, released):
+        """Keep the lock file fresh until the lock is released."""
+        while not released.wait(self.maxage / 4.0):
+            try:
+                os.utime(self.lockfile, None)
+            except OSError:
+                pass
+
+    def acquire(self, blocking=True):
+        """Take the lock, waiting for it to be free if blocking is True.
+
+        Returns
+        -------
+        bool : whether the lock was taken
+
+        """
+        while True:
+            try:
+                fd = os.open(self.lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+                if self._remove_if_stale():
+                    continue
+                if not blocking:
+                    return False
+                time.sleep(self.poll)
+                continue
+            os.write(fd, self.owner)
+            os.close(fd)
+            self.locked = True
+            if self.maxage is not None:
+                self._released = threading.Event()
+                self._toucher = threading.Thread(target=self._touch,
+                                                 args=(self._released,))
+                self._toucher.setDaemon(True)
+                self._toucher.start()
+            return True
+
+    def release(self):
+        """Give up the lock."""
+        if self.locked:
+            self.locked = False
+            if self._released is not None:
+                self._released.set()
+                self._toucher.join()
+                self._released = None
+            os.remove(self.lockfile)
@@ -0,0 +1,482 @@
+"""
+Functions for running independent processing steps in parallel.
+
+Most of the group methods on atlas objects loop over a list of subjects,
+and the processing for each subject does not depend on any other subject.
+The functions in this module farm those per-subject calls out to a pool
+of worker processes and hand the results back in the order the calls
+were given, so the caller can merge them exactly as a serial loop would.
+With the "thread" pool (the ``pool`` config setting), the calls run in
+threads of this process on copies of the object instead, which is much
+lighter when each call mostly waits on short external programs; the
+``maxprocs`` setting then bounds how many of those programs run at once.
+
+Processing for a single subject is a chain of stages, but several of
+those stages only depend on some of the others (e.g. sampling the left
+and right hemispheres).  The TaskGraph class models those stages with
+the files they read and write and runs every stage whose inputs are
+ready at the same time.  Because it knows what each stage reads and
+writes, it can also drop the stages whose outputs are up to date (see
+the depends module) before running the rest.
+
+Classes
+-------
+Task         :  A processing stage with declared input and output files
+
+TaskGraph    :  Dependency graph of tasks with a parallel scheduler
+
+Functions
+---------
+map_calls    :  Call a list of object methods, possibly in parallel
+
+map_subjects :  Initialize an object for each subject and call a method
+
+"""
+import sys
+import time
+import threading
+import multiprocessing
+from copy import deepcopy
+from Queue import Queue
+
+import depends
+from core import RoiResult
+
+__all__ = ["Task", "TaskGraph", "map_calls", "map_subjects"]
+
+__module__ = "parallel"
+
+def _n_processes(n_jobs, n_calls):
+    """Turn an n_jobs argument into a number of worker processes."""
+    if n_jobs is None:
+        n_jobs = 1
+    elif n_jobs < 0:
+        n_jobs = max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return max(min(n_jobs, n_calls), 1)
+
+def _call(call):
+    """Execute one (object, method, args, kwargs) call.
+
+    This needs to be a module-level function so the pool can pickle it.
+
+    """
+    obj, method, args, kwargs = call
+    return getattr(obj, method)(*args, **kwargs)
+
+def _map_threads(calls, n_jobs):
+    """Run calls on copies of their objects and arguments in n_jobs threads."""
+    done = Queue()
+    results = {}
+    pending = list(enumerate(calls))
+    running = 0
+    error = None
+    next_index = 0
+
+    def worker(index, call):
+        # The arguments are copied too, since methods like init_analysis()
+        # change the analysis object they are passed; copying them with 
+        # the object keeps any references between them
+        obj, method, args, kwargs = call
+        try:
+            obj, args, kwargs = deepcopy((obj, args, kwargs))
+            done.put((index, _call((obj, method, args, kwargs)), None))
+        except Exception:
+            done.put((index, None, sys.exc_info()))
+
+    while pending or running:
+        while error is None and pending and running < n_jobs:
+            index, call = pending.pop(0)
+            thread = threading.Thread(target=worker, args=(index, call))
+            thread.setDaemon(True)
+            thread.start()
+            running += 1
+        if not running:
+            break
+        index, res, exc = done.get()
+        running -= 1
+        if exc is not None and error is None:
+            error = exc
+        results[index] = res
+        while error is None and next_index in results:
+            yield results.pop(next_index)
+            next_index += 1
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+def map_calls(calls, n_jobs=1, pool=None):
+    """Call a list of object methods and yield their results in order.
+
+    With more than one job, each call runs on its own copy of the object
+    and its arguments, so methods that reinitialize the object (e.g. with
+    a new subject) or change an argument (e.g. an analysis) do not 
+    interfere with each other.  Results are yielded in the order of
+    the call list as soon as they are ready.
+
+    Parameters
+    ----------
+    calls : list of tuples
+        Each tuple is (object, method name, args tuple, kwargs dict).
+    n_jobs : int, optional
+        Number of worker processes.  1 runs the calls serially in this
+        process (the default), and negative numbers count back from the
+        number of available cores (-1 uses all of them).
+    pool : "process" or "thread", optional
+        Run the calls in worker processes or in threads.  Defaults to the
+        ``pool`` execution setting of the first object.
+
+    Returns
+    -------
+    generator of method return values
+
+    """
+    n_jobs = _n_processes(n_jobs, len(calls))
+    if n_jobs == 1:
+        for call in calls:
+            yield _call(call)
+        return
+    if pool is None:
+        pool = calls[0][0]._option("pool")
+    if pool == "thread":
+        for res in _map_threads(calls, n_jobs):
+            yield res
+        return
+
+    pool = multiprocessing.Pool(n_jobs)
+    completed = False
+    try:
+        for res in pool.imap(_call, calls, 1):
+            yield res
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+def map_subjects(obj, subjects, method, args=(), kwargs=None, n_jobs=1,
+                 pool=None):
+    """Initialize an object for each subject and call one of its methods.
+
+    Parameters
+    ----------
+    obj : RoiBase object
+        Object with an init_subject() method.
+    subjects : list
+        List of subject ids.
+    method : str
+        Name of the method to call after initializing each subject.
+    args : tuple, optional
+        Positional arguments for the method.
+    kwargs : dict, optional
+        Keyword arguments for the method.
+    n_jobs : int, optional
+        See map_calls().
+    pool : "process" or "thread", optional
+        See map_calls().
+
+    Returns
+    -------
+    generator of method return values, in subject order
+
+    """
+    if kwargs is None:
+        kwargs = {}
+    calls = [(obj, "_call_for_subject", (subj, method) + tuple(args), kwargs)
+             for subj in subjects]
+    return map_calls(calls, n_jobs, pool)
+
+class Task(object):
+    """A processing stage with the files it reads and writes.
+
+    Tasks are connected through their files: a task depends on any task
+    in the same graph that lists one of its inputs as an output.  Inputs
+    that no task produces are assumed to exist already.
+
+    """
+    def __init__(self, name, func, args=(), kwargs=None,
+                 inputs=None, outputs=None, after=None):
+        """
+        Parameters
+        ----------
+        name : str
+            Name that is unique within a graph.
+        func : callable
+            Function run by the task; should return a RoiResult.
+        args : tuple, optional
+            Positional arguments for func.
+        kwargs : dict, optional
+            Keyword arguments for func.
+        inputs : list, optional
+            Files the task reads.
+        outputs : list, optional
+            Files the task writes.
+        after : list, optional
+            Names of tasks that have to finish first regardless of files.
+
+        """
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        if kwargs is None:
+            kwargs = {}
+        self.kwargs = kwargs
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.after = list(after or [])
+
+    def __repr__(self):
+
+        return "Task(%s)" % self.name
+
+    def run(self):
+        """Call the task function and return its result."""
+        return self.func(*self.args, **self.kwargs)
+
+
+class TaskGraph(object):
+    """Graph of tasks run in dependency order.
+
+    Tasks are kept in the order they were added, and the results of
+    run() are merged in that order no matter which task finished first,
+    so the returned RoiResult reads the same as a serial run.
+
+    """
+    def __init__(self, tasks=None):
+
+        self.tasks = []
+        self._tasks = {}
+        if tasks is not None:
+            for task in tasks:
+                self.add(task)
+
+    def __len__(self):
+
+        return len(self.tasks)
+
+    def __contains__(self, name):
+
+        return name in self._tasks
+
+    def add(self, task):
+        """Add a task to the graph.
+
+        A task with the name of one already in the graph, or that writes
+        exactly the same files as one already in the graph, is dropped, so
+        the same stage can be requested from several places and will
+        only be run once.
+
+        Returns
+        -------
+        Task object that is in the graph in its place
+
+        """
+        if task.name in self._tasks:
+            return self._tasks[task.name]
+        if task.outputs:
+            outputs = set(task.outputs)
+            for other in self.tasks:
+                if set(other.outputs) == outputs:
+                    return other
+        self.tasks.append(task)
+        self._tasks[task.name] = task
+        return task
+
+    def _producers(self):
+        """Map each output file to the name of the task that writes it."""
+        producers = {}
+        for task in self.tasks:
+            for fname in task.outputs:
+                producers[fname] = task.name
+        return producers
+
+    def dependencies(self, task, producers=None):
+        """Return the names of the tasks a task depends on."""
+        if producers is None:
+            producers = self._producers()
+        deps = set([producers[f] for f in task.inputs if f in producers])
+        deps.update([name for name in task.after if name in self._tasks])
+        deps.discard(task.name)
+        return deps
+
+    def _ordered(self):
+        """Return the tasks sorted so each comes after its dependencies."""
+        producers = self._producers()
+        deps = dict([(task.name, self.dependencies(task, producers))
+                     for task in self.tasks])
+        ordered = []
+        placed = set()
+        pending = list(self.tasks)
+        while pending:
+            ready = [t for t in pending if deps[t.name].issubset(placed)]
+            if not ready:
+                raise ValueError("Circular dependencies between tasks %s"
+                                 % pending)
+            for task in ready:
+                pending.remove(task)
+                ordered.append(task)
+                placed.add(task.name)
+        return ordered
+
+    def prune(self, method="mtime", rerun=None):
+        """Drop the tasks whose outputs are up to date.
+
+        A task is kept if any of its outputs are missing or stale with
+        respect to its inputs, or if it depends on a task that is kept,
+        since that task will rewrite some of its inputs.
+
+        Parameters
+        ----------
+        method : "mtime" or "digest", optional
+            How to tell whether an input changed; see depends.is_current().
+        rerun : set, optional
+            Names of tasks to keep regardless of their outputs (e.g. tasks
+            a journal shows were interrupted).
+
+        Returns
+        -------
+        list of the names of the tasks that were dropped
+
+        """
+        if rerun is None:
+            rerun = set()
+        producers = self._producers()
+        kept = set()
+        for task in self._ordered():
+            if (task.name in rerun or self.dependencies(task, producers) & kept or
+                    not depends.is_current(task.outputs, task.inputs, method)):
+                kept.add(task.name)
+        dropped = [task.name for task in self.tasks if task.name not in kept]
+        self.tasks = [task for task in self.tasks if task.name in kept]
+        self._tasks = dict([(task.name, task) for task in self.tasks])
+        return dropped
+
+    def update(self, n_jobs=1, force=False, depcheck="mtime", journal=None,
+               debug=False):
+        """Run the tasks whose outputs are out of date, make-style.
+
+        Parameters
+        ----------
+        n_jobs : int, optional
+            Maximum number of tasks to run at once.  Defaults to 1.
+        force : bool, optional
+            Run every task, whether or not its outputs are up to date.
+        depcheck : "mtime" or "digest", optional
+            How to tell whether an input changed; see prune().
+        journal : Journal object, optional
+            Journal to record the tasks in; tasks it shows were started
+            but never finished are run again.
+        debug : bool, optional
+            If True, do not record dependency stamps.
+
+        Returns
+        -------
+        RoiResult object
+
+        """
+        if not force:
+            rerun = None
+            if journal is not None:
+                rerun = journal.unfinished()
+            self.prune(depcheck, rerun)
+        if debug:
+            depcheck = None
+        return self.run(n_jobs, stamp=depcheck, journal=journal)
+
+    def run(self, n_jobs=1, stamp=None, journal=None):
+        """Run all tasks, with up to n_jobs independent tasks at once.
+
+        Tasks run in threads, which is enough to keep several external
+        programs going at once.  If a task raises, no new tasks are
+        started and the exception is raised once running tasks finish.
+        A task whose result lists failed commands (e.g. a program that
+        exited with an error) is not stamped or journaled as done, and
+        the tasks that depend on it are skipped, with the skip recorded
+        as a failure in the returned result.
+
+        Parameters
+        ----------
+        n_jobs : int, optional
+            Maximum number of tasks to run at once.  Defaults to 1.
+        stamp : "mtime" or "digest", optional
+            If given, record dependency stamps for the outputs of each
+            task that finishes so a later prune() can skip it.
+        journal : Journal object, optional
+            If given, record when each task starts and finishes.
+
+        Returns
+        -------
+        RoiResult object
+
+        """
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = 1
+        producers = self._producers()
+        deps = dict([(task.name, self.dependencies(task, producers))
+                     for task in self.tasks])
+        results = {}
+        failed = set()
+        pending = list(self.tasks)
+        running = 0
+        error = None
+        done = Queue()
+
+        def worker(task):
+            if journal is not None:
+                journal.start(task.name)
+            started = time.time()
+            try:
+                res = task.run()
+            except Exception:
+                if journal is not None:
+                    journal.finish(task.name, False, time.time() - started)
+                done.put((task.name, None, sys.exc_info(), False))
+            else:
+                ok = res is None or not getattr(res, "failed", None)
+                if journal is not None:
+                    journal.finish(task.name, ok, time.time() - started)
+                done.put((task.name, res, None, ok))
+
+        while pending or running:
+            if error is None:
+                skipped = True
+                while skipped:
+                    skipped = [t for t in pending if deps[t.name] & failed]
+                    for task in skipped:
+                        pending.remove(task)
+                        failed.add(task.name)
+                        msg = "Skipped %s: %s failed" % (
+                            task.name, ", ".join(sorted(deps[task.name] & failed)))
+                        results[task.name] = RoiResult(msg)
+                        results[task.name].fail(msg)
+                ready = [t for t in pending if deps[t.name].issubset(results)]
+                for task in ready[:n_jobs - running]:
+                    pending.remove(task)
+                    running += 1
+                    thread = threading.Thread(target=worker, args=(task,))
+                    thread.setDaemon(True)
+                    thread.start()
+            if not running:
+                if error is None and pending:
+                    raise ValueError("Circular dependencies between tasks %s"
+                                     % pending)
+                break
+            name, res, exc, ok = done.get()
+            running -= 1
+            if exc is not None and error is None:
+                error = exc
+            elif not ok:
+                failed.add(name)
+            elif exc is None and stamp is not None:
+                task = self._tasks[name]
+                depends.record(task.outputs, task.inputs, stamp)
+            results[name] = res
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+        result = RoiResult()
+        for task in self.tasks:
+            if results[task.name] is not None:
+                result(results[task.name])
+        return result
@@ -0,0 +1,211 @@
+"""
+Process every analysis with every atlas in a project at once.
+
+Processing a subject for one analysis and one atlas involves stages that
+do not depend on the atlas at all: registering the mean functional
+image, concatenating the beta images, and sampling them to the surface
+depend only on the paradigm, the subject, and the kind of image being
+extracted.  Running Atlas.group_process() in a loop over atlases repeats
+those stages for each one.  The Project class instead puts the stages of
+every analysis and atlas for a subject into one TaskGraph, where stages
+with the same name or the same output files collapse into a single task,
+so each unique stage runs once.
+
+Classes
+-------
+Project     :  Plans and runs the processing for a set of analyses and atlases
+
+Functions
+---------
+run_project :  Process every analysis with every atlas for a group
+
+"""
+from copy import copy
+
+import configinterface as cfg
+import source
+import parallel
+import journal
+from atlases import init_atlas
+from database import build_database
+from core import RoiBase, RoiResult
+
+__all__ = ["Project", "run_project"]
+
+__module__ = "project"
+
+class Project(RoiBase):
+    """Processing plan for a set of analyses and atlases."""
+    def __init__(self, analyses=None, atlases=None, **kwargs):
+        """
+        Parameters
+        ----------
+        analyses : list, optional
+            Analysis indices, dicts, or Analysis objects.  Defaults to
+            every analysis in the config file.
+        atlases : list, optional
+            Atlas names or dicts.  Defaults to every atlas in the config
+            file except sphere atlases, which cannot be processed yet.
+        kwargs :
+            Options such as debug passed on to the atlas objects.
+
+        """
+        RoiBase.__init__(self, **kwargs)
+        if analyses is None:
+            analyses = range(1, len(cfg.analysis()) + 1)
+        self.analyses = []
+        for analysis in analyses:
+            if isinstance(analysis, dict) or isinstance(analysis, int):
+                analysis = source.Analysis(analysis)
+            self.analyses.append(analysis)
+        if atlases is None:
+            atlasdicts = cfg.atlases()
+            atlases = [name for name in sorted(atlasdicts)
+                       if atlasdicts[name]["source"] != "sphere"]
+        self.atlases = atlases
+
+    def plan(self, subject, shared_atlas=True):
+        """Return the graph of unique stages that process one subject.
+
+        Parameters
+        ----------
+        subject : str
+            Subject ID
+        shared_atlas : bool, optional
+            If False, leave out making the standard-space atlases; see
+            Atlas.process().
+
+        Returns
+        -------
+        TaskGraph object
+
+        """
+        graph = parallel.TaskGraph()
+        for analysis in self.analyses:
+            for atlasname in self.atlases:
+                atlas = init_atlas(atlasname, **self._runopts())
+                atlas.init_paradigm(analysis.paradigm)
+                atlas.init_subject(subject)
+                # Each atlas points its analysis at its own images
+                for task in atlas._process_tasks(copy(analysis), shared_atlas):
+                    graph.add(task)
+        return graph
+
+    def _shares_atlas(self):
+        """Return whether any atlas writes files shared by every subject."""
+        for atlasname in self.atlases:
+            atlas = init_atlas(atlasname, **self._runopts())
+            if atlas.source == "sigsurf" or atlas.space == "standard":
+                return True
+        return False
+
+    def process(self, subject, force=False, n_jobs=1, shared_atlas=True):
+        """Process one subject for every analysis and atlas.
+
+        Stages whose outputs are up to date are skipped as in
+        Atlas.process().
+
+        Parameters
+        ----------
+        subject : str
+            Subject ID
+        force : bool, optional
+            Run every stage even if its outputs are up to date.
+        n_jobs : int, optional
+            Number of independent stages to run at once.  Defaults to 1.
+        shared_atlas : bool, optional
+            If False, leave out making the standard-space atlases.
+
+        Returns
+        -------
+        RoiResult object
+
+        """
+        graph = self.plan(subject, shared_atlas)
+        jrnl = None
+        if self._option("journal") and not self.debug:
+            jrnl = journal.project_journal(subject)
+        return graph.update(n_jobs, force, self._option("depcheck"), jrnl,
+                            self.debug)
+
+    def group_process(self, subjects=None, force=False, n_jobs=1, stage_jobs=1):
+        """Process a group for every analysis and atlas.
+
+        Parameters
+        ----------
+        subjects : None, string or list
+            If None, runs all subjects defined in the config file.  If a
+            string, runs the group defined by that name.  If a list, runs
+            the each subject defined in that list.  None by default.
+        force : bool, optional
+            Run every stage even if its outputs are up to date.
+        n_jobs : int, optional
+            Number of subjects to process at once.  -1 uses all available
+            cores.  Defaults to 1 (serial).  If any atlas is a SigSurf or
+            standard-space atlas, the first subject runs on its own so 
+            the files those atlases share exist before the rest start, 
+            as in Atlas.group_process().
+        stage_jobs : int, optional
+            Number of independent stages to run at once for each subject.
+            Defaults to 1.
+
+        Returns
+        -------
+        RoiResult object
+
+        """
+        if subjects is None:
+            subjects = cfg.subjects()
+        elif isinstance(subjects, str):
+            subjects = cfg.subjects(subjects)
+        result = RoiResult()
+        calls = [(self, "process", (subj, force, stage_jobs), {})
+                 for subj in subjects]
+        if calls and self._shares_atlas():
+            res = self.process(*calls[0][2])
+            print res
+            result(res)
+            calls = [(obj, method, args + (False,), kwargs)
+                     for obj, method, args, kwargs in calls[1:]]
+        for res in parallel.map_calls(calls, n_jobs):
+            print res
+            result(res)
+        if not self.debug:
+            for analysis in self.analyses:
+                for atlasname in self.atlases:
+                    res = build_database(atlasname, analysis.dict, subjects)
+                    print res
+                    result(res)
+        return result
+
+def run_project(analyses=None, atlases=None, subjects=None, force=False,
+                n_jobs=1, stage_jobs=1, **kwargs):
+    """Process every analysis with every atlas for a group.
+
+    Each stage shared between analyses or atlases (e.g. registration,
+    beta concatenation, or surface sampling) runs once per subject.
+
+    Parameters
+    ----------
+    analyses : list, optional
+        Analyses to run; defaults to all of them.
+    atlases : list, optional
+        Atlases to run; defaults to all of them.
+    subjects : None, string or list
+        Subjects to run; see Project.group_process().
+    force : bool, optional
+        Run every stage even if its outputs are up to date.
+    n_jobs : int, optional
+        Number of subjects to process at once.
+    stage_jobs : int, optional
+        Number of independent stages to run at once for each subject.
+    kwargs :
+        Options such as debug passed on to the atlas objects.
+
+    Returns
+    -------
+    RoiResult object
+
+    """
+    project = Project(analyses, atlases, **kwargs)
+    return project.group_process(subjects, force, n_jobs, stage_jobs)
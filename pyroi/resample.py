@@ -0,0 +1,493 @@
+"""
+Native resampling between functional, anatomical, and surface space.
+
+Bringing a Freesurfer volume atlas into the space of a subject's
+functional data takes an mri_vol2vol run per atlas, each of which reads
+the registration and both images and computes the same voxel lookup
+again.  The functions here do the nearest neighbour resampling in
+process: the tkregister registration and the two image geometries give
+a voxel-to-voxel affine, and the anatomical voxel under each functional
+voxel is found for the whole grid at once.  The lookup depends only on
+the registration and the geometries, not on the labels, so it is kept in
+memory and reused for every atlas with the same subject and paradigm.
+
+Sampling functional images to the surface works the same way.  The
+voxels mri_vol2surf --projfrac-avg reads for each vertex depend only on
+the surfaces, the registration, and the functional grid, so they are
+written once as a sparse vertices x voxels matrix (see vol2surf_matrix())
+and every image with the same geometry is sampled with one sparse
+product, however many frames it has.
+
+Labels are brought from fsaverage to a subject's surface through the
+nearest vertices on the spherical registration surfaces, as
+mri_label2label --regmethod surface does.  The nearest neighbour maps
+between the two spheres are found once per subject and hemisphere with
+a KD-tree (see sphere_maps()) and used for every label.
+
+Functions
+---------
+read_regmat     :  Read the matrix from a tkregister registration file
+
+tkr_vox2ras     :  Return the tkregister vox2ras matrix of an image
+
+vol2vol_index   :  Return the anatomical voxel under each functional voxel
+
+resample_labels :  Resample a label image into functional space
+
+vertex_normals  :  Return the unit normal of each vertex of a surface
+
+build_vol2surf  :  Make the sparse projfrac-avg sampling matrix of a surface
+
+vol2surf_matrix :  Return the sampling matrix of a surface, reusing one
+                   saved on disk when possible
+
+sample_to_surface : Sample a functional image to the surface with a
+                    sampling matrix
+
+sphere_maps     :  Return the nearest vertex maps between two registered
+                   spheres
+
+map_labels      :  Resample labels from one surface to another
+
+"""
+import os
+import threading
+from hashlib import sha1
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+import cache as cmdcache
+from extraction import load_data, iter_frames, save_volume, _build_lock, _save_npz
+from clusters import read_label, write_label
+
+__all__ = ["read_regmat", "tkr_vox2ras", "vol2vol_index", "resample_labels",
+           "vertex_normals", "build_vol2surf", "vol2surf_matrix",
+           "sample_to_surface", "sphere_maps", "map_labels"]
+
+__module__ = "resample"
+
+def read_regmat(fname):
+    """Read the matrix from a tkregister registration file.
+
+    Parameters
+    ----------
+    fname : str
+        Path to a register.dat style file.
+
+    Returns
+    -------
+    4 x 4 array mapping anatomical to functional tkregister RAS
+
+    """
+    lines = [line.split() for line in open(fname) if line.strip()]
+    try:
+        regmat = np.array(lines[4:8], float)
+    except ValueError:
+        raise ValueError("%s is not a tkregister registration file" % fname)
+    if regmat.shape != (4, 4):
+        raise ValueError("%s is not a tkregister registration file" % fname)
+    return regmat
+
+def tkr_vox2ras(img):
+    """Return the tkregister vox2ras matrix of an image.
+
+    This depends only on the dimensions and voxel sizes of the image,
+    as in Freesurfer.
+
+    Parameters
+    ----------
+    img : nibabel image
+
+    Returns
+    -------
+    4 x 4 array
+
+    """
+    nc, nr, ns = img.shape[:3]
+    dc, dr, ds = img.get_header().get_zooms()[:3]
+    return np.array([[-dc, 0, 0, dc * nc / 2.],
+                     [0, 0, ds, -ds * ns / 2.],
+                     [0, -dr, 0, dr * nr / 2.],
+                     [0, 0, 0, 1]])
+
+# Entries kept in each in-memory cache below.  Run over a group in
+# threads, each subject in flight needs its own; older ones are read back
+# from their saved files (or built again) if they are needed again.
+_cache_size = 8
+
+# Lookups already computed, by registration and image geometries
+_maps = OrderedDict()
+_maps_lock = threading.Lock()
+
+def _cache_get(cache, key):
+    """Return a cached value and mark it as recently used, or None."""
+    _maps_lock.acquire()
+    try:
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+    finally:
+        _maps_lock.release()
+
+def _cache_put(cache, key, value):
+    """Cache a value, dropping the least recently used past _cache_size."""
+    _maps_lock.acquire()
+    try:
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > _cache_size:
+            cache.popitem(last=False)
+    finally:
+        _maps_lock.release()
+
+def vol2vol_index(regmat, movimg, targimg):
+    """Return the anatomical voxel under each functional voxel.
+
+    This is the lookup ``mri_vol2vol --inv --interp nearest`` does.  The
+    last few are kept in memory and reused for other calls with the same
+    registration and image geometries, as long as the registration and
+    the functional image have not changed on disk.
+
+    Parameters
+    ----------
+    regmat : str
+        tkregister registration from the functional (mov) image to the
+        anatomical (targ) image.
+    movimg : str
+        Functional image that sets the output grid.
+    targimg : nibabel image
+        Anatomical image to sample.
+
+    Returns
+    -------
+    (index, shape) tuple : index is the flat (C order) voxel of targimg
+    for each functional voxel in C order, or -1 outside of targimg, and
+    shape is the functional grid shape
+
+    """
+    targshape = targimg.shape[:3]
+    key = (regmat, os.path.getmtime(regmat), movimg, os.path.getmtime(movimg),
+           targshape, tuple(targimg.get_header().get_zooms()[:3]))
+    found = _cache_get(_maps, key)
+    if found is not None:
+        return found
+
+    mov = nib.load(movimg)
+    movshape = mov.shape[:3]
+    # func vox -> func tkRAS -> anat tkRAS -> anat vox
+    vox2vox = np.dot(np.linalg.inv(tkr_vox2ras(targimg)),
+                     np.dot(np.linalg.inv(read_regmat(regmat)), tkr_vox2ras(mov)))
+    grid = np.indices(movshape).reshape(3, -1).astype(float)
+    crs = np.dot(vox2vox[:3, :3], grid) + vox2vox[:3, 3:]
+    crs = np.floor(crs + .5).astype(int)
+    inside = np.all((crs >= 0) & (crs < np.array(targshape)[:, None]), axis=0)
+    index = np.empty(crs.shape[1], int)
+    index.fill(-1)
+    index[inside] = np.ravel_multi_index(crs[:, inside], targshape)
+
+    _cache_put(_maps, key, (index, movshape))
+    return index, movshape
+
+def resample_labels(targ, movimg, regmat, fname):
+    """Resample a label image into functional space.
+
+    Gives the same output as::
+
+        mri_vol2vol --mov movimg --targ targ --reg regmat --inv \\
+            --interp nearest --o fname
+
+    Parameters
+    ----------
+    targ : str
+        Label image in anatomical space (e.g. aseg.mgz).
+    movimg : str
+        Functional image that sets the output grid and affine.
+    regmat : str
+        tkregister registration from movimg to targ.
+    fname : str
+        Output image.
+
+    """
+    targimg = nib.load(targ)
+    index, shape = vol2vol_index(regmat, movimg, targimg)
+    labels = np.asarray(targimg.get_data()).reshape(targimg.shape[:3]).ravel()
+    out = np.zeros(len(index), labels.dtype)
+    inside = index >= 0
+    out[inside] = labels[index[inside]]
+    save_volume(out.reshape(shape), nib.load(movimg).get_affine(), fname)
+
+def vertex_normals(coords, faces):
+    """Return the unit normal of each vertex of a surface.
+
+    The normal of a vertex is the mean of the unit normals of the faces
+    around it.
+
+    """
+    normals = np.cross(coords[faces[:, 1]] - coords[faces[:, 0]],
+                       coords[faces[:, 2]] - coords[faces[:, 0]])
+    normals /= np.maximum(np.sqrt((normals ** 2).sum(axis=1)), 1e-12)[:, None]
+    vertnormals = np.zeros(coords.shape)
+    for corner in range(3):
+        for axis in range(3):
+            vertnormals[:, axis] += np.bincount(faces[:, corner], normals[:, axis],
+                                                coords.shape[0])
+    lengths = np.sqrt((vertnormals ** 2).sum(axis=1))
+    return vertnormals / np.maximum(lengths, 1e-12)[:, None]
+
+def build_vol2surf(regmat, volimg, white, thickness, fracs):
+    """Make the sparse projfrac-avg sampling matrix of a surface.
+
+    Each vertex is sampled at the nearest voxel to each point a fraction
+    of the cortical thickness out along its normal from the white
+    surface, and its value is the mean over the points.  Points outside
+    the volume count as zero, as in mri_vol2surf.
+
+    Parameters
+    ----------
+    regmat : str
+        tkregister registration from the functional image to the
+        subject's anatomy.
+    volimg : nibabel image
+        Functional image that sets the voxel grid.
+    white : str
+        White surface.
+    thickness : str
+        Thickness overlay of the same hemisphere.
+    fracs : sequence of floats
+        Fractions of the thickness to sample at.
+
+    Returns
+    -------
+    (counts, n_samples) tuple : counts is a vertices x voxels
+    scipy.sparse.csr_matrix of how many points of each vertex fall in
+    each voxel (voxels in C order), and the matrix divided by n_samples
+    gives the mean over points
+
+    """
+    coords, faces = nib.freesurfer.read_geometry(white)
+    thick = nib.freesurfer.read_morph_data(thickness)
+    normals = vertex_normals(coords, faces)
+    shape = volimg.shape[:3]
+    # anat tkRAS -> func tkRAS -> func vox
+    ras2vox = np.dot(np.linalg.inv(tkr_vox2ras(volimg)), read_regmat(regmat))
+    n_verts = coords.shape[0]
+    rows, cols = [], []
+    for frac in fracs:
+        points = coords + normals * (thick * frac)[:, None]
+        crs = np.dot(points, ras2vox[:3, :3].T) + ras2vox[:3, 3]
+        crs = np.floor(crs + .5).astype(int)
+        inside = np.all((crs >= 0) & (crs < np.array(shape)), axis=1)
+        rows.append(np.arange(n_verts)[inside])
+        cols.append(np.ravel_multi_index(crs[inside].T, shape))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    counts = sparse.coo_matrix((np.ones(len(rows), np.uint8), (rows, cols)),
+                               shape=(n_verts, int(np.prod(shape)))).tocsr()
+    counts.sum_duplicates()
+    return counts, len(fracs)
+
+# Matrices already loaded, by matrix file
+_matrices = OrderedDict()
+
+def vol2surf_matrix(regmat, volume, white, thickness, fracs, matrixdir=None):
+    """Return the projfrac-avg sampling matrix of a surface.
+
+    Parameters
+    ----------
+    regmat, white, thickness, fracs :
+        See build_vol2surf().
+    volume : str
+        Functional image that sets the voxel grid.
+    matrixdir : str, optional
+        Directory of saved matrices.  If given, the matrix is looked up
+        by the digests of the registration and the surface files and by
+        the voxel grid and fractions, built and saved there if it is not
+        found, and the last few are kept in memory.  Otherwise it is
+        always built.
+
+    Returns
+    -------
+    vertices x voxels scipy.sparse.csr_matrix of sampling weights
+
+    """
+    volimg = nib.load(volume)
+    fracs = [float(frac) for frac in fracs]
+    if matrixdir is None:
+        counts, n_samples = build_vol2surf(regmat, volimg, white, thickness, fracs)
+        return counts.astype(float) / n_samples
+    key = sha1(cmdcache.file_digest(regmat))
+    key.update(cmdcache.file_digest(white))
+    key.update(cmdcache.file_digest(thickness))
+    key.update(repr((volimg.shape[:3], volimg.get_header().get_zooms()[:3], fracs)))
+    matrixfile = os.path.join(matrixdir, "%s.npz" % key.hexdigest())
+    lock = _build_lock(matrixfile)
+    lock.acquire()
+    try:
+        matrix = _cache_get(_matrices, matrixfile)
+        if matrix is not None:
+            return matrix
+        if os.path.isfile(matrixfile):
+            arrays = np.load(matrixfile)
+            counts = sparse.csr_matrix(
+                (arrays["counts"], arrays["indices"], arrays["indptr"]),
+                shape=tuple(arrays["shape"]))
+            n_samples = int(arrays["n_samples"])
+        else:
+            counts, n_samples = build_vol2surf(regmat, volimg, white, thickness, fracs)
+            if not os.path.isdir(matrixdir):
+                try:
+                    os.makedirs(matrixdir)
+                except OSError:
+                    # Made by another process in the meantime
+                    pass
+            _save_npz(matrixfile, counts=counts.data,
+                      indices=counts.indices.astype(np.int32),
+                      indptr=counts.indptr.astype(np.int32),
+                      shape=np.array(counts.shape), n_samples=n_samples)
+        matrix = counts.astype(float) / n_samples
+        _cache_put(_matrices, matrixfile, matrix)
+        return matrix
+    finally:
+        lock.release()
+
+def sample_to_surface(matrix, source, fname, chunkframes=0):
+    """Sample a functional image to the surface with a sampling matrix.
+
+    Writes a vertices x 1 x 1 x frames overlay, as mri_vol2surf does
+    with --noreshape.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        Sampling matrix from vol2surf_matrix() for the grid of source.
+    source : str
+        Functional image.
+    fname : str
+        Output overlay.
+    chunkframes : int, optional
+        If greater than 0, read the source this many frames at a time.
+
+    """
+    img = nib.load(source)
+    if int(np.prod(img.shape[:3])) != matrix.shape[1]:
+        raise ValueError("%s does not have the voxel grid of the sampling matrix"
+                         % source)
+    if chunkframes:
+        n_frames = (tuple(img.shape) + (1,))[3]
+        out = np.zeros((matrix.shape[0], n_frames), np.float32)
+        for start, block in iter_frames(source, chunkframes):
+            out[:, start:start + block.shape[1]] = matrix.dot(block)
+    else:
+        data = load_data(source)[0]
+        out = np.asarray(matrix.dot(data.astype(float)), np.float32)
+    save_volume(out.reshape(out.shape[0], 1, 1, out.shape[1]), np.eye(4), fname)
+
+# Sphere maps already loaded, by map file or sphere files
+_spheremaps = OrderedDict()
+
+def _build_sphere_maps(srcsphere, trgsphere):
+    """Find the nearest target vertex of each source vertex and vice versa."""
+    srccoords = nib.freesurfer.read_geometry(srcsphere)[0]
+    trgcoords = nib.freesurfer.read_geometry(trgsphere)[0]
+    forward = cKDTree(trgcoords).query(srccoords)[1]
+    reverse = cKDTree(srccoords).query(trgcoords)[1]
+    return forward.astype(np.int32), reverse.astype(np.int32)
+
+def sphere_maps(srcsphere, trgsphere, mapdir=None):
+    """Return the nearest vertex maps between two registered spheres.
+
+    Parameters
+    ----------
+    srcsphere, trgsphere : str
+        ?h.sphere.reg of the source (e.g. fsaverage) and target subject.
+    mapdir : str, optional
+        Directory of saved maps.  If given, the maps are looked up by
+        the digests of the sphere files, and built and saved there if
+        they are not found.  Either way the last few are kept in memory.
+
+    Returns
+    -------
+    (forward, reverse) tuple : the nearest target vertex of each source
+    vertex and the nearest source vertex of each target vertex
+
+    """
+    if mapdir is None:
+        mapfile = (srcsphere, os.path.getmtime(srcsphere),
+                   trgsphere, os.path.getmtime(trgsphere))
+    else:
+        key = sha1(cmdcache.file_digest(srcsphere))
+        key.update(cmdcache.file_digest(trgsphere))
+        mapfile = os.path.join(mapdir, "%s.npz" % key.hexdigest())
+    lock = _build_lock(mapfile)
+    lock.acquire()
+    try:
+        maps = _cache_get(_spheremaps, mapfile)
+        if maps is not None:
+            return maps
+        if mapdir is not None and os.path.isfile(mapfile):
+            arrays = np.load(mapfile)
+            maps = arrays["forward"], arrays["reverse"]
+        else:
+            maps = _build_sphere_maps(srcsphere, trgsphere)
+            if mapdir is not None:
+                if not os.path.isdir(mapdir):
+                    try:
+                        os.makedirs(mapdir)
+                    except OSError:
+                        # Made by another process in the meantime
+                        pass
+                _save_npz(mapfile, forward=maps[0], reverse=maps[1])
+        _cache_put(_spheremaps, mapfile, maps)
+        return maps
+    finally:
+        lock.release()
+
+def map_labels(labels, trglabels, srcsphere, trgsphere, trgwhite, subject,
+               mapdir=None):
+    """Resample labels from one surface to another.
+
+    This is the native equivalent of running::
+
+        mri_label2label --srcsubject fsaverage --srclabel label \
+            --trgsubject subject --hemi hemi --regmethod surface \
+            --trglabel trglabel
+
+    for each label.  A target vertex is in the label if the label has a
+    source vertex whose nearest target vertex it is, or if its own
+    nearest source vertex is in the label, so the resampled label has no
+    holes when the target surface is denser than the source.
+
+    Parameters
+    ----------
+    labels : list
+        Source label files.
+    trglabels : list
+        Output label files, one for each source label.
+    srcsphere, trgsphere, mapdir :
+        See sphere_maps().
+    trgwhite : str
+        White surface of the target subject, for the label coordinates.
+    subject : str
+        Target subject.
+
+    """
+    forward, reverse = sphere_maps(srcsphere, trgsphere, mapdir)
+    trgcoords = nib.freesurfer.read_geometry(trgwhite)[0]
+    for label, trglabel in zip(labels, trglabels):
+        vertices, values = read_label(label)
+        srcvalues = np.zeros(len(forward))
+        inlabel = np.zeros(len(forward), bool)
+        srcvalues[vertices] = values
+        inlabel[vertices] = True
+        trgvalues = srcvalues[reverse]
+        trgvalues[forward[vertices]] = values
+        hit = inlabel[reverse]
+        hit[forward[vertices]] = True
+        trgvertices = np.nonzero(hit)[0]
+        write_label(trglabel, trgvertices, trgcoords[trgvertices],
+                    trgvalues[trgvertices], subject)
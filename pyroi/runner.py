@@ -0,0 +1,422 @@
+"""
+Concurrent runner for external programs.
+
+External programs are started without blocking the caller, and a
+semaphore shared by every runner in the process limits how many of them
+are running at once (the ``maxprocs`` config setting).  This lets one
+Python process keep many short Freesurfer programs in flight from
+several threads (see the "thread" pool in the parallel module) without
+starting more of them than the machine can hold.
+
+The output of each program is read line by line as it is written, so it
+can be streamed into a logging RoiResult while the program is running
+rather than all at once when it exits.
+
+Programs differ a lot in how much memory they need (bbregister and
+mri_vol2vol hold whole volumes, mri_segstats very little), so a runner
+can also be given a memory budget (the ``memlimit`` config setting).
+The peak resident memory of each program is measured when it exits and
+remembered by program name, and a program is only started when its
+remembered peak fits in what is left of the budget.  A program that has
+not been measured yet runs one copy at a time until it has been, and 
+holds a default reservation meanwhile.
+
+The budget covers every PyROI process of a project on one host, not just
+one process, so the workers of a process pool share it rather than each
+admitting the whole limit.  The reservations of running programs are
+kept in a ledger file next to the memory profile, updated under a file
+lock, and reservations left by processes that died are dropped.
+
+Classes
+-------
+Runner       :  Starts external programs under a shared concurrency limit
+
+Command      :  Handle to a program started by a Runner
+
+MemoryBudget :  Admits programs against a memory limit using their
+                measured peak memory
+
+"""
+import os
+import sys
+import json
+import socket
+import threading
+import subprocess
+from copy import deepcopy
+
+from locks import FileLock, process_alive
+
+__all__ = ["Runner", "Command", "MemoryBudget"]
+
+__module__ = "runner"
+
+# One semaphore per concurrency limit, shared by all runners in the process
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+# Likewise one memory budget per limit and profile file
+_budgets = {}
+
+# Megabytes reserved for a program whose peak has not been measured
+_unmeasured_mb = 1000
+
+def _semaphore(max_procs):
+    """Return the shared semaphore for a concurrency limit (or None)."""
+    if not max_procs:
+        return None
+    _semaphores_lock.acquire()
+    try:
+        if max_procs not in _semaphores:
+            _semaphores[max_procs] = threading.BoundedSemaphore(max_procs)
+        return _semaphores[max_procs]
+    finally:
+        _semaphores_lock.release()
+
+def _budget(memlimit, profile):
+    """Return the shared memory budget for a limit (or None)."""
+    if not memlimit:
+        return None
+    _semaphores_lock.acquire()
+    try:
+        if (memlimit, profile) not in _budgets:
+            ledger = None
+            if profile is not None and os.path.isdir(os.path.dirname(profile)):
+                ledger = "%s.%s.ledger" % (profile, socket.gethostname())
+            _budgets[(memlimit, profile)] = MemoryBudget(memlimit, profile, ledger)
+        return _budgets[(memlimit, profile)]
+    finally:
+        _semaphores_lock.release()
+
+def _tool_name(cmdline):
+    """Return the name of the program a command line runs."""
+    words = cmdline.split()
+    if not words:
+        return ""
+    return os.path.basename(words[0])
+
+def _maxrss_mb(rusage):
+    """Return the peak resident memory in a rusage struct in megabytes."""
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss / float(1 << 20)
+    return rusage.ru_maxrss / 1024.
+
+class MemoryBudget(object):
+    """Admits programs against a memory limit.
+
+    Programs that are running hold a reservation of their remembered
+    peak memory, or of a default amount if they have not been measured.
+    Peaks can be kept in a profile file so they carry over from one 
+    session to the next, and reservations in a ledger file so that every
+    process using the same ledger shares the budget.
+
+    """
+    def __init__(self, memlimit, profile=None, ledger=None, poll=0.2):
+        """
+        Parameters
+        ----------
+        memlimit : float
+            Memory budget in megabytes.
+        profile : str, optional
+            JSON file to read and save the peak memory of each program.
+        ledger : str, optional
+            JSON file holding the reservations of all processes on this
+            host that share the budget.  Without one the budget only
+            covers this process.
+        poll : float, optional
+            Seconds between looks at the ledger while waiting for room.
+
+        """
+        self.memlimit = memlimit
+        self.profile = profile
+        self.ledger = ledger
+        self.poll = poll
+        self.peaks = {}
+        self._load_peaks()
+        self._entries = {}
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def _load_peaks(self):
+        """Merge in the peaks another process may have saved."""
+        if self.profile is None or not os.path.isfile(self.profile):
+            return
+        try:
+            peaks = json.load(open(self.profile))
+        except (IOError, ValueError):
+            return
+        for tool, peak in peaks.items():
+            if peak > self.peaks.get(tool, 0):
+                self.peaks[tool] = peak
+
+    def _read_ledger(self):
+        """Return the reservations of live processes, by key."""
+        if self.ledger is None:
+            return self._entries
+        try:
+            entries = json.load(open(self.ledger))
+        except (IOError, ValueError):
+            return {}
+        return dict([(key, entry) for key, entry in entries.items()
+                     if process_alive(entry[2])])
+
+    def _write_ledger(self, entries):
+        """Replace the reservations in the ledger."""
+        if self.ledger is None:
+            self._entries = entries
+            return
+        tmpfile = "%s.%d" % (self.ledger, os.getpid())
+        fid = open(tmpfile, "w")
+        json.dump(entries, fid)
+        fid.close()
+        os.rename(tmpfile, self.ledger)
+
+    def _locked(self, func, *args):
+        """Call a function that reads and writes the ledger, under its lock."""
+        if self.ledger is None:
+            return func(*args)
+        lock = FileLock("%s.lock" % self.ledger, self.poll / 4)
+        lock.acquire()
+        try:
+            return func(*args)
+        finally:
+            lock.release()
+
+    def reservation(self, tool):
+        """Return the megabytes a program reserves while it runs."""
+        return self.peaks.get(tool, _unmeasured_mb)
+
+    def _admissible(self, tool, entries):
+        """Return whether a program can start now."""
+        if not entries:
+            return True
+        if tool not in self.peaks and tool in [e[0] for e in entries.values()]:
+            return False
+        reserved = sum([e[1] for e in entries.values()])
+        return reserved + self.reservation(tool) <= self.memlimit
+
+    def _try_reserve(self, tool):
+        """Reserve memory for a program if it fits; return the key or None."""
+        self._load_peaks()
+        entries = self._read_ledger()
+        if not self._admissible(tool, entries):
+            return None
+        self._count += 1
+        key = "%d-%d-%d" % (os.getpid(), id(self), self._count)
+        entries[key] = [tool, self.reservation(tool), os.getpid()]
+        self._write_ledger(entries)
+        return key
+
+    def _unreserve(self, key):
+        """Drop a reservation from the ledger."""
+        entries = self._read_ledger()
+        entries.pop(key, None)
+        self._write_ledger(entries)
+
+    def acquire(self, tool):
+        """Wait until a program fits in the budget and reserve its memory.
+
+        Returns
+        -------
+        str : key of the reservation, to hand back to release()
+
+        """
+        self._cond.acquire()
+        try:
+            while True:
+                key = self._locked(self._try_reserve, tool)
+                if key is not None:
+                    return key
+                # Programs finishing in other processes don't notify
+                if self.ledger is None:
+                    self._cond.wait()
+                else:
+                    self._cond.wait(self.poll)
+        finally:
+            self._cond.release()
+
+    def release(self, tool, key, peak=None):
+        """Return a program's reservation and record its measured peak."""
+        self._cond.acquire()
+        try:
+            self._locked(self._unreserve, key)
+            if peak is not None and peak > self.peaks.get(tool, 0):
+                self.peaks[tool] = peak
+                self._save()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _save(self):
+        """Write the peaks to the profile file."""
+        if self.profile is None:
+            return
+        self._load_peaks()
+        tmpfile = "%s.%d" % (self.profile, os.getpid())
+        try:
+            fid = open(tmpfile, "w")
+            json.dump(self.peaks, fid)
+            fid.close()
+            os.rename(tmpfile, self.profile)
+        except (IOError, OSError):
+            pass
+
+class Command(object):
+    """Handle to an external program started by a Runner.
+
+    The stdout, stderr, returncode, and peak_memory (in megabytes)
+    attributes are filled in once the program exits; use wait() to block
+    until then.
+
+    """
+    def __init__(self, cmdline, result=None):
+
+        self.cmdline = cmdline
+        self.result = result
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.peak_memory = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+
+        return "Command(%s)" % self.cmdline
+
+    def done(self):
+        """Return whether the program has exited."""
+        return self._done.isSet()
+
+    def wait(self):
+        """Wait for the program to exit.
+
+        Returns
+        -------
+        (stdout, stderr, returncode) tuple
+
+        """
+        self._done.wait()
+        return self.stdout, self.stderr, self.returncode
+
+    def _read(self, pipe, lines):
+        """Collect lines from a pipe, streaming them to the result log."""
+        for line in iter(pipe.readline, ""):
+            lines.append(line)
+            if self.result is not None:
+                self.result.stream(line)
+        pipe.close()
+
+    def _execute(self, semaphore, budget, env):
+        """Run the program; called in its own thread."""
+        tool = _tool_name(self.cmdline)
+        holding = False
+        reservation = None
+        try:
+            if semaphore is not None:
+                semaphore.acquire()
+                holding = True
+            if budget is not None:
+                try:
+                    reservation = budget.acquire(tool)
+                except (IOError, OSError), err:
+                    # e.g. the ledger could not be locked or written
+                    self.stdout, self.stderr, self.returncode = "", str(err), -1
+                    return
+            if self.result is not None:
+                self.result.stream("%s\n" % self.cmdline)
+            try:
+                proc = subprocess.Popen(self.cmdline,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        env=env,
+                                        shell=True)
+            except OSError, err:
+                self.stdout, self.stderr, self.returncode = "", str(err), -1
+                return
+            outlines, errlines = [], []
+            readers = [threading.Thread(target=self._read, args=(proc.stdout, outlines)),
+                       threading.Thread(target=self._read, args=(proc.stderr, errlines))]
+            for reader in readers:
+                reader.setDaemon(True)
+                reader.start()
+            for reader in readers:
+                reader.join()
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                proc.returncode = os.WEXITSTATUS(status)
+            self.returncode = proc.returncode
+            self.peak_memory = _maxrss_mb(rusage)
+            self.stdout = "".join(outlines)
+            self.stderr = "".join(errlines)
+        finally:
+            if reservation is not None:
+                budget.release(tool, reservation, self.peak_memory)
+            if holding:
+                semaphore.release()
+            if self.result is not None:
+                self.result.add_streamed(self.cmdline, [self.stdout, self.stderr])
+            self._done.set()
+
+
+class Runner(object):
+    """Starts external programs with a limit on how many run at once."""
+    def __init__(self, max_procs=0, memlimit=0, profile=None):
+        """
+        Parameters
+        ----------
+        max_procs : int, optional
+            Maximum number of programs started by any runner with the same
+            limit that can be running at once.  0 (the default) means no
+            limit.
+        memlimit : float, optional
+            Memory budget in megabytes shared by runners with the same 
+            budget and profile, in this and any other process on the host
+            that uses the same profile.  0 (the default) means no budget.
+        profile : str, optional
+            File to keep the measured peak memory of each program in.
+
+        """
+        self.max_procs = max_procs
+        self._semaphore = _semaphore(max_procs)
+        self._budget = _budget(memlimit, profile)
+
+    def start(self, cmdline, result=None):
+        """Start a command line in the background.
+
+        The program waits for a free slot if the concurrency limit is
+        reached or it does not fit in the memory budget, but this returns
+        right away either way.
+
+        Parameters
+        ----------
+        cmdline : str
+            Command line, run with the shell.
+        result : RoiResult or Log object, optional
+            If given, the command line and each line of output are written
+            to its log file as they happen, and the command is added to
+            the result when it exits.
+
+        Returns
+        -------
+        Command object
+
+        """
+        command = Command(cmdline, result)
+        thread = threading.Thread(target=command._execute,
+                                  args=(self._semaphore, self._budget,
+                                        deepcopy(os.environ.data)))
+        thread.setDaemon(True)
+        thread.start()
+        return command
+
+    def run(self, cmdline, result=None):
+        """Run a command line and wait for it to exit.
+
+        Returns
+        -------
+        (stdout, stderr, returncode) tuple
+
+        """
+        return self.start(cmdline, result).wait()
@@ -41,6 +41,8 @@ import configinterface as cfg
 import treeutils as tree
 from exceptions import *
 import core
+import extraction
+import resample
 from core import RoiBase, RoiResult
 
 __all__ = ["Analysis", "FirstLevelStats", 
@@ -83,6 +85,15 @@ class Analysis(RoiBase):
                 self.masksign = "abs"
         else:
             self.mask = False
+        if "stats" in analysis.keys():
+            self.stats = list(analysis["stats"])
+            for stat in self.stats:
+                try:
+                    extraction.parse_stat(stat)
+                except ValueError, err:
+                    raise SetupError(str(err))
+        else:
+            self.stats = []
 
 
 class FirstLevelStats(RoiBase):
@@ -112,6 +123,8 @@ class FirstLevelStats(RoiBase):
         """Concatenate the first level statistic images."""
         if not self._init_subject:
             raise InitError("Subject")
+        if self._option("engine") == "native":
+            return self._native_concatenate()
         
         result = RoiResult()
         if hasattr(self, "_n_sessions") and self._n_sessions > 1:
@@ -122,14 +135,55 @@ class FirstLevelStats(RoiBase):
             cmd.append("--i %s"%f)
         cmd.append("--o %s"%self.extractvol)
 
-        self._run(cmd)
-        if hasattr(self, "_avgtempdir"):
-            shutil.rmtree(self._avgtempdir)
+        avgdir = self.__dict__.pop("_avgtempdir", None)
+        result(self._run(cmd, self.extractlist, [self.extractvol], avgdir))
+        if avgdir is not None and os.path.isdir(avgdir):
+            shutil.rmtree(avgdir)
         return result
 
+    def _native_concatenate(self):
+        """Concatenate and average the stat images in process.
+
+        The frames come out in the same order as with mri_concat: the
+        images in the extract list, then the mean over sessions of each
+        image averaged across sessions.  The means are never written to
+        disk.
+
+        """
+        groups = [[f] for f in self.extractlist]
+        if hasattr(self, "_n_sessions") and self._n_sessions > 1:
+            groups.extend(self._avgsource)
+        desc = "native concat"
+        for group in groups:
+            if len(group) == 1:
+                desc = "%s --i %s" % (desc, group[0])
+            else:
+                desc = "%s --mean %s" % (desc, " ".join(group))
+        desc = "%s --o %s" % (desc, self.extractvol)
+        if not self.debug:
+            extraction.concatenate(groups, self.extractvol)
+        return RoiResult(desc)
+
     def make_avg_betas(self):
-        """Create the average parameter estimate images."""
-        self._avgtempdir = mkdtemp()
+        """Create the average parameter estimate images.
+        
+        Each run writes the averages to its own temporary directory in
+        the subject's stat directory, so runs for the same subject in
+        other processes never touch them.  The directory is left out of
+        the cache keys (see RoiBase._manual_run()), and concatenate()
+        removes it once the averages are in the extraction volume.
+
+        """
+        if self.debug:
+            self._avgtempdir = os.path.join(self.roistatdir, "avg")
+        else:
+            if not os.path.isdir(self.roistatdir):
+                try:
+                    os.makedirs(self.roistatdir)
+                except OSError:
+                    if not os.path.isdir(self.roistatdir):
+                        raise
+            self._avgtempdir = mkdtemp(prefix="avg", dir=self.roistatdir)
         result = RoiResult()
         for i, sourcelist in enumerate(self._avgsource):
             avgimg = os.path.join(self._avgtempdir,"avg-%d.mgz"%i)
@@ -141,19 +195,32 @@ class FirstLevelStats(RoiBase):
             cmd.append("--mean")
             cmd.append("--o %s"%avgimg)
 
-            result(self._run(cmd))
+            result(self._run(cmd, sourcelist, [avgimg], self._avgtempdir))
         return result
 
-    def sample_to_surface(self):
-        """Sample an extraction volume to the surface."""
+    def sample_to_surface(self, hemis=None):
+        """Sample an extraction volume to the surface.
+        
+        Parameters
+        ----------
+        hemis : list, optional
+            Hemispheres to sample to.  Both by default.
+
+        """
         if not self._init_subject:
             raise InitError("Subject")
         if not os.path.isfile(self.regmat) and not self.debug:
             raise PreprocessError(self.regmat)
+        if hemis is None:
+            hemis = ["lh", "rh"]
 
         res = RoiResult()
+        if self._option("engine") == "native":
+            for hemi in hemis:
+                res(self._native_sample(hemi))
+            return res
 
-        for hemi in ["lh","rh"]:
+        for hemi in hemis:
             cmd = ["mri_vol2surf"]    
             cmd.append("--mov %s" % self.extractvol)
             cmd.append("--o %s" % self.extractsurf % hemi)
@@ -162,11 +229,39 @@ class FirstLevelStats(RoiBase):
             cmd.append("--projfrac-avg 0 1 .1")
             cmd.append("--noreshape")
 
-            result = self._run(cmd)
+            surfdir = os.path.join(cfg.fssubjdir(), self.subject, "surf")
+            surfs = [os.path.join(surfdir, "%s.%s" % (hemi, surf)) 
+                     for surf in ["white", "thickness"]]
+            result = self._run(cmd, [self.extractvol, self.regmat] + surfs,
+                               [self.extractsurf % hemi])
             res(result)
 
         return res
 
+    def _native_sample(self, hemi):
+        """Sample to one hemisphere in process instead of with mri_vol2surf.
+
+        The sampling matrix depends only on the subject, paradigm, and
+        hemisphere, so it is saved in the registration directory and
+        shared by every image sampled with the same registration.
+
+        """
+        surfdir = os.path.join(cfg.fssubjdir(), self.subject, "surf")
+        white, thickness = [os.path.join(surfdir, "%s.%s" % (hemi, surf))
+                            for surf in ["white", "thickness"]]
+        desc = ("native vol2surf --mov %s --o %s --reg %s --hemi %s "
+                "--projfrac-avg 0 1 .1 --noreshape" % (
+                    self.extractvol, self.extractsurf % hemi, self.regmat, hemi))
+        if not self.debug:
+            matrix = resample.vol2surf_matrix(
+                self.regmat, self.extractvol, white, thickness,
+                np.linspace(0, 1, 11),
+                os.path.join(os.path.dirname(self._regtreepath), "vol2surf"))
+            resample.sample_to_surface(matrix, self.extractvol,
+                                       self.extractsurf % hemi,
+                                       self._option("chunkframes"))
+        return RoiResult(desc)
+
     def group_concatenate(self, subjects=None):
         """Concatenate stat images for a group of subjects."""
         if subjects is None:
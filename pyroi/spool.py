@@ -0,0 +1,461 @@
+"""
+Job spool on a shared filesystem for running commands on several hosts.
+
+With the ``backend = "spool"`` config setting, the command lines PyROI
+would run are instead written as job files into a spool directory (by
+default roi/analysis/<project>/spool), and the calling process waits for
+a worker to run them.  Workers are started on any host that can see the
+spool directory with ``pyroi worker``, and can come and go while jobs
+are queued.
+
+The spool directory has six subdirectories::
+
+    tmp/      job and result files being written
+    new/      jobs waiting to be run
+    claimed/  jobs a worker is running
+    done/     results waiting to be collected by the submitter
+    failed/   jobs a worker could not run or report on
+    workers/  a heartbeat file for each running worker
+
+Every step from one directory to the next is a rename, which is atomic
+on a local or NFS filesystem, so exactly one worker claims each job
+without any locking.  A job is only claimed once none of its input files
+are outputs of another job that is still waiting or running.
+
+Running workers touch their heartbeat file every few seconds.  A
+submitter whose job has sat unclaimed for a while with no live worker,
+or whose job's worker has stopped beating, takes the job back rather
+than waiting forever: it requeues a job whose worker died and withdraws
+one nobody is there to run, reporting it as failed.
+
+Classes
+-------
+Spool  :  Submits jobs to and claims jobs from a spool directory
+
+Worker :  Runs the jobs in a spool directory
+
+"""
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import traceback
+import subprocess
+from copy import deepcopy
+
+from locks import process_alive
+
+__all__ = ["Spool", "Worker"]
+
+__module__ = "spool"
+
+# Environment variables that are sent along with each job
+_job_environ = ["SUBJECTS_DIR"]
+
+# Seconds between worker heartbeats
+_heartbeat = 5.
+
+class Spool(object):
+    """Job spool in a directory that several hosts can share."""
+    def __init__(self, spooldir):
+        """
+        Parameters
+        ----------
+        spooldir : str
+            Spool directory; made with its subdirectories if needed.
+
+        """
+        self.spooldir = os.path.abspath(spooldir)
+        self.tmpdir = os.path.join(self.spooldir, "tmp")
+        self.newdir = os.path.join(self.spooldir, "new")
+        self.claimdir = os.path.join(self.spooldir, "claimed")
+        self.donedir = os.path.join(self.spooldir, "done")
+        self.faildir = os.path.join(self.spooldir, "failed")
+        self.workerdir = os.path.join(self.spooldir, "workers")
+        for path in [self.spooldir, self.tmpdir, self.newdir, self.claimdir,
+                     self.donedir, self.faildir, self.workerdir]:
+            if not os.path.isdir(path):
+                try:
+                    os.mkdir(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+        self._count = 0
+
+    def _new_id(self):
+        """Return a job id that sorts by submission time."""
+        self._count += 1
+        return "%.6f-%s-%d-%d" % (time.time(), socket.gethostname(),
+                                  os.getpid(), self._count)
+
+    def _write(self, job, dest):
+        """Write a job dict to a file via the tmp directory."""
+        tmpfile = os.path.join(self.tmpdir, os.path.basename(dest))
+        fid = open(tmpfile, "w")
+        json.dump(job, fid)
+        fid.close()
+        os.rename(tmpfile, dest)
+
+    def _read(self, fname):
+        """Return the job dict in a file, or None if it is gone."""
+        try:
+            fid = open(fname, "r")
+        except IOError:
+            return None
+        try:
+            return json.load(fid)
+        finally:
+            fid.close()
+
+    def _jobs(self, path):
+        """Return the job dicts in one of the spool subdirectories."""
+        jobs = []
+        for fname in sorted(os.listdir(path)):
+            job = self._read(os.path.join(path, fname))
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+    def submit(self, cmdline, inputs=None, outputs=None):
+        """Add a command line to the spool.
+
+        Parameters
+        ----------
+        cmdline : str
+            Command line, run with the shell in the submitter's working
+            directory.
+        inputs : list, optional
+            Files the command reads.
+        outputs : list, optional
+            Files the command writes.
+
+        Returns
+        -------
+        str : job id
+
+        """
+        jobid = self._new_id()
+        env = dict([(name, os.environ[name]) for name in _job_environ
+                    if name in os.environ])
+        job = dict(id=jobid, cmdline=cmdline, cwd=os.getcwd(), env=env,
+                   inputs=[os.path.abspath(f) for f in inputs or []],
+                   outputs=[os.path.abspath(f) for f in outputs or []],
+                   submitted=time.time(), submitter=socket.gethostname())
+        self._write(job, os.path.join(self.newdir, "%s.json" % jobid))
+        return jobid
+
+    def heartbeat(self, worker):
+        """Mark a worker as alive."""
+        fname = os.path.join(self.workerdir, worker)
+        open(fname, "a").close()
+        os.utime(fname, None)
+
+    def retire(self, worker):
+        """Remove the heartbeat of a worker that is stopping."""
+        try:
+            os.remove(os.path.join(self.workerdir, worker))
+        except OSError:
+            pass
+
+    def live_workers(self, within):
+        """Return the names of workers that beat in the last within seconds."""
+        live = []
+        now = time.time()
+        for worker in os.listdir(self.workerdir):
+            try:
+                beat = os.path.getmtime(os.path.join(self.workerdir, worker))
+            except OSError:
+                continue
+            if now - beat <= within:
+                live.append(worker)
+        return live
+
+    def withdraw(self, jobid):
+        """Take a job out of the spool if no worker has claimed it yet.
+
+        Returns
+        -------
+        bool : whether the job was withdrawn
+
+        """
+        try:
+            os.remove(os.path.join(self.newdir, "%s.json" % jobid))
+        except OSError:
+            return False
+        return True
+
+    def _requeue_orphan(self, jobid, within):
+        """Put a claimed job back if its worker has not beat lately."""
+        fname = "%s.json" % jobid
+        job = self._read(os.path.join(self.claimdir, fname))
+        # A job just renamed into claimed/ has not been stamped with its
+        # worker yet, and a worker gets within seconds to start beating
+        if (job is None or "worker" not in job
+            or time.time() - job["claimed"] <= within
+            or job["worker"] in self.live_workers(within)):
+            return
+        try:
+            os.rename(os.path.join(self.claimdir, fname),
+                      os.path.join(self.newdir, fname))
+        except OSError:
+            pass
+
+    def wait(self, jobid, poll=1.0, unclaimed=None):
+        """Wait for a job to finish and collect its result.
+
+        Parameters
+        ----------
+        jobid : str
+        poll : float, optional
+            Seconds between looks for the result.
+        unclaimed : float, optional
+            Give up on the job once it has gone this many seconds with
+            no live worker to run it.  A job claimed by a worker that
+            has stopped beating for that long is put back in the queue.
+            Waits forever if None (the default).
+
+        Returns
+        -------
+        dict with returncode, stdout, stderr, and worker keys; a
+        withdrawn job has a returncode of -1
+
+        """
+        donefile = os.path.join(self.donedir, "%s.json" % jobid)
+        started = time.time()
+        if unclaimed is not None:
+            # Don't take a worker for dead between two of its beats
+            alive = max(unclaimed, 2 * _heartbeat)
+        while True:
+            result = self._read(donefile)
+            if result is not None:
+                os.remove(donefile)
+                return result
+            if unclaimed is not None:
+                self._requeue_orphan(jobid, alive)
+                if (time.time() - started > unclaimed
+                    and not self.live_workers(alive)
+                    and self.withdraw(jobid)):
+                    return dict(id=jobid, returncode=-1, stdout="", worker=None,
+                                stderr="No worker took job %s from %s in %g "
+                                       "seconds; is `pyroi worker` running?\n"
+                                       % (jobid, self.spooldir, unclaimed))
+            time.sleep(poll)
+
+    def call(self, cmdline, inputs=None, outputs=None, poll=1.0, unclaimed=None):
+        """Submit a command line and wait for its result.
+
+        See wait() for the meaning of unclaimed.
+
+        Returns
+        -------
+        (stdout, stderr, returncode) tuple
+
+        """
+        result = self.wait(self.submit(cmdline, inputs, outputs), poll, unclaimed)
+        return (result["stdout"].encode("utf-8"),
+                result["stderr"].encode("utf-8"),
+                result["returncode"])
+
+    def claim(self, worker):
+        """Claim the oldest job whose inputs are not waiting on another job.
+
+        Parameters
+        ----------
+        worker : str
+            Name of the claiming worker, recorded in the claimed job.
+
+        Returns
+        -------
+        dict, or None if there are no runnable jobs
+
+        """
+        waiting = self._jobs(self.newdir)
+        running = self._jobs(self.claimdir)
+        pending = set()
+        for job in waiting + running:
+            pending.update(job["outputs"])
+        for job in waiting:
+            if pending.intersection(job["inputs"]):
+                continue
+            fname = "%s.json" % job["id"]
+            claimed = os.path.join(self.claimdir, fname)
+            try:
+                os.rename(os.path.join(self.newdir, fname), claimed)
+            except OSError:
+                # Another worker got there first
+                continue
+            job["worker"] = worker
+            job["host"] = socket.gethostname()
+            job["pid"] = os.getpid()
+            job["claimed"] = time.time()
+            self._write(job, claimed)
+            return job
+        return None
+
+    def finish(self, job, returncode, stdout="", stderr=""):
+        """Hand the result of a claimed job back to its submitter.
+
+        Output that is not valid UTF-8 has the bad bytes replaced.  Only
+        raises if the result could not be written.
+
+        """
+        if isinstance(stdout, str):
+            stdout = stdout.decode("utf-8", "replace")
+        if isinstance(stderr, str):
+            stderr = stderr.decode("utf-8", "replace")
+        fname = "%s.json" % job["id"]
+        result = dict(id=job["id"], returncode=returncode,
+                      stdout=stdout, stderr=stderr, worker=job.get("worker"))
+        self._write(result, os.path.join(self.donedir, fname))
+        try:
+            os.remove(os.path.join(self.claimdir, fname))
+        except OSError:
+            # A submitter that took this worker for dead put the job back
+            # in the queue; take it out so that it does not run again
+            self.withdraw(job["id"])
+
+    def fail(self, job, message):
+        """Report a claimed job as failed and move it to failed/.
+
+        Used when a worker cannot run a job or hand back its result, so
+        that the job does not sit in claimed/ with its submitter waiting.
+
+        """
+        fname = "%s.json" % job["id"]
+        result = dict(id=job["id"], returncode=-1, stdout=u"",
+                      stderr=message.decode("utf-8", "replace"),
+                      worker=job.get("worker"))
+        self._write(result, os.path.join(self.donedir, fname))
+        try:
+            os.rename(os.path.join(self.claimdir, fname),
+                      os.path.join(self.faildir, fname))
+        except OSError:
+            pass
+
+    def recover(self):
+        """Put back jobs claimed by workers on this host that have died.
+
+        Returns
+        -------
+        list of the ids of the jobs that were put back
+
+        """
+        host = socket.gethostname()
+        recovered = []
+        for job in self._jobs(self.claimdir):
+            if job.get("host") != host or process_alive(job.get("pid", 0)):
+                continue
+            fname = "%s.json" % job["id"]
+            try:
+                os.rename(os.path.join(self.claimdir, fname),
+                          os.path.join(self.newdir, fname))
+            except OSError:
+                continue
+            recovered.append(job["id"])
+        return recovered
+
+
+class Worker(object):
+    """Runs jobs from a spool directory until told to stop."""
+    def __init__(self, spooldir, name=None, poll=1.0):
+        """
+        Parameters
+        ----------
+        spooldir : str
+            Spool directory shared with the submitting processes.
+        name : str, optional
+            Name used to identify this worker in job results.  Defaults
+            to host:pid.
+        poll : float, optional
+            Seconds to wait between looks at the spool when it is empty.
+
+        """
+        self.spooldir = spooldir
+        self.name = name
+        self.poll = poll
+        self._stopped = threading.Event()
+
+    def run_job(self, job):
+        """Run one job and return (stdout, stderr, returncode)."""
+        env = deepcopy(os.environ.data)
+        env.update(job.get("env", {}))
+        proc = subprocess.Popen(job["cmdline"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=job.get("cwd"),
+                                env=env,
+                                shell=True)
+        stdout, stderr = proc.communicate()
+        return stdout, stderr, proc.returncode
+
+    def run(self, max_jobs=None, idle=None, verbose=False):
+        """Claim and run jobs.
+
+        Parameters
+        ----------
+        max_jobs : int, optional
+            Stop after running this many jobs.
+        idle : float, optional
+            Stop after this many seconds without finding a job.  Runs
+            until killed if None (the default).
+        verbose : bool, optional
+            Print each command line as it is run.
+
+        Returns
+        -------
+        int : number of jobs run
+
+        """
+        spool = Spool(self.spooldir)
+        name = self.name
+        if name is None:
+            name = "%s:%d" % (socket.gethostname(), os.getpid())
+        for jobid in spool.recover():
+            if verbose:
+                print "Requeued job %s from a dead worker" % jobid
+        # Keep beating while a long job runs
+        spool.heartbeat(name)
+        self._stopped.clear()
+        beater = threading.Thread(target=self._beat, args=(spool, name))
+        beater.daemon = True
+        beater.start()
+        n_run = 0
+        idle_since = time.time()
+        try:
+            while max_jobs is None or n_run < max_jobs:
+                job = spool.claim(name)
+                if job is None:
+                    if idle is not None and time.time() - idle_since > idle:
+                        break
+                    time.sleep(self.poll)
+                    continue
+                if verbose:
+                    print job["cmdline"]
+                    sys.stdout.flush()
+                try:
+                    stdout, stderr, returncode = self.run_job(job)
+                except Exception, err:
+                    stdout, stderr, returncode = "", str(err), -1
+                try:
+                    spool.finish(job, returncode, stdout, stderr)
+                except Exception:
+                    # No result was written, so report the job as failed
+                    spool.fail(job, "Worker %s failed on this job:\n%s"
+                               % (name, traceback.format_exc()))
+                n_run += 1
+                idle_since = time.time()
+        finally:
+            self._stopped.set()
+            beater.join()
+            spool.retire(name)
+        return n_run
+
+    def _beat(self, spool, name):
+        """Touch the worker's heartbeat file until run() stops."""
+        while not self._stopped.wait(_heartbeat):
+            try:
+                spool.heartbeat(name)
+            except (IOError, OSError):
+                pass
@@ -9,6 +9,7 @@ you don't feel comfortable enough with the directory structure to use shell util
 """
 
 import os
+import errno
 import shutil
 
 import configinterface as cfg
@@ -22,6 +23,22 @@ __all__ = ["trim_analysis_tree", "make_analysis_tree",
 
 __module__ = "treeutils"
 
+def _make_dirs(dirlist):
+    """Make each directory in a list that does not exist yet.
+
+    Directories are made in list order, so parents should come first.
+    Parallel processes may be building the same tree, so a directory
+    that appears between the check and the mkdir is not an error.
+
+    """
+    for direct in dirlist:
+        if not os.path.isdir(direct):
+            try:
+                os.mkdir(direct)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+
 def trim_analysis_tree(analysis):
     """Remove a analysis tree and all of its contents.
     
@@ -51,9 +68,7 @@ def make_project_base_tree():
     dbhistdir = os.path.join(dbdir, ".old")
 
     projdirs = [roidir, analysisdir, projdir, logdir, logarcdir, dbdir, dbhistdir]
-    for direct in projdirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(projdirs)
 
 def make_analysis_tree(analysis):
     """Set up the directory tree for an analysis.
@@ -91,9 +106,7 @@ def make_analysis_tree(analysis):
                 resdir = os.path.join(atlasdir, res)
                 analdirs.append(resdir)
 
-    for direct in analdirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(analdirs)
 
 def make_levelone_tree():
     """Setup the tree for level one data that will be extracted."""
@@ -114,9 +127,7 @@ def make_levelone_tree():
                 subjdir = os.path.join(pardir, subj)
                 l1dirs.append(subjdir)
 
-    for direct in l1dirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(l1dirs)
 
 def make_fs_atlas_tree(atlas=None, subject=None):
     """Setup the Freesurfer atlas tree."""
@@ -158,9 +169,7 @@ def make_fs_atlas_tree(atlas=None, subject=None):
                         atnamedir = os.path.join(subjdir, atlasdict["atlasname"])
                         fsdirs.append(atnamedir)
                     
-    for direct in fsdirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(fsdirs)
 
 def make_reg_tree():
     """Setup the registration tree."""
@@ -176,9 +185,7 @@ def make_reg_tree():
             subjdir = os.path.join(pardir, subj)
             regdirs.append(subjdir)
 
-    for direct in regdirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(regdirs)
 
 def make_sigsurf_atlas_tree():
     """Set up the atlas tree for sigsurf atlases."""
@@ -198,9 +205,7 @@ def make_sigsurf_atlas_tree():
                 atnamedir = os.path.join(subjdir, atlas)
                 labeldirs.append(atnamedir)
 
-    for direct in labeldirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(labeldirs)
 
 def make_label_atlas_tree():
     """Set up the atlas tree for label atlases."""
@@ -220,9 +225,7 @@ def make_label_atlas_tree():
                 atnamedir = os.path.join(subjdir, atlas)
                 labeldirs.append(atnamedir)
 
-    for direct in labeldirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(labeldirs)
 
 def make_mask_atlas_tree():
     """Set up the atlas tree for mask atlases."""
@@ -237,9 +240,7 @@ def make_mask_atlas_tree():
             atnamedir = os.path.join(projectdir, atlas)
             maskdirs.append(atnamedir)
 
-    for direct in maskdirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(maskdirs)
 
 def make_sphere_atlas_tree():
     """Set upthe atlas tree for sphere atlases."""
@@ -254,6 +255,4 @@ def make_sphere_atlas_tree():
             atnamedir = os.path.join(projectdir, atlas)
             spheredirs.append(atnamedir)
 
-    for direct in spheredirs:
-        if not os.path.isdir(direct):
-            os.mkdir(direct)
+    _make_dirs(spheredirs)
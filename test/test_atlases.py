@@ -0,0 +1,155 @@
+"""Unit tests for extracting from atlas objects.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import atlases
+import extraction
+from core import RoiBase, RoiResult
+
+class Analysis(object):
+    """Stand-in for an Analysis that an atlas was initialized with."""
+
+    def __init__(self, source, stats=()):
+
+        self.source = source
+        self.stats = list(stats)
+        self.dir = os.path.dirname(source)
+
+
+class VolumeAtlas(atlases.Atlas):
+    """Volume atlas with a label image and no config file behind it."""
+
+    def __init__(self, atlas, regions, analysis, **kwargs):
+
+        RoiBase.__init__(self, **kwargs)
+        self.atlas = atlas
+        self.regions = list(regions)
+        self.analysis = analysis
+        self.manifold = "volume"
+        self.space = "native"
+        self.mask = False
+        self.subject = "s1"
+        outdir = analysis.dir
+        self.functxt = os.path.join(outdir, "s1.txt")
+        self.funcvol = os.path.join(outdir, "s1.nii")
+        self.funcstats = os.path.join(outdir, "s1.stats")
+
+
+class TestVolExtract(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.labels = rng.randint(0, 4, (4, 5, 6))
+        self.data = rng.randn(4, 5, 6, 3)
+        self.seg = os.path.join(self.tmpdir, "seg.nii")
+        self.source = os.path.join(self.tmpdir, "source.nii")
+        nib.save(nib.Nifti1Image(self.labels.astype(np.float32), np.eye(4)),
+                 self.seg)
+        nib.save(nib.Nifti1Image(self.data.astype(np.float32), np.eye(4)),
+                 self.source)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def atlas(self, stats=(), **kwargs):
+
+        return VolumeAtlas(self.seg, [3, 1, 2], Analysis(self.source, stats),
+                           **kwargs)
+
+    def test_freesurfer(self):
+
+        res = self.atlas(engine="freesurfer", debug=True)._vol_extract()
+        cmdline = res.cmdline[0].split(" --")
+        self.assertEqual(cmdline[0], "mri_segstats")
+        self.assertEqual([arg for arg in cmdline if arg.startswith("id ")],
+                         ["id 1", "id 2", "id 3"])
+
+    def test_native(self):
+
+        atlas = self.atlas(engine="native", debug=False, chunkframes=0)
+        res = atlas._vol_extract()
+        self.assertTrue(res.cmdline[0].startswith("native segstats"))
+        avgwf = np.loadtxt(atlas.functxt)
+        flat = self.data.reshape(-1, 3)
+        for i, id in enumerate([1, 2, 3]):
+            np.testing.assert_allclose(
+                avgwf[:, i], flat[self.labels.ravel() == id].mean(axis=0),
+                rtol=1e-4)
+        for fname in [atlas.funcvol, atlas.funcstats]:
+            self.assertTrue(os.path.isfile(fname))
+
+    def test_stats_need_native(self):
+
+        res = self.atlas(["median"], engine="freesurfer", debug=True)._vol_extract()
+        self.assertTrue(res.cmdline[0].startswith("native segstats"))
+
+
+class LoadingAtlas(atlases.Atlas):
+    """Atlas whose extraction only loads its source into the image dict."""
+
+    def __init__(self, sourcefile, loaded):
+
+        RoiBase.__init__(self)
+        self.sourcefile = sourcefile
+        self.loaded = loaded
+
+    def _check_extract(self, analysis=None):
+
+        self.mask = False
+
+    def _source_files(self):
+
+        return [self.sourcefile]
+
+    def _native_extract(self, cache=None):
+
+        extraction.load_data(self.sourcefile, cache)
+        self.loaded.append(sorted(cache))
+        return RoiResult(self.sourcefile)
+
+
+class TestExtractAtlases(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def test_images_dropped_after_last_use(self):
+
+        first, second = [os.path.join(self.tmpdir, f)
+                         for f in ["first.nii", "second.nii"]]
+        for fname in [first, second]:
+            nib.save(nib.Nifti1Image(np.zeros((2, 2, 2, 3), np.float32),
+                                     np.eye(4)), fname)
+        loaded = []
+        res = atlases.extract_atlases([LoadingAtlas(first, loaded),
+                                       LoadingAtlas(first, loaded),
+                                       LoadingAtlas(second, loaded)])
+        self.assertEqual(res.cmdline, [first, first, second])
+        # The first image is shared, then dropped before the second loads
+        self.assertEqual(loaded, [[first], [first], [second]])
+
+
+if __name__ == "__main__":
+    unittest.main()
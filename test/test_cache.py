@@ -0,0 +1,49 @@
+"""Unit tests for the command cache.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+from cache import CommandCache
+
+class TestKey(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = CommandCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def run_key(self, scratch=True):
+        """Return the key of a command reading a file in a new scratch dir."""
+        tmp = tempfile.mkdtemp(prefix="avg", dir=self.tmpdir)
+        fname = os.path.join(tmp, "avg-0.mgz")
+        open(fname, "w").write("same contents")
+        cmdline = "mri_concat --i %s --o out.mgz" % fname
+        return self.cache.key(cmdline, [fname], tmp if scratch else None)
+
+    def test_scratch(self):
+
+        self.assertEqual(self.run_key(), self.run_key())
+        self.assertNotEqual(self.run_key(False), self.run_key(False))
+
+    def test_missing_input(self):
+
+        self.assertEqual(self.cache.key("cmd", [os.path.join(self.tmpdir, "no")]),
+                         None)
+
+
+if __name__ == "__main__":
+    unittest.main()
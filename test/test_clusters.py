@@ -0,0 +1,128 @@
+"""Unit tests for clustering significance maps on a surface mesh.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import clusters
+from clusters import SurfaceClusters
+
+class ClusterTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        # A 2 x 4 strip of unit squares: vertices 0-3 along y = 1 and
+        # 4-7 along y = 0, with a blob at each end
+        self.subjdir = tempfile.mkdtemp()
+        surfdir = os.path.join(self.subjdir, "fsaverage", "surf")
+        self.labeldir = os.path.join(self.subjdir, "fsaverage", "label")
+        os.makedirs(surfdir)
+        os.makedirs(self.labeldir)
+        coords = np.array([[x, y, 0] for y in [1, 0] for x in range(4)], float)
+        self.faces = np.array([face for i in range(3)
+                               for face in [[i, i + 4, i + 1], [i + 1, i + 4, i + 5]]],
+                              np.int32)
+        nib.freesurfer.write_geometry(os.path.join(surfdir, "lh.white"),
+                                      coords, self.faces)
+        self.write_cortex(range(8))
+        ctab = np.array([[20, 30, 40, 0, 0], [50, 60, 70, 0, 0]], np.int32)
+        nib.freesurfer.write_annot(os.path.join(self.labeldir, "lh.aparc.annot"),
+                                   np.array([0, 0, 0, 0, 0, 0, 0, 1]), ctab,
+                                   ["first", "second"])
+        self.sig = np.array([5, 0, 0, -3, 4, 0, 0, -6], float)
+        self.sigfile = os.path.join(self.subjdir, "sig.mgh")
+        nib.save(nib.MGHImage(self.sig.reshape(8, 1, 1).astype(np.float32),
+                              np.eye(4)), self.sigfile)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.subjdir)
+        clusters._meshes.clear()
+
+    def write_cortex(self, vertices):
+
+        clusters.write_label(os.path.join(self.labeldir, "lh.cortex.label"),
+                             vertices, np.zeros((len(vertices), 3)),
+                             np.zeros(len(vertices)), "fsaverage")
+
+    def clusterer(self, **kwargs):
+
+        return SurfaceClusters(self.sigfile, self.subjdir, "lh", **kwargs)
+
+
+class TestSurfaceClusters(ClusterTestCase):
+
+    def test_adjacency(self):
+
+        adjacency = clusters.mesh_adjacency(self.faces, 8).toarray()
+        np.testing.assert_array_equal(adjacency, adjacency.T)
+        self.assertTrue(adjacency[0, 4] and adjacency[1, 4])
+        self.assertFalse(adjacency[0, 5] or adjacency[0, 2])
+
+    def test_clusters(self):
+
+        found = self.clusterer().clusters(2)
+        self.assertEqual([c["vtxmax"] for c in found], [7, 0])
+        self.assertEqual([c["max"] for c in found], [-6, 5])
+        self.assertEqual([sorted(c["vertices"]) for c in found], [[3, 7], [0, 4]])
+        self.assertEqual([c["annot"] for c in found], ["second", "first"])
+        # Each end is a unit square split in half: a third of each face
+        # around a vertex counts toward its area
+        np.testing.assert_allclose([c["area"] for c in found], [.5, .5])
+
+    def test_sign_and_size(self):
+
+        sc = self.clusterer()
+        self.assertEqual([c["vtxmax"] for c in sc.clusters(2, sign="pos")], [0])
+        self.assertEqual([c["vtxmax"] for c in sc.clusters(2, sign="neg")], [7])
+        self.assertEqual(sc.clusters(2, minsize=3), [])
+        self.assertEqual(sc.clusters(10), [])
+
+    def test_cortex(self):
+
+        self.write_cortex([1, 2, 3, 4, 5, 6, 7])
+        found = self.clusterer().clusters(2)
+        self.assertEqual([sorted(c["vertices"]) for c in found], [[3, 7], [4]])
+        self.assertEqual(len(self.clusterer(cortex=False).clusters(2)), 2)
+
+    def test_fdr(self):
+
+        sig = np.array([4, -3, 2, .5, .1])
+        pvals = np.sort(10 ** -np.abs(sig))
+        # Benjamini-Hochberg by hand: the largest p under its line
+        k = max([i for i in range(5) if pvals[i] <= .05 * (i + 1) / 5])
+        self.assertAlmostEqual(clusters.fdr_threshold(sig, .05),
+                               -np.log10(pvals[k]))
+        self.assertEqual(clusters.fdr_threshold(sig, 1e-9), np.inf)
+        # Only the one negative value counts
+        self.assertAlmostEqual(clusters.fdr_threshold(sig, .05, "neg"), 3)
+
+    def test_write(self):
+
+        sc = self.clusterer()
+        found = sc.clusters(2)
+        summary = os.path.join(self.subjdir, "sum.txt")
+        labelstem = os.path.join(self.subjdir, "cluster")
+        sc.write(found, summary, labelstem)
+        rows = [line.split() for line in open(summary) if not line.startswith("#")]
+        self.assertEqual([row[2] for row in rows], ["7", "0"])
+        self.assertEqual([row[-1] for row in rows], ["second", "first"])
+        vertices, values = clusters.read_label(labelstem + "-0001.label")
+        np.testing.assert_array_equal(sorted(vertices), [3, 7])
+        np.testing.assert_allclose(sorted(values), [-6, -3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,558 @@
+"""Unit tests for the native extraction engine on small synthetic images.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import extraction
+from extraction import RegionIndex
+
+def _region_means(labels, data, ids, mask=None):
+    """Average data over each region with plain loops, for comparison."""
+    if mask is None:
+        mask = np.ones(len(labels), bool)
+    means = np.zeros((len(ids), data.shape[1]))
+    for i, id in enumerate(ids):
+        inregion = (labels == id) & mask
+        if inregion.any():
+            means[i] = data[inregion].mean(axis=0)
+    return means
+
+class ExtractionTestCase(unittest.TestCase):
+
+    shape = (4, 5, 6)
+    nframes = 7
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.labels3d = rng.randint(0, 4, self.shape)
+        self.labels = self.labels3d.ravel()
+        self.data4d = rng.randn(*(self.shape + (self.nframes,)))
+        self.data = self.data4d.reshape(-1, self.nframes)
+        self.mask3d = rng.randn(*self.shape)
+        self.mask = self.mask3d.ravel()
+        self.ids = [1, 2, 3]
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, data, fname):
+        """Save an array as an image in the temp dir and return its path."""
+        fname = os.path.join(self.tmpdir, fname)
+        data = np.asarray(data, np.float32)
+        if fname.endswith(".mgz"):
+            nib.save(nib.MGHImage(data, np.eye(4)), fname)
+        else:
+            nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+        return fname
+
+
+class TestRegionIndex(ExtractionTestCase):
+
+    def test_regions(self):
+
+        index = RegionIndex(self.labels3d, self.ids)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.n_voxels, self.labels.size)
+        for i, id in enumerate(self.ids):
+            np.testing.assert_array_equal(index.region(i),
+                                          np.flatnonzero(self.labels == id))
+        np.testing.assert_array_equal(
+            index.counts(), [np.sum(self.labels == id) for id in self.ids])
+
+    def test_sums(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        expected = [self.data[self.labels == id].sum(axis=0) for id in self.ids]
+        np.testing.assert_allclose(index.sums(self.data), expected)
+
+    def test_missing_region(self):
+
+        index = RegionIndex(self.labels, [1, 9, 2])
+        self.assertEqual(index.counts()[1], 0)
+        sums = index.sums(self.data)
+        np.testing.assert_array_equal(sums[1], 0)
+        np.testing.assert_allclose(sums[2], self.data[self.labels == 2].sum(axis=0))
+
+    def test_subset(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        mask = self.mask > 0
+        subset = index.subset(mask)
+        self.assertEqual(subset.ids, self.ids)
+        self.assertEqual(len(subset), len(index))
+        for i, id in enumerate(self.ids):
+            np.testing.assert_array_equal(
+                subset.region(i), np.flatnonzero((self.labels == id) & mask))
+
+    def test_save_load(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        fname = os.path.join(self.tmpdir, "index.npz")
+        index.save(fname)
+        loaded = RegionIndex.load(fname)
+        self.assertEqual(loaded.ids, self.ids)
+        self.assertEqual(loaded.n_voxels, index.n_voxels)
+        self.assertTrue(loaded.weights is None)
+        np.testing.assert_array_equal(loaded.voxels, index.voxels)
+        np.testing.assert_array_equal(loaded.offsets, index.offsets)
+        np.testing.assert_allclose(loaded.sums(self.data), index.sums(self.data))
+
+    def test_region_index_cache(self):
+
+        seg = self.save(self.labels3d, "seg.nii")
+        indexdir = os.path.join(self.tmpdir, "index")
+        first = extraction.region_index(seg, self.ids, indexdir)
+        self.assertEqual(len(os.listdir(indexdir)), 1)
+        # A fresh process would read the saved index back
+        extraction._indexes.clear()
+        second = extraction.region_index(seg, self.ids, indexdir)
+        self.assertEqual(second.ids, self.ids)
+        np.testing.assert_array_equal(second.voxels, first.voxels)
+
+    def test_region_index_threads(self):
+
+        seg = self.save(self.labels3d, "seg.nii")
+        indexdir = os.path.join(self.tmpdir, "index")
+        builds = []
+        build_index = extraction._build_index
+        def slow_build(seg, ids):
+            builds.append(seg)
+            time.sleep(.2)
+            return build_index(seg, ids)
+        extraction._build_index = slow_build
+        extraction._indexes.clear()
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(
+                extraction.region_index(seg, self.ids, indexdir)))
+                for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            extraction._build_index = build_index
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(len(set([id(index) for index in results])), 1)
+        # Only the index itself, no temp files left behind
+        self.assertEqual(len(os.listdir(indexdir)), 1)
+
+
+class TestConcatenate(ExtractionTestCase):
+
+    def test_group_means(self):
+
+        rng = np.random.RandomState(4)
+        vols = [rng.randn(*self.shape) for i in range(5)]
+        fnames = [self.save(v, "vol%d.nii" % i) for i, v in enumerate(vols)]
+        out = os.path.join(self.tmpdir, "concat.nii")
+        extraction.concatenate([fnames[:2], fnames[2:3], fnames[3:]], out, 2)
+        data = nib.load(out).get_data()
+        self.assertEqual(data.shape, self.shape + (3,))
+        np.testing.assert_allclose(data[..., 0], (vols[0] + vols[1]) / 2, rtol=1e-5)
+        np.testing.assert_allclose(data[..., 1], vols[2], rtol=1e-5)
+        np.testing.assert_allclose(data[..., 2], (vols[3] + vols[4]) / 2, rtol=1e-5)
+
+    def test_bounded_read_ahead(self):
+
+        fname = self.save(self.mask3d, "vol.nii")
+        starts = []
+        firstdone = []
+        load_volume = extraction._load_volume
+        def slow_first(f):
+            starts.append(time.time())
+            if len(starts) == 1:
+                time.sleep(.3)
+                firstdone.append(time.time())
+            return load_volume(f)
+        extraction._load_volume = slow_first
+        try:
+            extraction.concatenate([[fname]] * 12,
+                                   os.path.join(self.tmpdir, "concat.nii"), 3)
+        finally:
+            extraction._load_volume = load_volume
+        self.assertEqual(len(starts), 12)
+        self.assertTrue(len([s for s in starts if s < firstdone[0]]) <= 3)
+
+
+class TestExtract(ExtractionTestCase):
+
+    def test_masked_extract(self):
+
+        seg = self.save(self.labels3d, "seg.nii")
+        source = self.save(self.data4d, "source.nii")
+        mask = self.save(self.mask3d, "mask.nii")
+        outputs = [os.path.join(self.tmpdir, f)
+                   for f in ["avgwf.txt", "avgwf.nii", "sum.stats"]]
+        stats = extraction.extract(seg, source, self.ids, *outputs, mask=mask,
+                                   maskthresh=.5, masksign="pos")
+        maskbool = self.mask > .5
+        expected = _region_means(self.labels, self.data, self.ids, maskbool)
+        np.testing.assert_allclose(stats["avgwf"], expected, rtol=1e-5)
+        np.testing.assert_array_equal(
+            stats["counts"], [np.sum((self.labels == id) & maskbool)
+                              for id in self.ids])
+        np.testing.assert_allclose(np.loadtxt(outputs[0]), expected.T, rtol=1e-4)
+        for fname in outputs:
+            self.assertTrue(os.path.isfile(fname))
+
+
+class TestSurface(ExtractionTestCase):
+
+    def setUp(self):
+
+        ExtractionTestCase.setUp(self)
+        # A unit square split into two triangles
+        self.white = os.path.join(self.tmpdir, "lh.white")
+        coords = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]], float)
+        faces = np.array([[0, 1, 2], [1, 3, 2]], np.int32)
+        nib.freesurfer.write_geometry(self.white, coords, faces)
+        self.annot = os.path.join(self.tmpdir, "lh.atlas.annot")
+        ctab = np.array([[20, 30, 40, 0, 0], [50, 60, 70, 0, 0]], np.int32)
+        nib.freesurfer.write_annot(self.annot, np.array([0, 0, 1, -1]), ctab,
+                                   ["first", "second"])
+        self.surfdata = np.arange(12.).reshape(4, 1, 1, 3)
+
+    def test_read_annot(self):
+
+        np.testing.assert_array_equal(extraction.read_annot(self.annot),
+                                      [0, 0, 1, -1])
+
+    def test_vertex_areas(self):
+
+        np.testing.assert_allclose(extraction.vertex_areas(self.white),
+                                   [1 / 6., 1 / 3., 1 / 3., 1 / 6.])
+
+    def test_extract_surface(self):
+
+        source = self.save(self.surfdata, "lh.source.mgz")
+        outputs = [os.path.join(self.tmpdir, f)
+                   for f in ["avgwf.txt", "avgwf.nii", "sum.stats"]]
+        stats = extraction.extract_surface(self.annot, self.white, source,
+                                           [1001, 1000], *outputs, segbase=1000)
+        data = self.surfdata[:, 0, 0]
+        np.testing.assert_allclose(stats["avgwf"],
+                                   [data[:2].mean(axis=0), data[2]])
+        table = np.loadtxt(outputs[2])
+        np.testing.assert_array_equal(table[:, 1], [1000, 1001])
+        np.testing.assert_array_equal(table[:, 2], [2, 1])
+        # Region areas, not vertex counts
+        np.testing.assert_allclose(table[:, 3], [.5, .3], atol=.05)
+
+
+class TestStats(ExtractionTestCase):
+
+    def test_region_stats(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        stats = extraction.region_stats(index, self.data)
+        np.testing.assert_allclose(stats["avgwf"],
+                                   _region_means(self.labels, self.data, self.ids))
+        for i, id in enumerate(self.ids):
+            values = self.data[self.labels == id, 0]
+            self.assertEqual(stats["counts"][i], len(values))
+            self.assertAlmostEqual(stats["mean"][i], values.mean())
+            self.assertAlmostEqual(stats["std"][i], values.std(ddof=1))
+            self.assertAlmostEqual(stats["min"][i], values.min())
+            self.assertAlmostEqual(stats["max"][i], values.max())
+
+    def test_order_stats(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        names = ["median", "p25", "trim10", "std", "min", "max"]
+        mask = self.mask > -.5
+        stats = extraction.order_stats(index, self.data, names, mask)
+        for i, id in enumerate(self.ids):
+            values = self.data[(self.labels == id) & mask]
+            np.testing.assert_allclose(stats["median"][i], np.median(values, axis=0))
+            np.testing.assert_allclose(stats["p25"][i],
+                                       np.percentile(values, 25, axis=0))
+            cut = int(np.floor(.1 * len(values)))
+            trimmed = np.sort(values, axis=0)[cut:len(values) - cut]
+            np.testing.assert_allclose(stats["trim10"][i], trimmed.mean(axis=0))
+            np.testing.assert_allclose(stats["std"][i], values.std(axis=0, ddof=1))
+            np.testing.assert_allclose(stats["min"][i], values.min(axis=0))
+            np.testing.assert_allclose(stats["max"][i], values.max(axis=0))
+
+    def test_order_stats_empty(self):
+
+        index = RegionIndex(self.labels, [1, 9])
+        stats = extraction.order_stats(index, self.data, ["median", "max"])
+        np.testing.assert_array_equal(stats["median"][1], 0)
+        np.testing.assert_array_equal(stats["max"][1], 0)
+
+    def test_parse_stat(self):
+
+        self.assertEqual(extraction.parse_stat("median"), ("percentile", 50.))
+        self.assertEqual(extraction.parse_stat("trim20"), ("trim", .2))
+        for name in ["mode", "p101", "trim50", "pfoo"]:
+            self.assertRaises(ValueError, extraction.parse_stat, name)
+
+    def test_mask_sweep(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        thresholds = [0, .5, 1]
+        signs = ["abs", "pos", "neg"]
+        sweeps = extraction.mask_sweep(index, self.data, self.mask, thresholds, signs)
+        self.assertEqual(len(sweeps), 9)
+        for sign in signs:
+            for thresh in thresholds:
+                maskbool = extraction.apply_mask(self.mask, thresh, sign)
+                stats = extraction.region_stats(index, self.data, maskbool)
+                avgwf, counts = sweeps[(sign, thresh)]
+                np.testing.assert_array_equal(counts, stats["counts"])
+                np.testing.assert_allclose(avgwf, stats["avgwf"], atol=1e-12)
+
+    def test_group_cube(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        rng = np.random.RandomState(2)
+        datas = [rng.randn(*self.data4d.shape) for subj in range(5)]
+        sources = [self.save(d, "subj%d.nii" % i) for i, d in enumerate(datas)]
+        cube, counts = extraction.group_cube(index, sources, chunksubjects=2)
+        self.assertEqual(cube.shape, (5, 3, self.nframes))
+        for i, data in enumerate(datas):
+            np.testing.assert_allclose(
+                cube[i], _region_means(self.labels, data.reshape(-1, self.nframes),
+                                       self.ids), rtol=1e-5)
+            np.testing.assert_array_equal(counts[i], index.counts())
+        masks = [self.save(rng.randn(*self.shape), "mask%d.nii" % i)
+                 for i in range(5)]
+        cube, counts = extraction.group_cube(index, sources, masks, chunksubjects=2)
+        for i, data in enumerate(datas):
+            maskbool = extraction.load_data(masks[i])[0][:, 0] != 0
+            np.testing.assert_allclose(
+                cube[i], _region_means(self.labels, data.reshape(-1, self.nframes),
+                                       self.ids, maskbool), rtol=1e-5)
+
+    def test_group_cube_extra(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        rng = np.random.RandomState(3)
+        datas = [rng.randn(*self.data4d.shape) for subj in range(3)]
+        sources = [self.save(d, "subj%d.nii" % i) for i, d in enumerate(datas)]
+        masks = [self.save(rng.randn(*self.shape), "mask%d.nii" % i)
+                 for i in range(3)]
+        names = ["median", "p90"]
+        for maskfiles in [None, masks]:
+            cube, counts, extra = extraction.group_cube(
+                index, sources, maskfiles, chunksubjects=2, extra=names)
+            self.assertEqual(sorted(extra), names)
+            for i, source in enumerate(sources):
+                data = extraction.load_data(source)[0]
+                mask = None
+                if maskfiles is not None:
+                    mask = extraction.load_data(maskfiles[i])[0][:, 0] != 0
+                expected = extraction.order_stats(index, data, names, mask)
+                for name in names:
+                    np.testing.assert_allclose(extra[name][i], expected[name])
+
+    def test_export_patterns(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        source = self.save(self.data4d, "source.nii")
+        mask = self.save(self.mask3d, "mask.nii")
+        fname = os.path.join(self.tmpdir, "patterns.npy")
+        extraction.export_patterns(fname, [("s1", "", index, source, None),
+                                           ("s2", "", index, source, mask)],
+                                   maskthresh=.5, masksign="pos")
+        patterns, offsets = extraction.read_patterns(fname)
+        for i, id in enumerate(self.ids):
+            start, stop = offsets[("s1", "", id)]
+            np.testing.assert_allclose(patterns[start:stop],
+                                       self.data[self.labels == id], rtol=1e-6)
+            start, stop = offsets[("s2", "", id)]
+            np.testing.assert_allclose(
+                patterns[start:stop],
+                self.data[(self.labels == id) & (self.mask > .5)], rtol=1e-6)
+
+
+class TestWriters(ExtractionTestCase):
+
+    def test_avgwf(self):
+
+        avgwf = np.arange(6.).reshape(2, 3) / 7
+        fname = os.path.join(self.tmpdir, "avgwf.txt")
+        extraction.write_avgwf(fname, avgwf)
+        # One row per frame, one column per region
+        np.testing.assert_allclose(np.loadtxt(fname), avgwf.T, rtol=1e-5)
+        fname = os.path.join(self.tmpdir, "avgwf.nii")
+        extraction.write_avgwfvol(fname, avgwf)
+        img = nib.load(fname)
+        self.assertEqual(img.shape, (2, 1, 1, 3))
+        np.testing.assert_allclose(img.get_data()[:, 0, 0], avgwf, rtol=1e-6)
+
+    def test_sum(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        stats = extraction.region_stats(index, self.data)
+        fname = os.path.join(self.tmpdir, "sum.stats")
+        extraction.write_sum(fname, self.ids, stats, source="src.nii", seg="seg.nii")
+        lines = open(fname).readlines()
+        self.assertTrue("# NRows 3 \n" in lines)
+        table = np.loadtxt(fname)
+        self.assertEqual(table.shape, (3, 9))
+        np.testing.assert_array_equal(table[:, 1], self.ids)
+        np.testing.assert_array_equal(table[:, 2], stats["counts"])
+        np.testing.assert_allclose(table[:, 4], stats["mean"], atol=1e-4)
+        np.testing.assert_allclose(table[:, 8], stats["max"] - stats["min"], atol=2e-4)
+
+    def test_sweep(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        sweeps = {"mask": extraction.mask_sweep(index, self.data, self.mask, [0, 1])}
+        fname = os.path.join(self.tmpdir, "sweep.txt")
+        extraction.write_sweep(fname, self.ids, ["a", "b", "c"], sweeps)
+        lines = open(fname).readlines()
+        self.assertEqual(len(lines), 1 + 2 * 3)
+        self.assertEqual(len(lines[0].split("\t")), 6 + self.nframes)
+
+
+class TestWeighted(ExtractionTestCase):
+
+    def setUp(self):
+
+        ExtractionTestCase.setUp(self)
+        rng = np.random.RandomState(1)
+        self.maps = [np.where(rng.rand(*self.shape) > .4, rng.rand(*self.shape), 0)
+                     for id in self.ids]
+        self.weights = np.array([m.ravel() for m in self.maps])
+
+    def test_from_weights(self):
+
+        index = RegionIndex.from_weights(self.maps, self.ids)
+        self.assertEqual(index.ids, self.ids)
+        self.assertEqual(len(index), 3)
+        np.testing.assert_allclose(index.totals(), self.weights.sum(axis=1))
+        np.testing.assert_allclose(index.sums(self.data),
+                                   np.dot(self.weights, self.data))
+
+    def test_subset_save_load(self):
+
+        index = RegionIndex.from_weights(self.maps, self.ids)
+        mask = self.mask > 0
+        subset = index.subset(mask)
+        np.testing.assert_allclose(subset.sums(self.data),
+                                   np.dot(self.weights * mask, self.data))
+        fname = os.path.join(self.tmpdir, "weighted.npz")
+        subset.save(fname)
+        loaded = RegionIndex.load(fname)
+        self.assertEqual(loaded.ids, self.ids)
+        np.testing.assert_allclose(loaded.weights, subset.weights)
+        np.testing.assert_allclose(loaded.sums(self.data), subset.sums(self.data))
+
+    def test_weighted_stats(self):
+
+        index = RegionIndex.from_weights(self.maps, self.ids)
+        stats = extraction.region_stats(index, self.data)
+        for i, w in enumerate(self.weights):
+            x = self.data[:, 0]
+            mean = np.dot(w, x) / w.sum()
+            var = np.dot(w, (x - mean) ** 2) / (w.sum() - (w ** 2).sum() / w.sum())
+            self.assertAlmostEqual(stats["mean"][i], mean)
+            self.assertAlmostEqual(stats["std"][i], np.sqrt(var))
+            np.testing.assert_allclose(stats["avgwf"][i],
+                                       np.dot(w, self.data) / w.sum())
+
+    def test_weighted_extract(self):
+
+        maps = [self.save(m, "map%d.nii" % i) for i, m in enumerate(self.maps)]
+        source = self.save(self.data4d, "source.nii")
+        mask = self.save(self.mask3d, "mask.nii")
+        outputs = [os.path.join(self.tmpdir, f)
+                   for f in ["avgwf.txt", "avgwf.nii", "sum.stats"]]
+        # Ids out of order are sorted together with their maps
+        stats = extraction.extract(maps[::-1], source, self.ids[::-1], *outputs,
+                                   mask=mask)
+        w = self.weights * (np.abs(self.mask) > 0)
+        np.testing.assert_allclose(stats["avgwf"],
+                                   np.dot(w, self.data) / w.sum(axis=1)[:, None],
+                                   rtol=1e-5)
+
+    def test_weighted_group(self):
+
+        index = RegionIndex.from_weights(self.maps, self.ids)
+        source = self.save(self.data4d, "source.nii")
+        cube, counts = extraction.group_cube(index, [source, source])
+        expected = np.dot(self.weights, self.data) / self.weights.sum(axis=1)[:, None]
+        np.testing.assert_allclose(cube[1], expected, rtol=1e-5)
+        fname = os.path.join(self.tmpdir, "patterns.npy")
+        extraction.export_patterns(fname, [("s1", "", index, source, None)])
+        patterns, offsets = extraction.read_patterns(fname)
+        start, stop = offsets[("s1", "", 2)]
+        np.testing.assert_allclose(patterns[start:stop],
+                                   self.data[self.weights[1] > 0], rtol=1e-6)
+
+
+class TestIterFrames(ExtractionTestCase):
+
+    def check_chunks(self, ext):
+
+        source = self.save(self.data4d, "source" + ext)
+        whole = extraction.load_data(source)[0]
+        np.testing.assert_allclose(whole, self.data, rtol=1e-6, atol=1e-6)
+        for chunkframes in [1, 3, self.nframes]:
+            chunks = np.hstack([block for start, block
+                                in extraction.iter_frames(source, chunkframes)])
+            np.testing.assert_allclose(chunks, whole, rtol=1e-6)
+
+    def test_nifti(self):
+
+        self.check_chunks(".nii")
+
+    def test_nifti_gz(self):
+
+        self.check_chunks(".nii.gz")
+
+    def test_mgz(self):
+
+        self.check_chunks(".mgz")
+
+    def test_scaled(self):
+
+        # Integer data with a scale factor in the header
+        img = nib.Nifti1Image((self.data4d * 100).astype(np.int16), np.eye(4))
+        img.get_header().set_slope_inter(.5, 3)
+        source = os.path.join(self.tmpdir, "scaled.nii")
+        nib.save(img, source)
+        whole = extraction.load_data(source)[0]
+        chunks = np.hstack([block for start, block
+                            in extraction.iter_frames(source, 2)])
+        np.testing.assert_allclose(chunks, whole, rtol=1e-6)
+
+    def test_stream_stats(self):
+
+        index = RegionIndex(self.labels, self.ids)
+        for ext in [".nii", ".nii.gz", ".mgz"]:
+            source = self.save(self.data4d, "source" + ext)
+            whole = extraction.region_stats(index, extraction.load_data(source)[0],
+                                            self.mask > 0, ["median", "p90"])
+            chunked = extraction.stream_stats(index, source, 3, self.mask > 0,
+                                              ["median", "p90"])
+            for key in ["avgwf", "counts", "mean", "std", "min", "max"]:
+                np.testing.assert_allclose(chunked[key], whole[key], rtol=1e-6)
+            for name in ["median", "p90"]:
+                np.testing.assert_allclose(chunked["extra"][name],
+                                           whole["extra"][name], rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""Unit tests for file locks.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import locks
+from locks import FileLock
+
+def _dead_pid():
+
+    proc = multiprocessing.Process(target=os.getpid)
+    proc.start()
+    proc.join()
+    return proc.pid
+
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.lockfile = os.path.join(self.tmpdir, "file.lock")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def write_lock(self, pid):
+
+        open(self.lockfile, "w").write("%s:%d" % (socket.gethostname(), pid))
+
+    def test_exclusive(self):
+
+        first = FileLock(self.lockfile)
+        self.assertTrue(first.acquire())
+        self.assertFalse(FileLock(self.lockfile).acquire(blocking=False))
+        first.release()
+        self.assertFalse(os.path.exists(self.lockfile))
+
+    def test_stale(self):
+
+        self.write_lock(_dead_pid())
+        lock = FileLock(self.lockfile)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertEqual(open(self.lockfile).read(), lock.owner)
+        lock.release()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_live_owner(self):
+
+        self.write_lock(os.getppid())
+        self.assertFalse(FileLock(self.lockfile).acquire(blocking=False))
+
+    def test_replaced_while_checking(self):
+
+        # Between reading the stale lock and removing it, another waiter
+        # removes it and a third process takes the lock
+        self.write_lock(_dead_pid())
+        process_alive = locks.process_alive
+        def replace(pid):
+            os.remove(self.lockfile)
+            self.write_lock(os.getppid())
+            return False
+        locks.process_alive = replace
+        try:
+            FileLock(self.lockfile)._remove_if_stale()
+        finally:
+            locks.process_alive = process_alive
+        self.assertEqual(open(self.lockfile).read(),
+                         "%s:%d" % (socket.gethostname(), os.getppid()))
+        self.assertEqual(os.listdir(self.tmpdir), ["file.lock"])
+
+    def test_other_host(self):
+
+        open(self.lockfile, "w").write("elsewhere:1")
+        lock = FileLock(self.lockfile, maxage=60)
+        self.assertFalse(lock.acquire(blocking=False))
+        # Nothing has touched it for longer than maxage
+        then = time.time() - 120
+        os.utime(self.lockfile, (then, then))
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_owner_touches_lock(self):
+
+        lock = FileLock(self.lockfile, maxage=.2)
+        lock.acquire()
+        then = time.time() - 120
+        os.utime(self.lockfile, (then, then))
+        time.sleep(.2)
+        self.assertTrue(os.stat(self.lockfile).st_mtime > then + 60)
+        lock.release()
+
+    def test_breaking_in_progress(self):
+
+        # Another waiter is removing the stale lock
+        self.write_lock(_dead_pid())
+        open(self.lockfile + ".break", "w").write(
+            "%s:%d" % (socket.gethostname(), os.getppid()))
+        self.assertFalse(FileLock(self.lockfile).acquire(blocking=False))
+        self.assertTrue(os.path.exists(self.lockfile))
+
+
+if __name__ == "__main__":
+    unittest.main()
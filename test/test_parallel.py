@@ -0,0 +1,294 @@
+"""Unit tests for running external programs and task graphs.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import time
+import pickle
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import core
+import runner
+import parallel
+import depends
+import journal
+import atlases
+from core import RoiBase, RoiResult, Log
+
+class Runnable(RoiBase):
+    """Object that runs shell commands the way atlas objects do."""
+
+    def shell(self, cmdline, inputs=None, outputs=None):
+
+        return self._manual_run([cmdline], inputs, outputs)
+
+
+class TaskGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.obj = Runnable(backend="local", cachedir="", maxprocs=0, memlimit=0)
+        self.source = self.path("source.txt")
+        open(self.source, "w").write("source\n")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, fname):
+
+        return os.path.join(self.tmpdir, fname)
+
+    def task(self, name, cmdline, inputs, outputs):
+
+        return parallel.Task(name, self.obj.shell, (cmdline, inputs, outputs),
+                             inputs=inputs, outputs=outputs)
+
+
+class TestManualRun(TaskGraphTestCase):
+
+    def test_success(self):
+
+        res = self.obj.shell("echo hello")
+        self.assertEqual(res.failed, [])
+        self.assertEqual(res.stdout, ["hello\n"])
+
+    def test_failure(self):
+
+        res = self.obj.shell("echo oops >&2; exit 3")
+        self.assertEqual(res.failed, ["echo oops >&2; exit 3"])
+        self.assertEqual(res.stderr, ["oops\n"])
+        merged = RoiResult()
+        merged(RoiResult("other"))
+        merged(res)
+        self.assertEqual(merged.failed, res.failed)
+
+
+class TestStreaming(TaskGraphTestCase):
+
+    def test_lines_arrive_while_running(self):
+
+        log = Log(logdir=self.tmpdir)
+        command = runner.Runner().start(
+            "echo first; while [ ! -e %s ]; do sleep .05; done; echo $((6 * 7))"
+            % self.path("go"), log)
+        for i in range(100):
+            if "first" in open(log.log_file).read():
+                break
+            time.sleep(.05)
+        self.assertFalse(command.done())
+        self.assertFalse("\n42\n" in open(log.log_file).read())
+        open(self.path("go"), "w").close()
+        self.assertEqual(command.wait()[0], "first\n42\n")
+        self.assertTrue("\n42\n" in open(log.log_file).read())
+
+    def test_object_log(self):
+
+        log = Log(logdir=self.tmpdir)
+        obj = Runnable(backend="local", cachedir="", maxprocs=0, memlimit=0,
+                       log=log)
+        self.assertTrue(obj._runopts()["log"] is log)
+        res = obj.shell("echo hello; exit 2")
+        self.assertEqual(res.stdout, ["hello\n"])
+        self.assertEqual(log.cmdline, ["echo hello; exit 2"])
+        self.assertEqual(log.failed, ["echo hello; exit 2"])
+        text = open(log.log_file).read()
+        self.assertTrue("echo hello; exit 2\nhello\n" in text)
+        self.assertTrue("Failed (exit status 2)" in text)
+
+    def test_log_pickles(self):
+
+        log = Log(logdir=self.tmpdir)
+        copy = pickle.loads(pickle.dumps(log))
+        copy.stream("from a worker\n")
+        self.assertTrue("from a worker" in open(log.log_file).read())
+
+
+class JournaledAtlas(atlases.Atlas, Runnable):
+    """Atlas that only runs shell commands, for the journaled group calls."""
+
+    def __init__(self, **kwargs):
+
+        RoiBase.__init__(self, **kwargs)
+        self.atlasname = "atlas"
+        self.paradigm = "par"
+
+    def init_subject(self, subject):
+
+        self.subject = subject
+
+    def make_atlas(self, cmdline):
+
+        return self.shell(cmdline)
+
+
+class TestJournaled(TaskGraphTestCase):
+
+    def test_group_stages(self):
+
+        jrnl = journal.Journal(self.path("journal"))
+        project_journal = journal.project_journal
+        journal.project_journal = lambda *args: jrnl
+        try:
+            obj = JournaledAtlas(backend="local", cachedir="", maxprocs=0,
+                                 memlimit=0, journal=True, pool="thread")
+            results = list(parallel.map_subjects(
+                obj, ["s1", "s2"], "_journaled", ("make_atlas", "", "exit 1"),
+                n_jobs=2))
+        finally:
+            journal.project_journal = project_journal
+        self.assertEqual([len(res.failed) for res in results], [1, 1])
+        # Named as in process(), which will run them again
+        self.assertEqual(jrnl.last_status(),
+                         {"make_atlas:atlas:par:s1": "failed",
+                          "make_atlas:atlas:par:s2": "failed"})
+
+
+# When each subject ran, shared by the copies of the object each job gets
+_ran = []
+
+class ClusterAtlas(atlases.Atlas):
+    """SigSurf-like atlas whose process() notes when each subject ran."""
+
+    def __init__(self, source="sigsurf", space="native", **kwargs):
+
+        RoiBase.__init__(self, **kwargs)
+        self.source = source
+        self.space = space
+
+    def process(self, subject, analysis, force=False, n_jobs=1,
+                shared_atlas=True):
+
+        start = time.time()
+        time.sleep(.1)
+        _ran.append((subject, start, time.time()))
+        return RoiResult("%s %s" % (subject, shared_atlas))
+
+
+class TestGroupProcess(unittest.TestCase):
+
+    def test_sigsurf_first_subject_alone(self):
+
+        del _ran[:]
+        obj = ClusterAtlas(debug=True, pool="thread")
+        res = obj.group_process(object(), ["s1", "s2", "s3"], n_jobs=3)
+        self.assertEqual(res.cmdline, ["s1 True", "s2 False", "s3 False"])
+        times = dict([(subj, (start, stop)) for subj, start, stop in _ran])
+        self.assertTrue(times["s1"][1] <= min(times["s2"][0], times["s3"][0]))
+        # The rest still run at once
+        self.assertTrue(times["s2"][0] < times["s3"][1] and
+                        times["s3"][0] < times["s2"][1])
+
+    def test_standard_atlas_made_once(self):
+
+        del _ran[:]
+        obj = ClusterAtlas(source="mask", space="standard", debug=True, 
+                           pool="thread")
+        res = obj.group_process(object(), ["s1", "s2", "s3"], n_jobs=3)
+        # Only the first subject makes the shared atlas image
+        self.assertEqual(res.cmdline, ["s1 True", "s2 False", "s3 False"])
+        times = dict([(subj, (start, stop)) for subj, start, stop in _ran])
+        self.assertTrue(times["s1"][1] <= min(times["s2"][0], times["s3"][0]))
+
+    def test_native_atlas_not_serialized(self):
+
+        del _ran[:]
+        obj = ClusterAtlas(source="freesurfer", debug=True, pool="thread")
+        res = obj.group_process(object(), ["s1", "s2"], n_jobs=2)
+        self.assertEqual(res.cmdline, ["s1 True", "s2 True"])
+        times = dict([(subj, (start, stop)) for subj, start, stop in _ran])
+        self.assertTrue(times["s1"][0] < times["s2"][1] and
+                        times["s2"][0] < times["s1"][1])
+
+
+class Analysis(object):
+    """Stand-in for source.Analysis, which atlases change per subject."""
+
+    source = None
+
+
+class AnalysisAtlas(RoiBase):
+    """Atlas whose extraction points the analysis at the subject's image."""
+
+    def init_subject(self, subject):
+
+        self.subject = subject
+
+    def extract(self, analysis):
+
+        # Like init_analysis(), which sets the source image for a subject
+        analysis.source = "%s.mgz" % self.subject
+        time.sleep(.1)
+        return RoiResult("%s %s" % (self.subject, analysis.source))
+
+
+class TestMapSubjects(unittest.TestCase):
+
+    def test_threads_get_own_analysis(self):
+
+        analysis = Analysis()
+        obj = AnalysisAtlas(pool="thread")
+        results = list(parallel.map_subjects(obj, ["s1", "s2"], "extract",
+                                             (analysis,), n_jobs=2))
+        self.assertEqual([res.cmdline for res in results],
+                         [["s1 s1.mgz"], ["s2 s2.mgz"]])
+        self.assertTrue(analysis.source is None)
+
+
+class TestTaskGraph(TaskGraphTestCase):
+
+    def test_stamps_successful_tasks(self):
+
+        out = self.path("out.txt")
+        graph = parallel.TaskGraph([self.task(
+            "copy", "cp %s %s" % (self.source, out), [self.source], [out])])
+        res = graph.run(stamp="mtime")
+        self.assertEqual(res.failed, [])
+        self.assertTrue(depends.is_current([out], [self.source]))
+
+    def test_failed_task_not_stamped(self):
+
+        # A stale output from an earlier run is left behind by the failure
+        out = self.path("out.txt")
+        open(out, "w").write("old\n")
+        later = self.path("later.txt")
+        jrnl = journal.Journal(self.path("journal"))
+        graph = parallel.TaskGraph([
+            self.task("broken", "exit 1", [self.source], [out]),
+            self.task("later", "cp %s %s" % (out, later), [out], [later])])
+        res = graph.run(n_jobs=2, stamp="mtime", journal=jrnl)
+        self.assertEqual(len(res.failed), 2)
+        self.assertFalse(os.path.exists(depends._stamp_file(out)))
+        self.assertFalse(os.path.exists(later))
+        self.assertEqual(jrnl.last_status(), {"broken": "failed"})
+        self.assertEqual(jrnl.unfinished(), set(["broken"]))
+
+    def test_update_reruns_failed(self):
+
+        out = self.path("out.txt")
+        jrnl = journal.Journal(self.path("journal"))
+        graph = parallel.TaskGraph([self.task("broken", "exit 1", [self.source], [out])])
+        graph.update(journal=jrnl)
+        # The output appears (e.g. written by hand) but the stage still
+        # has to run again, since its last run failed
+        open(out, "w").write("new\n")
+        graph = parallel.TaskGraph([self.task(
+            "broken", "cp %s %s" % (self.source, out), [self.source], [out])])
+        self.assertEqual(len(graph.update(journal=jrnl).cmdline), 1)
+        self.assertEqual(jrnl.last_status()["broken"], "done")
+        graph = parallel.TaskGraph([self.task(
+            "broken", "cp %s %s" % (self.source, out), [self.source], [out])])
+        self.assertEqual(len(graph.update(journal=jrnl).cmdline), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
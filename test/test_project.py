@@ -0,0 +1,201 @@
+"""Unit tests for planning the processing of a whole project.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import configinterface as cfg
+import source
+import atlases
+import project
+from core import RoiBase, RoiResult
+
+class Analysis(object):
+    """Stand-in for source.Analysis without a config file."""
+
+    def __init__(self):
+
+        self.dict = dict(par="PAR", extract="beta")
+        self.paradigm = "PAR"
+        self.extract = "beta"
+        self.name = "PAR_nomask_beta"
+        self.mask = False
+        self.stats = []
+
+
+class StatImages(RoiBase):
+    """Stand-in for the first-level stats object of an analysis."""
+
+    def __init__(self, analysis, **kwargs):
+
+        RoiBase.__init__(self, **kwargs)
+        self.analysis = analysis
+
+    def init_subject(self, subject):
+
+        stemdir = os.path.join("/roi", "levelone", "beta", "PAR", subject)
+        self.extractlist = [os.path.join("/betas", subject, "beta_0001.img")]
+        self.extractvol = os.path.join(stemdir, "task_betas.mgz")
+        self.extractsurf = os.path.join(stemdir, "%s.task_betas.mgz")
+        self.regmat = os.path.join("/roi", "reg", "PAR", subject, "func2orig.dat")
+
+    def concatenate(self):
+
+        return RoiResult()
+
+    def sample_to_surface(self, hemis=None):
+
+        return RoiResult()
+
+
+class Register(object):
+    """Stand-in for FSRegister."""
+
+    def __init__(self, paradigm, subject, **kwargs):
+
+        self.regmat = os.path.join("/roi", "reg", paradigm, subject,
+                                   "func2orig.dat")
+        self.meanfuncimg = os.path.join("/func", subject, "mean.nii")
+
+    def register(self, force=False):
+
+        return RoiResult()
+
+
+class PlanAtlas(atlases.Atlas):
+    """Atlas with paths but no config file behind it."""
+
+    def __init__(self, atlasname, manifold, atlassource="freesurfer",
+                 space="native", **kwargs):
+
+        RoiBase.__init__(self, **kwargs)
+        self.roidir = "/roi"
+        self.atlasname = atlasname
+        self.manifold = manifold
+        self.source = atlassource
+        self.space = space
+        self.iterhemi = ["lh", "rh"]
+        self._init_paradigm = False
+        self._init_subject = False
+
+    def init_subject(self, subject):
+
+        self.subject = subject
+        if self.manifold == "surface":
+            self.atlas = "/roi/atlases/%s/%s/%%s.annot" % (subject, self.atlasname)
+        else:
+            self.atlas = "/roi/atlases/%s/%s/atlas.mgz" % (subject, self.atlasname)
+        self._init_subject = True
+
+    def make_atlas(self):
+
+        return RoiResult()
+
+
+_atlases = dict(aseg=("aseg", "volume"),
+                aparc=("aparc", "surface"),
+                clusters=("clusters", "surface", "sigsurf"),
+                masks=("masks", "volume", "mask", "standard"))
+
+
+class ProjectTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.saved = [(cfg, "projectname", cfg.projectname),
+                      (cfg, "paradigms", cfg.paradigms),
+                      (source, "init_stat_object", source.init_stat_object),
+                      (atlases, "FSRegister", atlases.FSRegister),
+                      (project, "init_atlas", project.init_atlas)]
+        cfg.projectname = lambda: "proj"
+        cfg.paradigms = lambda par=None, case="upper": par
+        source.init_stat_object = StatImages
+        atlases.FSRegister = Register
+        project.init_atlas = lambda name, **kwargs: PlanAtlas(
+            *_atlases[name], **kwargs)
+
+    def tearDown(self):
+
+        for module, name, value in self.saved:
+            setattr(module, name, value)
+
+
+class TestPlan(ProjectTestCase):
+
+    def test_mixed_atlases(self):
+
+        analysis = Analysis()
+        proj = project.Project([analysis], ["aseg", "aparc"], debug=True)
+        graph = proj.plan("s1")
+        extract = dict([(task.name, task.func.im_self.analysis)
+                        for task in graph.tasks
+                        if task.name.startswith("extract:")])
+        stemdir = "/roi/levelone/beta/PAR/s1"
+        vol = extract["extract:aseg:PAR_nomask_beta:s1"]
+        surf = extract["extract:aparc:PAR_nomask_beta:s1"]
+        # Each atlas extracts from its own images into its own directory
+        self.assertEqual(vol.source, os.path.join(stemdir, "task_betas.mgz"))
+        self.assertEqual(surf.source, os.path.join(stemdir, "%s.task_betas.mgz"))
+        self.assertTrue(vol.dir.endswith(os.path.join("PAR_nomask_beta", "aseg")))
+        self.assertTrue(surf.dir.endswith(os.path.join("aparc", "%s")))
+        self.assertFalse(hasattr(analysis, "source"))
+        # The stages the atlases share run once
+        self.assertEqual(len([task for task in graph.tasks
+                              if task.name.startswith("concatenate:")]), 1)
+
+    def test_shared_atlas(self):
+
+        proj = project.Project([Analysis()], ["aseg", "masks"], debug=True)
+        names = [task.name for task in proj.plan("s2", shared_atlas=False).tasks]
+        self.assertTrue("make_atlas:aseg:PAR:s2" in names)
+        self.assertFalse("make_atlas:masks:PAR:s2" in names)
+
+
+# When each subject ran, shared by the copies of the project each job gets
+_ran = []
+
+class TimedProject(project.Project):
+    """Project whose process() notes when each subject ran."""
+
+    def process(self, subject, force=False, n_jobs=1, shared_atlas=True):
+
+        start = time.time()
+        time.sleep(.1)
+        _ran.append((subject, start, time.time()))
+        return RoiResult("%s %s" % (subject, shared_atlas))
+
+
+class TestGroupProcess(ProjectTestCase):
+
+    def run_group(self, atlasnames):
+
+        del _ran[:]
+        proj = TimedProject([Analysis()], atlasnames, debug=True, pool="thread")
+        res = proj.group_process(["s1", "s2", "s3"], n_jobs=3)
+        times = dict([(subj, (start, stop)) for subj, start, stop in _ran])
+        return res.cmdline, times
+
+    def test_sigsurf_first_subject_alone(self):
+
+        cmdline, times = self.run_group(["aseg", "clusters"])
+        self.assertEqual(cmdline, ["s1 True", "s2 False", "s3 False"])
+        self.assertTrue(times["s1"][1] <= min(times["s2"][0], times["s3"][0]))
+
+    def test_native_atlases_at_once(self):
+
+        cmdline, times = self.run_group(["aseg", "aparc"])
+        self.assertEqual(cmdline, ["s1 True", "s2 True", "s3 True"])
+        self.assertTrue(times["s1"][0] < times["s2"][1] and
+                        times["s2"][0] < times["s1"][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,277 @@
+"""Unit tests for native resampling between spaces.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import resample
+from clusters import read_label, write_label
+
+def _write_regmat(fname, regmat):
+    """Write a tkregister registration file."""
+    fid = open(fname, "w")
+    fid.write("subject\n2.0\n2.0\n0.15\n")
+    for row in regmat:
+        fid.write(" ".join(["%f" % value for value in row]) + "\n")
+    fid.write("round\n")
+    fid.close()
+
+
+class ResampleTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.regmat = self.path("register.dat")
+        _write_regmat(self.regmat, np.eye(4))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, fname):
+
+        return os.path.join(self.tmpdir, fname)
+
+    def save(self, data, fname, voxsize=1):
+        """Save an array as an image with cubic voxels and return its path."""
+        fname = self.path(fname)
+        affine = np.diag([voxsize, voxsize, voxsize, 1.])
+        nib.save(nib.Nifti1Image(np.asarray(data, np.float32), affine), fname)
+        return fname
+
+
+class TestVol2Vol(ResampleTestCase):
+
+    def test_read_regmat(self):
+
+        regmat = np.arange(16.).reshape(4, 4)
+        _write_regmat(self.regmat, regmat)
+        np.testing.assert_allclose(resample.read_regmat(self.regmat), regmat)
+        open(self.regmat, "w").write("not\na\nregistration\n")
+        self.assertRaises(ValueError, resample.read_regmat, self.regmat)
+
+    def test_same_grid(self):
+
+        labels = np.random.RandomState(0).randint(0, 5, (4, 5, 6))
+        targ = self.save(labels, "aseg.nii")
+        mov = self.save(np.zeros((4, 5, 6)), "func.nii")
+        out = self.path("out.nii")
+        resample.resample_labels(targ, mov, self.regmat, out)
+        np.testing.assert_array_equal(nib.load(out).get_data(), labels)
+
+    def test_coarser_grid(self):
+
+        # Functional voxels twice the size land on every other anat voxel
+        labels = np.random.RandomState(0).randint(0, 5, (8, 8, 8))
+        targ = self.save(labels, "aseg.nii")
+        mov = self.save(np.zeros((4, 4, 4)), "func.nii", voxsize=2)
+        out = self.path("out.nii")
+        resample.resample_labels(targ, mov, self.regmat, out)
+        np.testing.assert_array_equal(nib.load(out).get_data(),
+                                      labels[::2, ::2, ::2])
+
+    def test_outside(self):
+
+        # Shifted out of the anatomy along x
+        regmat = np.eye(4)
+        regmat[0, 3] = 100
+        _write_regmat(self.regmat, regmat)
+        targ = self.save(np.ones((4, 4, 4)), "aseg.nii")
+        mov = self.save(np.zeros((4, 4, 4)), "func.nii")
+        out = self.path("out.nii")
+        resample.resample_labels(targ, mov, self.regmat, out)
+        self.assertFalse(nib.load(out).get_data().any())
+
+    def test_cache_bounded(self):
+
+        targ = nib.load(self.save(np.ones((4, 4, 4)), "aseg.nii"))
+        mov = self.save(np.zeros((4, 4, 4)), "func.nii")
+        regmats = [self.path("register%d.dat" % i) for i in range(3)]
+        cache_size = resample._cache_size
+        resample._cache_size = 2
+        resample._maps.clear()
+        try:
+            for regmat in regmats:
+                _write_regmat(regmat, np.eye(4))
+                resample.vol2vol_index(regmat, mov, targ)
+            # The first registration was the least recently used
+            self.assertEqual([key[0] for key in resample._maps], regmats[1:])
+        finally:
+            resample._cache_size = cache_size
+            resample._maps.clear()
+
+
+class TestVol2Surf(ResampleTestCase):
+
+    def setUp(self):
+
+        ResampleTestCase.setUp(self)
+        # One triangle in the z = 0 plane, so every normal points up
+        self.white = self.path("lh.white")
+        coords = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], float)
+        nib.freesurfer.write_geometry(self.white, coords,
+                                      np.array([[0, 1, 2]], np.int32))
+        self.thickness = self.path("lh.thickness")
+        nib.freesurfer.write_morph_data(self.thickness, np.array([1., 0, 0]))
+        self.data = (np.arange(64.).reshape(4, 4, 4)[..., None]
+                     + 100 * np.arange(2))
+        self.volume = self.save(self.data, "func.nii")
+        # tkregister RAS (x, y, z) is voxel (2 - x, 2 - z, 2 + y) here
+        d = self.data
+        self.expected = [(2 * d[2, 2, 2] + d[2, 1, 2]) / 3, d[1, 2, 2], d[2, 2, 3]]
+
+    def matrix(self, matrixdir=None):
+
+        return resample.vol2surf_matrix(self.regmat, self.volume, self.white,
+                                        self.thickness, [0, .5, 1], matrixdir)
+
+    def test_sample(self):
+
+        out = self.path("lh.out.mgz")
+        resample.sample_to_surface(self.matrix(), self.volume, out)
+        sampled = nib.load(out).get_data()
+        self.assertEqual(sampled.shape, (3, 1, 1, 2))
+        np.testing.assert_allclose(sampled[:, 0, 0], self.expected, rtol=1e-6)
+
+    def test_chunked(self):
+
+        out = self.path("lh.out.mgz")
+        resample.sample_to_surface(self.matrix(), self.volume, out, chunkframes=1)
+        np.testing.assert_allclose(nib.load(out).get_data()[:, 0, 0],
+                                   self.expected, rtol=1e-6)
+
+    def test_saved_matrix(self):
+
+        matrixdir = self.path("vol2surf")
+        matrix = self.matrix(matrixdir)
+        self.assertEqual(len(os.listdir(matrixdir)), 1)
+        self.assertTrue(self.matrix(matrixdir) is matrix)
+        # A fresh process reads the saved file instead of building it
+        resample._matrices.clear()
+        build = resample.build_vol2surf
+        resample.build_vol2surf = None
+        try:
+            loaded = self.matrix(matrixdir)
+        finally:
+            resample.build_vol2surf = build
+        np.testing.assert_allclose(loaded.toarray(), matrix.toarray())
+
+    def test_cache_bounded(self):
+
+        matrixdir = self.path("vol2surf")
+        cache_size = resample._cache_size
+        resample._cache_size = 1
+        try:
+            first = self.matrix(matrixdir)
+            resample.vol2surf_matrix(self.regmat, self.volume, self.white,
+                                     self.thickness, [.5], matrixdir)
+            self.assertEqual(len(resample._matrices), 1)
+            # Read back from its file after it was dropped
+            again = self.matrix(matrixdir)
+            self.assertFalse(again is first)
+            np.testing.assert_allclose(again.toarray(), first.toarray())
+        finally:
+            resample._cache_size = cache_size
+            resample._matrices.clear()
+
+    def test_wrong_grid(self):
+
+        other = self.save(np.zeros((2, 2, 2)), "other.nii")
+        self.assertRaises(ValueError, resample.sample_to_surface,
+                          self.matrix(), other, self.path("lh.out.mgz"))
+
+
+class TestMapLabels(ResampleTestCase):
+
+    def setUp(self):
+
+        ResampleTestCase.setUp(self)
+        faces = np.array([[0, 1, 2]], np.int32)
+        # Four source vertices on the equator; the target has the same
+        # four and two more, each nearest to one of them
+        srccoords = np.array([[1, 0, 0], [0, 1, 0], [-1, 0, 0], [0, -1, 0]], float)
+        trgcoords = np.vstack([srccoords, [[.9, .1, .3], [-.1, -.9, -.3]]])
+        self.srcsphere = self.path("src.sphere.reg")
+        self.trgsphere = self.path("trg.sphere.reg")
+        self.trgwhite = self.path("trg.white")
+        nib.freesurfer.write_geometry(self.srcsphere, srccoords, faces)
+        nib.freesurfer.write_geometry(self.trgsphere, trgcoords, faces)
+        self.whitecoords = trgcoords * 10
+        nib.freesurfer.write_geometry(self.trgwhite, self.whitecoords, faces)
+
+    def test_sphere_maps(self):
+
+        forward, reverse = resample.sphere_maps(self.srcsphere, self.trgsphere)
+        np.testing.assert_array_equal(forward, [0, 1, 2, 3])
+        np.testing.assert_array_equal(reverse, [0, 1, 2, 3, 0, 3])
+
+    def test_saved_maps(self):
+
+        mapdir = self.path("maps")
+        maps = resample.sphere_maps(self.srcsphere, self.trgsphere, mapdir)
+        self.assertEqual(len(os.listdir(mapdir)), 1)
+        resample._spheremaps.clear()
+        build = resample._build_sphere_maps
+        resample._build_sphere_maps = None
+        try:
+            loaded = resample.sphere_maps(self.srcsphere, self.trgsphere, mapdir)
+        finally:
+            resample._build_sphere_maps = build
+        for saved, read in zip(maps, loaded):
+            np.testing.assert_array_equal(saved, read)
+
+    def test_cache_bounded(self):
+
+        mapdir = self.path("maps")
+        other = self.path("other.sphere.reg")
+        shutil.copy(self.srcsphere, other)
+        # Same contents, but another file
+        os.utime(other, (0, 0))
+        cache_size = resample._cache_size
+        resample._cache_size = 1
+        try:
+            resample.sphere_maps(self.srcsphere, self.trgsphere)
+            resample.sphere_maps(other, self.trgsphere)
+            self.assertEqual([key[0] for key in resample._spheremaps], [other])
+            resample.sphere_maps(self.srcsphere, self.trgsphere, mapdir)
+            self.assertEqual(list(resample._spheremaps),
+                             [os.path.join(mapdir, os.listdir(mapdir)[0])])
+        finally:
+            resample._cache_size = cache_size
+            resample._spheremaps.clear()
+
+    def test_map_labels(self):
+
+        labels = [self.path("first.label"), self.path("second.label")]
+        write_label(labels[0], [0, 1], np.zeros((2, 3)), [1.5, 2.5], "fsaverage")
+        write_label(labels[1], [2], np.zeros((1, 3)), [-1], "fsaverage")
+        trglabels = [self.path("lh.first.label"), self.path("lh.second.label")]
+        resample.map_labels(labels, trglabels, self.srcsphere, self.trgsphere,
+                            self.trgwhite, "subj")
+        # The extra target vertex nearest source vertex 0 joins the label
+        vertices, values = read_label(trglabels[0])
+        np.testing.assert_array_equal(vertices, [0, 1, 4])
+        np.testing.assert_allclose(values, [1.5, 2.5, 1.5])
+        lines = open(trglabels[0]).readlines()
+        self.assertTrue("from subject subj" in lines[0])
+        np.testing.assert_allclose([float(x) for x in lines[4].split()[1:4]],
+                                   self.whitecoords[4], atol=1e-3)
+        vertices, values = read_label(trglabels[1])
+        np.testing.assert_array_equal(vertices, [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Unit tests for the memory budget shared by external program runners.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import runner
+from runner import MemoryBudget
+
+def _hold(profile, ledger, timesfile):
+    """Hold a reservation for a while and note when it was held."""
+    budget = MemoryBudget(1000, profile, ledger, poll=.02)
+    key = budget.acquire("mri_vol2vol")
+    start = time.time()
+    time.sleep(.3)
+    stop = time.time()
+    budget.release("mri_vol2vol", key)
+    fid = open(timesfile, "a")
+    fid.write("%f %f\n" % (start, stop))
+    fid.close()
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.profile = os.path.join(self.tmpdir, ".toolmemory")
+        self.ledger = self.profile + ".ledger"
+        json.dump({"mri_vol2vol": 600, "mri_segstats": 100}, open(self.profile, "w"))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def budget(self):
+
+        return MemoryBudget(1000, self.profile, self.ledger, poll=.02)
+
+    def test_shared_ledger(self):
+
+        # Two budgets on one ledger stand for two processes
+        first, second = self.budget(), self.budget()
+        key = first.acquire("mri_vol2vol")
+        self.assertEqual(second._try_reserve("mri_vol2vol"), None)
+        small = second.acquire("mri_segstats")
+        first.release("mri_vol2vol", key, 700)
+        key = second.acquire("mri_vol2vol")
+        self.assertEqual(second.peaks["mri_vol2vol"], 700)
+        second.release("mri_vol2vol", key)
+        second.release("mri_segstats", small)
+        self.assertEqual(json.load(open(self.ledger)), {})
+
+    def test_unmeasured(self):
+
+        budget = self.budget()
+        self.assertEqual(budget.reservation("bbregister"), runner._unmeasured_mb)
+        key = budget.acquire("mri_segstats")
+        # An unmeasured program no longer fits beside a measured one for free
+        self.assertEqual(budget._try_reserve("bbregister"), None)
+        budget.release("mri_segstats", key)
+        key = budget.acquire("bbregister")
+        self.assertEqual(budget._try_reserve("bbregister"), None)
+        budget.release("bbregister", key, 300)
+        self.assertEqual(budget.reservation("bbregister"), 300)
+
+    def test_dead_process(self):
+
+        proc = multiprocessing.Process(target=time.sleep, args=(0,))
+        proc.start()
+        proc.join()
+        json.dump({"gone": ["mri_vol2vol", 600, proc.pid]}, open(self.ledger, "w"))
+        budget = self.budget()
+        self.assertNotEqual(budget._try_reserve("mri_vol2vol"), None)
+
+    def test_processes(self):
+
+        timesfile = os.path.join(self.tmpdir, "times")
+        procs = [multiprocessing.Process(target=_hold,
+                                         args=(self.profile, self.ledger, timesfile))
+                 for i in range(2)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        times = sorted([map(float, line.split()) for line in open(timesfile)])
+        self.assertEqual(len(times), 2)
+        self.assertTrue(times[0][1] <= times[1][0])
+
+
+class BrokenBudget(object):
+    """Budget whose ledger cannot be written."""
+
+    def acquire(self, tool):
+
+        raise IOError("ledger is read-only")
+
+    def release(self, tool, key, peak=None):
+
+        raise AssertionError("released a reservation that was never made")
+
+
+class TestCommand(unittest.TestCase):
+
+    def test_budget_error(self):
+
+        semaphore = threading.BoundedSemaphore(1)
+        command = runner.Command("echo hello")
+        command._execute(semaphore, BrokenBudget(), None)
+        self.assertTrue(command.done())
+        self.assertEqual(command.wait(), ("", "ledger is read-only", -1))
+        # The concurrency slot was given back
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+"""Unit tests for the job spool and its workers.
+
+Run from the top of the source tree with::
+
+    python -m unittest discover -s test -p "test_*.py"
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pyroi"))
+import spool
+from spool import Spool, Worker
+
+def _run_worker(spooldir, name):
+
+    Worker(spooldir, name, poll=.05).run(idle=2)
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.spooldir = tempfile.mkdtemp()
+        self.spool = Spool(self.spooldir)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.spooldir)
+
+    def start_workers(self, n):
+
+        workers = [multiprocessing.Process(target=_run_worker,
+                                           args=(self.spooldir, "worker%d" % i))
+                   for i in range(n)]
+        for worker in workers:
+            worker.start()
+        return workers
+
+
+class TestWorkers(SpoolTestCase):
+
+    def test_two_workers(self):
+
+        jobids = [self.spool.submit("sleep .3; echo %d" % i) for i in range(6)]
+        workers = self.start_workers(2)
+        results = [self.spool.wait(jobid, poll=.05, unclaimed=10)
+                   for jobid in jobids]
+        for worker in workers:
+            worker.join()
+        for i, result in enumerate(results):
+            self.assertEqual(result["returncode"], 0)
+            self.assertEqual(result["stdout"], "%d\n" % i)
+        self.assertEqual(set([r["worker"] for r in results]),
+                         set(["worker0", "worker1"]))
+        for subdir in ["new", "claimed", "done", "failed", "workers"]:
+            self.assertEqual(os.listdir(os.path.join(self.spooldir, subdir)), [])
+
+    def test_dependent_jobs(self):
+
+        fname = os.path.join(self.spooldir, "out.txt")
+        first = self.spool.submit("sleep .3; echo first > %s" % fname,
+                                  outputs=[fname])
+        second = self.spool.submit("cat %s" % fname, inputs=[fname])
+        workers = self.start_workers(2)
+        self.assertEqual(self.spool.wait(first, poll=.05)["returncode"], 0)
+        self.assertEqual(self.spool.wait(second, poll=.05)["stdout"], "first\n")
+        for worker in workers:
+            worker.join()
+
+    def test_bad_output(self):
+
+        workers = self.start_workers(1)
+        stdout, stderr, returncode = self.spool.call(
+            "printf 'a\\377b'; exit 2", poll=.05, unclaimed=10)
+        for worker in workers:
+            worker.join()
+        self.assertEqual(returncode, 2)
+        self.assertEqual(stdout, u"a\ufffdb".encode("utf-8"))
+
+    def test_failed_finish(self):
+
+        job = dict(id="broken", worker="w")
+        self.spool._write(job, os.path.join(self.spool.claimdir, "broken.json"))
+        self.spool.fail(job, "Worker w failed on this job")
+        result = self.spool.wait("broken", poll=.05)
+        self.assertEqual(result["returncode"], -1)
+        self.assertEqual(os.listdir(self.spool.claimdir), [])
+        self.assertEqual(os.listdir(self.spool.faildir), ["broken.json"])
+
+    def test_finish_requeued(self):
+
+        # A submitter put the job back in the queue while it was running
+        jobid = self.spool.submit("echo hello")
+        job = self.spool.claim("w")
+        os.rename(os.path.join(self.spool.claimdir, "%s.json" % jobid),
+                  os.path.join(self.spool.newdir, "%s.json" % jobid))
+        self.spool.finish(job, 0, "hello\n")
+        self.assertEqual(os.listdir(self.spool.newdir), [])
+        result = self.spool.wait(jobid, poll=.05)
+        self.assertEqual(result["returncode"], 0)
+        self.assertEqual(result["stdout"], "hello\n")
+
+
+class TestWait(SpoolTestCase):
+
+    def test_no_workers(self):
+
+        started = time.time()
+        stdout, stderr, returncode = self.spool.call("echo hello", poll=.05,
+                                                     unclaimed=.2)
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(returncode, -1)
+        self.assertTrue("pyroi worker" in stderr)
+        self.assertEqual(os.listdir(self.spool.newdir), [])
+
+    def test_dead_worker(self):
+
+        # A job claimed by a worker that has stopped beating is requeued
+        jobid = self.spool.submit("echo hello")
+        job = self.spool.claim("gone")
+        self.spool.heartbeat("gone")
+        beat = time.time() - 2 * spool._heartbeat - 1
+        os.utime(os.path.join(self.spool.workerdir, "gone"), (beat, beat))
+        job["claimed"] = beat
+        self.spool._write(job, os.path.join(self.spool.claimdir, "%s.json" % jobid))
+        result = self.spool.wait(jobid, poll=.05, unclaimed=.2)
+        self.assertEqual(result["returncode"], -1)
+        self.assertEqual(os.listdir(self.spool.claimdir), [])
+        self.assertEqual(os.listdir(self.spool.newdir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()